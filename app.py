@@ -1,24 +1,64 @@
 import os
 import json
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
 import requests # For Knack API calls
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time # For cache expiry
 from datetime import datetime # For timestamp parsing
 import openai # For LLM integration
+import random # For retry jitter
 import re # For keyword extraction and special message handling
+import sys # For interning lookup-table keys
+from bisect import bisect_right # For banded score lookups
+import gzip # For response compression
+import hashlib # For LLM insights cache keys
+import heapq # For top/bottom questionnaire statements
+import hmac # For constant-time admin token checks
+import threading # For cache locking
+from collections import Counter, OrderedDict # Counter for response tallies, OrderedDict for LRU ordering in TTLCache
+from concurrent.futures import ThreadPoolExecutor, wait # For parallel Knack page fetches and batched LLM calls
+from functools import lru_cache, wraps
+from itertools import chain, islice
+from operator import itemgetter
 
 # Load environment variables from .env file (optional, Heroku uses config vars)
 load_dotenv()
 
 app = Flask(__name__)
 
+# jsonify would otherwise re-sort every nested dict in the (large) coaching payload on each response;
+# the dicts are already built in a meaningful order.
+if hasattr(app, "json"): # Flask 2.2+ JSON provider
+    app.json.sort_keys = False
+else:
+    app.config['JSON_SORT_KEYS'] = False
+
 # --- CORS Configuration ---
 # Allow requests ONLY from your Knack domain for security.
 CORS(app, resources={r"/api/*": {"origins": "https://vespaacademy.knack.com"}})
 
+# --- Response Compression ---
+# The coaching data payload (scored statements, averages, academic summary) runs to tens of KB,
+# so gzip it for clients that accept it. Small and streamed responses are left alone.
+GZIP_MIN_SIZE = 1024
+
+@app.after_request
+def gzip_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers or 'gzip' not in request.accept_encodings):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 # --- Logging Configuration ---
 # Basic logging setup
 if not app.debug:
@@ -40,33 +80,89 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 # Knack base URL for API calls - good to define once
 KNACK_API_BASE_URL = "https://api.knack.com/v1/objects"
 
+# Shared Knack HTTP session: pooled keep-alive connections avoid a TCP+TLS handshake per call,
+# and transient 429/5xx responses are retried with backoff (GETs and PUTs only; urllib3 never retries POSTs).
+# All calls go to the single api.knack.com host, so one host pool is enough; its size caps how many
+# sockets the process keeps open and should cover the concurrent page/profile fetches below.
+# A student load keeps about four Knack reads in flight at once (Object_10/29 on the request thread,
+# the two Object_112 lookups and the school averages in the background), so by default the pool is
+# sized for that across every gunicorn thread rather than letting pool_block serialize them.
+KNACK_REQUEST_TIMEOUT = (3.05, 30) # (connect, read) seconds
+KNACK_MAX_CONNECTIONS = int(os.getenv('KNACK_MAX_CONNECTIONS') or max(16, 4 * int(os.getenv('GUNICORN_THREADS', '4'))))
+KNACK_PAGE_FETCH_WORKERS = min(8, KNACK_MAX_CONNECTIONS) # Concurrent page fetches per paginated Knack query
+KNACK_SESSION = requests.Session()
+KNACK_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=KNACK_MAX_CONNECTIONS,
+    pool_block=True, # Wait for a free connection instead of opening throwaway sockets past the cap
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False),
+))
+if KNACK_APP_ID and KNACK_API_KEY:
+    KNACK_SESSION.headers.update({
+        'X-Knack-Application-Id': KNACK_APP_ID,
+        'X-Knack-REST-API-Key': KNACK_API_KEY,
+        'Content-Type': 'application/json'
+    })
+
 if not KNACK_APP_ID or not KNACK_API_KEY:
     app.logger.warning("KNACK_APP_ID or KNACK_API_KEY is not set. Knack integration will fail.")
 if not OPENAI_API_KEY:
     app.logger.warning("OPENAI_API_KEY is not set. OpenAI integration will fail.")
 
+# One OpenAI client per process so its pooled HTTP connections stay warm across requests.
+# The timeout stops a slow completion from tying up a worker indefinitely.
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '30'))
+openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS) if OPENAI_API_KEY else None
+# Concurrent Knack loads per class-view request (see _student_coaching_data_for_group)
+INSIGHTS_BATCH_WORKERS = int(os.getenv('INSIGHTS_BATCH_WORKERS', '4'))
+# Most students one class-view request may ask for; each costs Knack loads and OpenAI work, and the whole
+# request has to finish inside Heroku's 30 s router timeout
+STUDENT_GROUP_MAX = int(os.getenv('STUDENT_GROUP_MAX', '8'))
+# Wall-clock budget for a whole class-view request (Knack loads and insights), leaving headroom under that
+# 30 s limit. Students whose insights aren't back by then get the generic _fallback_student_insights.
+STUDENT_GROUP_DEADLINE_SECONDS = float(os.getenv('STUDENT_GROUP_DEADLINE_SECONDS', '25'))
+# Least time that must be left before that deadline to start another completion
+INSIGHTS_MIN_CALL_SECONDS = float(os.getenv('INSIGHTS_MIN_CALL_SECONDS', '5'))
+# Most students per ?mode=batch submission. Only their Knack loads happen inside the request (the LLM work
+# runs on the OpenAI Batch API), so this can be larger than STUDENT_GROUP_MAX
+INSIGHTS_BATCH_STUDENT_MAX = int(os.getenv('INSIGHTS_BATCH_STUDENT_MAX', '40'))
+# OpenAI insights calls in flight at once across all requests in this process (see INSIGHTS_LLM_POOL)
+INSIGHTS_LLM_WORKERS = int(os.getenv('INSIGHTS_LLM_WORKERS') or INSIGHTS_BATCH_WORKERS * int(os.getenv('GUNICORN_THREADS', '4')))
+# Students per combined insights request. The whole group's output (roughly 700-1200 tokens per student) has to
+# arrive within INSIGHTS_GROUP_TIMEOUT_SECONDS, so keep this small; a failed group's students are retried one at a
+# time only while the request's deadline allows.
+INSIGHTS_MULTI_STUDENT_MAX = int(os.getenv('INSIGHTS_MULTI_STUDENT_MAX', '2'))
+# A combined request gets one attempt with its own timeout: retrying a slow group only delays the fallback
+INSIGHTS_GROUP_TIMEOUT_SECONDS = float(os.getenv('INSIGHTS_GROUP_TIMEOUT_SECONDS', '25'))
+# First wait between insights attempts; doubles per attempt (the client already retries 429/5xx itself)
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.getenv('LLM_RETRY_BASE_DELAY_SECONDS', '1'))
+# Only these can succeed on a second attempt (APITimeoutError is an APIConnectionError)
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
 # --- Load Knowledge Bases (Copied from Tutor app.py, adapt paths if needed) ---
+# KB files live in a 'knowledge_base' subdirectory relative to this app.py
+_KB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'knowledge_base')
+
+@lru_cache(maxsize=None) # KB files are static; parse each one once per process
 def load_json_file(file_path):
+    full_path = os.path.join(_KB_DIR, file_path)
     try:
-        # Assuming KB files are in a 'knowledge_base' subdirectory relative to this app.py
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        full_path = os.path.join(current_dir, 'knowledge_base', file_path)
-        full_path = os.path.normpath(full_path)
-        app.logger.info(f"Attempting to load JSON KB: {full_path}")
-        with open(full_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        app.logger.info("Attempting to load JSON KB: %s", full_path)
+        with open(full_path, 'rb') as f:
+            data = json.loads(f.read())
         # Check if data is in Knack 'records' format for some files
         if isinstance(data, dict) and 'records' in data and isinstance(data['records'], list) and file_path in ['reporttext.json']:
-            app.logger.info(f"Extracted {len(data['records'])} records from {file_path}")
+            app.logger.info("Extracted %s records from %s", len(data['records']), file_path)
             return data['records']
-        app.logger.info(f"Loaded {file_path} (data type: {type(data)})")
+        app.logger.info("Loaded %s (data type: %s)", file_path, type(data))
         return data
     except FileNotFoundError:
-        app.logger.error(f"Knowledge base file not found: {file_path} (looked in {full_path})")
+        app.logger.error("Knowledge base file not found: %s (looked in %s)", file_path, full_path)
     except json.JSONDecodeError:
-        app.logger.error(f"Error decoding JSON from file: {file_path}")
+        app.logger.error("Error decoding JSON from file: %s", file_path)
     except Exception as e:
-        app.logger.error(f"Error loading JSON file {file_path}: {e}")
+        app.logger.error("Error loading JSON file %s: %s", file_path, e)
     return None
 
 # Load relevant KBs - adjust file names/paths as per your student coach's KB structure
@@ -77,20 +173,116 @@ grade_points_mapping_kb = load_json_file('grade_to_points_mapping.json')
 alps_bands_aLevel_75_kb = load_json_file('alpsBands_aLevel_75.json') # Example for standard MEG
 # ... load other ALPS KBs as needed (60th, 90th, 100th, BTEC, etc.)
 
+# --- Short-lived in-process cache for Knack lookups ---
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds."""
+    def __init__(self, maxsize=2048, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def evict(self, predicate):
+        """Drops every entry whose key satisfies predicate(key)."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_MISSING = object()
+
+def ttl_cached(cache):
+    """Caches a function's non-None results in `cache`, keyed on its positional args.
+    Concurrent misses on the same key wait for the first caller's result instead of
+    each running func (e.g. a cohort of students all needing one school's averages)."""
+    def decorator(func):
+        key_locks = {}
+        key_locks_guard = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + args
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            with key_locks_guard:
+                key_lock = key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                value = cache.get(key, _MISSING) # Filled in while we waited?
+                if value is not _MISSING:
+                    return value
+                try:
+                    value = func(*args)
+                    if value is not None:
+                        cache.set(key, value)
+                finally:
+                    with key_locks_guard:
+                        key_locks.pop(key, None)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+# The coach page fires student_coaching_data, chat_history and chat_turn within seconds of each other;
+# a one-minute cache lets them share the student's Knack records instead of refetching them.
+STUDENT_RECORD_CACHE = TTLCache(maxsize=2048, ttl=60)
+
+# Raw Knack GET response bodies. Records change on a scale of minutes, so repeat queries within
+# five minutes are served from memory; writes evict the affected object (see invalidate_knack_cache).
+# The bytes are kept and decoded on every hit, so each caller gets its own dict to modify.
+KNACK_RECORD_CACHE = TTLCache(maxsize=2048, ttl=300)
+# Objects read fresh every time. The chat log (object_119) is written by whichever gunicorn worker serves the
+# chat turn, and invalidate_knack_cache only clears this process, so a cached copy could hide new messages/likes.
+UNCACHED_KNACK_OBJECTS = frozenset(("object_119",))
+
+def invalidate_knack_cache(object_key):
+    "Drops cached Knack responses for one object after a write to it."
+    KNACK_RECORD_CACHE.evict(lambda key: key[0] == object_key)
+
 # --- Knack API Helper Functions (Adapted from Tutor app.py) ---
 def get_knack_record(object_key, record_id=None, filters=None, page=1, rows_per_page=1000):
     if not KNACK_APP_ID or not KNACK_API_KEY:
         app.logger.error("Knack App ID or API Key is missing for get_knack_record.")
         return None
-    headers = {
-        'X-Knack-Application-Id': KNACK_APP_ID,
-        'X-Knack-REST-API-Key': KNACK_API_KEY,
-        'Content-Type': 'application/json'
-    }
     params = {'page': page, 'rows_per_page': rows_per_page}
     if filters:
         params['filters'] = json.dumps(filters)
 
+    cache_key = None
+    if object_key not in UNCACHED_KNACK_OBJECTS:
+        cache_key = (object_key, record_id, json.dumps(filters, sort_keys=True) if filters else None, page, rows_per_page)
+        cached_content = KNACK_RECORD_CACHE.get(cache_key)
+        if cached_content is not None:
+            app.logger.info("Knack cache hit for %s (record_id=%s, page=%s).", object_key, record_id, page)
+            return json.loads(cached_content)
+
     url_path = f"/{object_key}/records"
     if record_id:
         url_path = f"/{object_key}/records/{record_id}"
@@ -99,78 +291,107 @@ def get_knack_record(object_key, record_id=None, filters=None, page=1, rows_per_
         current_params = params
     
     full_url = f"{KNACK_API_BASE_URL}{url_path}"
-    app.logger.info(f"Knack API call: URL={full_url}, Params={current_params}")
+    app.logger.info("Knack API call: URL=%s, Params=%s", full_url, current_params)
 
     try:
-        response = requests.get(full_url, headers=headers, params=current_params)
-        response.raise_for_status()
-        data = response.json()
-        app.logger.info(f"Knack API success for {object_key}. Records: {len(data.get('records', [])) if not record_id else '1 (specific ID)'}")
-        return data
-    except requests.exceptions.HTTPError as e:
-        app.logger.error(f"HTTP error fetching Knack data ({object_key}): {e}. Response: {response.content if response else 'No response object'}")
+        response = KNACK_SESSION.get(full_url, params=current_params, timeout=KNACK_REQUEST_TIMEOUT)
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Request exception fetching Knack data ({object_key}): {e}")
-    except json.JSONDecodeError:
-        app.logger.error(f"JSON decode error for Knack response ({object_key}). Response text: {response.text if response else 'No response object'}")
-    return None
+        app.logger.error("Request exception fetching Knack data (%s): %s", object_key, e)
+        return None
+
+    # Branch on the status code directly rather than raising and catching HTTPError.
+    # 429s have already been retried by the session (honouring Retry-After), so one here means Knack is still throttling.
+    status_code = response.status_code
+    if status_code == 429:
+        app.logger.warning("Knack rate limit still in effect for %s after retries (Retry-After: %s).", object_key, response.headers.get('Retry-After', 'N/A'))
+        return None
+    if status_code >= 400:
+        app.logger.error("HTTP %s fetching Knack data (%s). Response: %.500s", status_code, object_key, response.text)
+        return None
+
+    try:
+        data = response.json()
+    except ValueError: # json.JSONDecodeError / requests' JSONDecodeError
+        app.logger.error("JSON decode error for Knack response (%s). Response text: %.500s", object_key, response.text)
+        return None
+    app.logger.info("Knack API success for %s. Records: %s", object_key, len(data.get('records', [])) if not record_id else '1 (specific ID)')
+    if cache_key is not None:
+        KNACK_RECORD_CACHE.set(cache_key, response.content)
+    return data
 
 # --- Helper function to extract qualification details (ported from tutorapp.py) ---
+# Per-family detail extractors, dispatched on the normalized qualification type.
+# Each takes (exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance).
+_BTEC_SIZE_BY_TYPE = {
+    "BTEC Level 3 Extended Diploma": "EXTDIP",
+    "BTEC Level 3 Diploma": "DIP",
+    "BTEC Level 3 Subsidiary Diploma": "SUBDIP",
+}
+_PRE_U_TYPE_BY_TYPE = {"Pre-U Principal Subject": "FULL", "Pre-U Short Course": "SC"}
+_WJEC_SIZE_BY_TYPE = {"WJEC Level 3 Diploma": "DIP", "WJEC Level 3 Certificate": "CERT"}
+
+def _extract_btec_details(exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance):
+    details = {}
+    if "2010" in lower_exam_type: details['year'] = "2010"
+    elif "2016" in lower_exam_type: details['year'] = "2016"
+    else:
+        details['year'] = "2016" # Default BTEC year if not specified
+        app_logger_instance.info(f"BTEC year not specified in '{exam_type_str}', defaulting to {details['year']} for MEG lookup.")
+
+    # Determine BTEC size based on normalized type
+    size = _BTEC_SIZE_BY_TYPE.get(normalized_qual_type)
+    if size: details['size'] = size
+    elif normalized_qual_type == "BTEC Level 3 Extended Certificate": # This is often the default "BTEC Level 3"
+        # Size for "Extended Certificate" can depend on the year for some ALPS tables:
+        # for 2010 it might be referred to as just "Certificate" in ALPS bands, for 2016 it's usually "EXTCERT"
+        details['size'] = "CERT" if details['year'] == "2010" else "EXTCERT"
+    elif "foundation diploma" in lower_exam_type : details['size'] = "FOUNDDIP"
+    elif "90 credit diploma" in lower_exam_type or "90cr" in lower_exam_type : details['size'] = "NINETY_CR"
+    # Add other BTEC size mappings if necessary based on your ALPS band JSON keys
+
+    if not details.get('size'):
+         app_logger_instance.warning(f"Could not determine BTEC size for MEG key from '{exam_type_str}' (Normalized: '{normalized_qual_type}'). MEG lookup might fail.")
+    return details
+
+def _extract_pre_u_details(exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance):
+    pre_u_type = _PRE_U_TYPE_BY_TYPE.get(normalized_qual_type)
+    return {'pre_u_type': pre_u_type} if pre_u_type else {}
+
+def _extract_wjec_details(exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance):
+    wjec_size = _WJEC_SIZE_BY_TYPE.get(normalized_qual_type)
+    if not wjec_size: # Default if not clearly diploma or certificate but identified as WJEC
+        wjec_size = "CERT"
+        app_logger_instance.info(f"WJEC size not clearly diploma/certificate from '{normalized_qual_type}', defaulting to CERT for MEG lookup.")
+    return {'wjec_size': wjec_size}
+
+# Exact normalized types resolve in one dict lookup; anything else falls back to the family markers below.
+_QUAL_DETAILS_DISPATCH = {
+    "IB HL": lambda exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance: {'ib_level': "HL"},
+    "IB SL": lambda exam_type_str, normalized_qual_type, lower_exam_type, app_logger_instance: {'ib_level': "SL"},
+}
+_QUAL_FAMILY_MARKERS = (("BTEC", _extract_btec_details), ("Pre-U", _extract_pre_u_details), ("WJEC", _extract_wjec_details))
+for _qual_type in list(_BTEC_SIZE_BY_TYPE) + ["BTEC Level 3 Extended Certificate", "BTEC Level 3"]:
+    _QUAL_DETAILS_DISPATCH[_qual_type] = _extract_btec_details
+for _qual_type in _PRE_U_TYPE_BY_TYPE:
+    _QUAL_DETAILS_DISPATCH[_qual_type] = _extract_pre_u_details
+for _qual_type in _WJEC_SIZE_BY_TYPE:
+    _QUAL_DETAILS_DISPATCH[_qual_type] = _extract_wjec_details
+
 def extract_qual_details(exam_type_str, normalized_qual_type, app_logger_instance):
     """Extracts specific details (like year, size) from an exam_type_str based on its normalized type."""
     if not exam_type_str or not normalized_qual_type:
         app_logger_instance.debug(f"extract_qual_details: exam_type_str ('{exam_type_str}') or normalized_qual_type ('{normalized_qual_type}') is missing.")
         return None
-    
-    lower_exam_type = str(exam_type_str).lower()
-    details = {}
 
-    if normalized_qual_type == "IB HL":
-        details['ib_level'] = "HL"
-        return details
-    if normalized_qual_type == "IB SL":
-        details['ib_level'] = "SL"
-        return details
+    extractor = _QUAL_DETAILS_DISPATCH.get(normalized_qual_type)
+    if extractor is None:
+        for marker, family_extractor in _QUAL_FAMILY_MARKERS:
+            if marker in normalized_qual_type:
+                extractor = family_extractor
+                break
+    if extractor is not None:
+        return extractor(exam_type_str, normalized_qual_type, str(exam_type_str).lower(), app_logger_instance)
 
-    if "BTEC" in normalized_qual_type:
-        if "2010" in lower_exam_type: details['year'] = "2010"
-        elif "2016" in lower_exam_type: details['year'] = "2016"
-        else:
-            details['year'] = "2016" # Default BTEC year if not specified
-            app_logger_instance.info(f"BTEC year not specified in '{exam_type_str}', defaulting to {details['year']} for MEG lookup.")
-        
-        # Determine BTEC size based on normalized type
-        if normalized_qual_type == "BTEC Level 3 Extended Diploma": details['size'] = "EXTDIP"
-        elif normalized_qual_type == "BTEC Level 3 Diploma": details['size'] = "DIP"
-        elif normalized_qual_type == "BTEC Level 3 Subsidiary Diploma": details['size'] = "SUBDIP"
-        elif normalized_qual_type == "BTEC Level 3 Extended Certificate": # This is often the default "BTEC Level 3"
-            # Size for "Extended Certificate" can depend on the year for some ALPS tables
-            if details['year'] == "2010":
-                # For 2010, an "Extended Certificate" might be referred to as just "Certificate" in ALPS bands
-                details['size'] = "CERT" 
-            else: # For 2016, it's usually "EXTCERT"
-                details['size'] = "EXTCERT"
-        elif "foundation diploma" in lower_exam_type : details['size'] = "FOUNDDIP"
-        elif "90 credit diploma" in lower_exam_type or "90cr" in lower_exam_type : details['size'] = "NINETY_CR"
-        # Add other BTEC size mappings if necessary based on your ALPS band JSON keys
-        
-        if not details.get('size'):
-             app_logger_instance.warning(f"Could not determine BTEC size for MEG key from '{exam_type_str}' (Normalized: '{normalized_qual_type}'). MEG lookup might fail.")
-        return details
-
-    if "Pre-U" in normalized_qual_type:
-        if normalized_qual_type == "Pre-U Principal Subject": details['pre_u_type'] = "FULL"
-        elif normalized_qual_type == "Pre-U Short Course": details['pre_u_type'] = "SC"
-        return details
-
-    if "WJEC" in normalized_qual_type:
-        if normalized_qual_type == "WJEC Level 3 Diploma": details['wjec_size'] = "DIP"
-        elif normalized_qual_type == "WJEC Level 3 Certificate": details['wjec_size'] = "CERT"
-        else: # Default if not clearly diploma or certificate but identified as WJEC
-            details['wjec_size'] = "CERT" 
-            app_logger_instance.info(f"WJEC size not clearly diploma/certificate from '{normalized_qual_type}', defaulting to CERT for MEG lookup.")
-        return details
-    
     # No specific details needed for A-Level, AS-Level, UAL, CACHE for this function as per tutorapp.py structure
     # If they were needed (e.g. UAL Diploma vs ExtDip affecting MEG key), they would be added here.
     app_logger_instance.debug(f"No specific details extracted for '{normalized_qual_type}' from '{exam_type_str}'.")
@@ -178,11 +399,56 @@ def extract_qual_details(exam_type_str, normalized_qual_type, app_logger_instanc
 
 # --- Student Data Specific Fetching Functions ---
 
+# Object_3 field_70_raw sometimes arrives as an HTML link: <a href="mailto:email@example.com">email@example.com</a>
+_MAILTO_TARGET_RE = re.compile(r'mailto:([^"\'>]*)', re.IGNORECASE)
+_LINK_TEXT_RE = re.compile(r'>(.*)</a>$', re.IGNORECASE | re.DOTALL)
+
+def _looks_like_email(value):
+    return '@' in value and ' ' not in value and '<' not in value
+
+def extract_email_from_field70(raw_val_field70, obj_val_field70):
+    """Extracts a plain email address from Object_3 field_70 (email), or returns None.
+
+    Knack email fields fetched as objects look like {'email': 'actual.email@example.com', 'label': ...};
+    the _raw version may instead be a plain string or an HTML mailto link.
+    """
+    # Priority 1: field_70 as a Knack email object
+    if isinstance(obj_val_field70, dict) and isinstance(obj_val_field70.get('email'), str):
+        return obj_val_field70['email'].strip()
+    # Priority 2: field_70_raw as a Knack email object (less common for _raw to be an object)
+    if isinstance(raw_val_field70, dict) and isinstance(raw_val_field70.get('email'), str):
+        return raw_val_field70['email'].strip()
+    # Priority 3: field_70_raw as a string - an HTML mailto link or a plain email
+    if isinstance(raw_val_field70, str):
+        temp_email_str = raw_val_field70.strip()
+        lowered = temp_email_str.lower()
+        if lowered.startswith('<a') and lowered.endswith('</a>') and 'mailto:' in lowered:
+            mailto_match = _MAILTO_TARGET_RE.search(temp_email_str)
+            extracted_from_href = mailto_match.group(1).strip()
+            if _looks_like_email(extracted_from_href):
+                return extracted_from_href
+            # Fallback: the link text
+            text_match = _LINK_TEXT_RE.search(temp_email_str)
+            extracted_text = text_match.group(1).strip() if text_match else ''
+            if _looks_like_email(extracted_text):
+                app.logger.info("Used email from link text: %s", extracted_text)
+                return extracted_text
+            return None
+        if '@' in temp_email_str and '<' not in temp_email_str:
+            return temp_email_str
+        return None
+    # Priority 4: field_70 as a plain string
+    if isinstance(obj_val_field70, str) and '@' in obj_val_field70 and '<' not in obj_val_field70:
+        return obj_val_field70.strip()
+    return None
+
+@ttl_cached(STUDENT_RECORD_CACHE)
 def get_student_user_details(student_object3_id):
     "Fetches Object_3 record for the student."
     if not student_object3_id: return None
     return get_knack_record("object_3", record_id=student_object3_id)
 
+@ttl_cached(STUDENT_RECORD_CACHE)
 def get_student_object10_record(student_email):
     "Fetches student's Object_10 (VESPA Results) record using their email."
     if not student_email: return None
@@ -195,61 +461,113 @@ def get_student_object10_record(student_email):
     app.logger.warning(f"No Object_10 record found for email {student_email}.")
     return None
 
+@ttl_cached(STUDENT_RECORD_CACHE)
+def get_student_object29_all_cycles(object10_id):
+    """Fetches every Object_29 (Questionnaire) record for an Object_10 ID in one call.
+
+    Returns {cycle number as str: record}, keeping the first record per cycle, or None if there are none.
+    """
+    if not object10_id: return None
+    app.logger.info("Fetching Object_29 questionnaire data (all cycles) for Object_10 ID: %s", object10_id)
+    filters = [{'field': 'field_792', 'operator': 'is', 'value': object10_id}] # Connection to Object_10
+    response = get_knack_record("object_29", filters=filters)
+    records_by_cycle = {}
+    if response and response.get('records'):
+        for record in response['records']:
+            raw_cycle = record.get('field_863_raw', '') # Cycle number
+            cycle_key = str(int(raw_cycle)) if isinstance(raw_cycle, float) and raw_cycle.is_integer() else str(raw_cycle).strip()
+            if cycle_key in records_by_cycle:
+                app.logger.warning("Multiple Object_29 records found for Object_10 ID %s, cycle %s. Using the first one.", object10_id, cycle_key)
+                continue
+            records_by_cycle[cycle_key] = record
+    return records_by_cycle or None
+
 def get_student_object29_questionnaire_data(object10_id, cycle_number):
     "Fetches Object_29 (Questionnaire) data for a given Object_10 ID and cycle."
     if not object10_id or cycle_number is None: return None
-    app.logger.info(f"Fetching Object_29 questionnaire data for Object_10 ID: {object10_id}, Cycle: {cycle_number}")
-    filters = [
-        {'field': 'field_792', 'operator': 'is', 'value': object10_id}, # Connection to Object_10
-        {'field': 'field_863_raw', 'operator': 'is', 'value': str(cycle_number)} # Cycle number
-    ]
-    response = get_knack_record("object_29", filters=filters)
+    records_by_cycle = get_student_object29_all_cycles(object10_id) or {}
+    record = records_by_cycle.get(str(cycle_number)) # Assuming one Object_29 per student per cycle
+    if record is None:
+        app.logger.warning("No Object_29 data found for Object_10 ID %s, Cycle %s.", object10_id, cycle_number)
+    return record
+
+@ttl_cached(STUDENT_RECORD_CACHE)
+def get_student_object6_record(student_email):
+    "Fetches student's Object_6 (Student Records) record using their email."
+    if not student_email: return None
+    filters = [{'field': 'field_91', 'operator': 'is', 'value': student_email}] # field_91 is student email in Object_6
+    response = get_knack_record("object_6", filters=filters)
     if response and response.get('records'):
-        if len(response['records']) > 1:
-            app.logger.warning(f"Multiple Object_29 records found for Object_10 ID {object10_id}, cycle {cycle_number}. Using the first one.")
-        return response['records'][0] # Assuming one Object_29 per student per cycle
-    app.logger.warning(f"No Object_29 data found for Object_10 ID {object10_id}, Cycle {cycle_number}.")
+        return response['records'][0]
+    app.logger.warning(f"No Object_6 record found for email {student_email}.")
     return None
 
 # --- Ported Academic Profile Functions from tutorapp.py ---
 
+# Subject fields are field_3080 (Sub1) to field_3094 (Sub15) in Object_112
+SUBJECT_FIELD_IDS = tuple(f"field_{3079 + i}" for i in range(1, 16))
+# (plain, raw) field name pairs, built once so the parse loop does no string concatenation
+SUBJECT_FIELD_PAIRS = tuple((field_id, field_id + "_raw") for field_id in SUBJECT_FIELD_IDS)
+
+# Output key -> alternative key names used in the subject JSON, in priority order
+SUBJECT_KEY_ALIASES = (
+    ("subject", ("subject", "subject_name", "subjectName", "name")),
+    ("currentGrade", ("currentGrade", "current_grade", "cg", "currentgrade")),
+    ("targetGrade", ("targetGrade", "target_grade", "tg", "targetgrade")),
+    ("effortGrade", ("effortGrade", "effort_grade", "eg", "effortgrade")),
+    ("examType", ("examType", "exam_type", "qualificationType")),
+)
+
+def _pick(data, keys):
+    """Returns the first truthy value among keys, else data[last key] (or "N/A" if absent)."""
+    for key in keys[:-1]:
+        value = data.get(key)
+        if value:
+            return value
+    return data.get(keys[-1], "N/A")
+
 # Helper function to parse subjects from a given academic_profile_record (ported from tutorapp.py)
 def parse_subjects_from_profile_record(academic_profile_record, app_logger_instance):
     if not academic_profile_record:
         app_logger_instance.error("parse_subjects_from_profile_record called with no record.")
         return [] 
 
-    app_logger_instance.info(f"Parsing subjects for Object_112 record ID: {academic_profile_record.get('id')}. Record (first 500 chars): {str(academic_profile_record)[:500]}")
+    app_logger_instance.info("Parsing subjects for Object_112 record ID: %s", academic_profile_record.get('id'))
+    debug_enabled = app_logger_instance.isEnabledFor(logging.DEBUG) # Checked once; skips building debug strings at INFO
+    if debug_enabled:
+        app_logger_instance.debug("Object_112 record (first 500 chars): %.500s", academic_profile_record)
     subjects_summary = []
-    # Subject fields are field_3080 (Sub1) to field_3094 (Sub15) in tutorapp, assuming same for student view if Obj112 is shared
-    for i in range(1, 16):
-        field_id_subject_json = f"field_30{79+i}" # field_3080 to field_3094
-        subject_json_str = academic_profile_record.get(field_id_subject_json)
+    # Gather only the populated subject slots; most students fill 3-5 of the 15.
+    record_get = academic_profile_record.get
+    populated_slots = []
+    for field_id_subject_json, raw_field_id in SUBJECT_FIELD_PAIRS:
+        subject_json_str = record_get(field_id_subject_json)
         if subject_json_str is None:
-            subject_json_str = academic_profile_record.get(f"{field_id_subject_json}_raw")
+            subject_json_str = record_get(raw_field_id)
+        if subject_json_str:
+            populated_slots.append((field_id_subject_json, subject_json_str))
 
-        app_logger_instance.debug(f"For Obj112 ID {academic_profile_record.get('id')}, field {field_id_subject_json}: Data type: {type(subject_json_str)}, Content (brief): '{str(subject_json_str)[:100]}...'")
+    for field_id_subject_json, subject_json_str in populated_slots:
+        if debug_enabled:
+            app_logger_instance.debug("For Obj112 ID %s, field %s: Data type: %s, Content (brief): '%.100s...'", academic_profile_record.get('id'), field_id_subject_json, type(subject_json_str), subject_json_str)
         
-        if subject_json_str and isinstance(subject_json_str, str) and subject_json_str.strip().startswith('{'):
-            app_logger_instance.info(f"Attempting to parse JSON for {field_id_subject_json}: '{subject_json_str[:200]}...'")
+        if isinstance(subject_json_str, str) and subject_json_str.lstrip()[:1] == '{':
+            if debug_enabled:
+                app_logger_instance.debug("Attempting to parse JSON for %s: '%.200s...'", field_id_subject_json, subject_json_str)
             try:
                 subject_data = json.loads(subject_json_str)
-                app_logger_instance.info(f"Parsed subject_data for {field_id_subject_json}: {subject_data}")
-                summary_entry = {
-                    "subject": subject_data.get("subject") or subject_data.get("subject_name") or subject_data.get("subjectName") or subject_data.get("name", "N/A"),
-                    "currentGrade": subject_data.get("currentGrade") or subject_data.get("current_grade") or subject_data.get("cg") or subject_data.get("currentgrade", "N/A"),
-                    "targetGrade": subject_data.get("targetGrade") or subject_data.get("target_grade") or subject_data.get("tg") or subject_data.get("targetgrade", "N/A"),
-                    "effortGrade": subject_data.get("effortGrade") or subject_data.get("effort_grade") or subject_data.get("eg") or subject_data.get("effortgrade", "N/A"),
-                    "examType": subject_data.get("examType") or subject_data.get("exam_type") or subject_data.get("qualificationType", "N/A")
-                }
+                if debug_enabled:
+                    app_logger_instance.debug("Parsed subject_data for %s: %s", field_id_subject_json, subject_data)
+                summary_entry = {out_key: _pick(subject_data, aliases) for out_key, aliases in SUBJECT_KEY_ALIASES}
                 if summary_entry["subject"] != "N/A" and summary_entry["subject"] is not None:
                     subjects_summary.append(summary_entry)
-                    app_logger_instance.debug(f"Added subject: {summary_entry['subject']}")
+                    if debug_enabled:
+                        app_logger_instance.debug("Added subject: %s", summary_entry['subject'])
                 else:
                     app_logger_instance.info(f"Skipped adding subject for {field_id_subject_json} as subject name was invalid or N/A. Parsed data: {subject_data}")
             except json.JSONDecodeError as e:
                 app_logger_instance.warning(f"JSONDecodeError for {field_id_subject_json}: {e}. Content: '{subject_json_str[:100]}...'")
-        elif subject_json_str:
+        else:
             app_logger_instance.info(f"Field {field_id_subject_json} was not empty but not a valid JSON string start: '{subject_json_str[:100]}...'")
 
     if not subjects_summary:
@@ -261,354 +579,510 @@ def parse_subjects_from_profile_record(academic_profile_record, app_logger_insta
 
 # Function to fetch Academic Profile (Object_112) - (ported from tutorapp.py)
 def get_academic_profile(actual_student_obj3_id, student_name_for_fallback, app_logger_instance, student_obj10_id_log_ref="N/A"):
-    app_logger_instance.info(f"Starting academic profile fetch. Target Student's Object_3 ID: '{actual_student_obj3_id}', Fallback Name: '{student_name_for_fallback}', Original Obj10 ID for logging: {student_obj10_id_log_ref}.")
-    
-    academic_profile_record = None
-    subjects_summary = []
+    cache_key = ("get_academic_profile", actual_student_obj3_id, student_name_for_fallback)
+    cached_profile = STUDENT_RECORD_CACHE.get(cache_key)
+    if cached_profile is not None:
+        app_logger_instance.info(f"Using cached academic profile for Object_3 ID '{actual_student_obj3_id}'.")
+        return cached_profile
+    academic_profile = _fetch_academic_profile(actual_student_obj3_id, student_name_for_fallback, app_logger_instance, student_obj10_id_log_ref)
+    if academic_profile and academic_profile.get("profile_record"):
+        STUDENT_RECORD_CACHE.set(cache_key, academic_profile)
+    return academic_profile
+
+def _has_valid_subjects(subjects_summary):
+    "True unless parse_subjects_from_profile_record returned nothing or only its placeholder entry."
+    return bool(subjects_summary) and not (len(subjects_summary) == 1 and subjects_summary[0]["subject"].startswith("No academic subjects"))
+
+def _profile_match_rank(actual_student_obj3_id):
+    """Sort key preferring profiles matched on field_3064 (UserId text), then field_3070 (Account Connection)."""
+    def rank(record):
+        if str(record.get('field_3064') or '').strip() == actual_student_obj3_id:
+            return 0
+        connection = record.get('field_3070_raw')
+        if isinstance(connection, list) and any(isinstance(c, dict) and c.get('id') == actual_student_obj3_id for c in connection):
+            return 1
+        return 2
+    return rank
+
+def _first_valid_profile(knack_response, lookup_label, app_logger_instance, rank_key=None):
+    """Returns {"subjects", "profile_record"} for the first candidate Object_112 record with valid subjects, else None."""
+    records = knack_response.get('records') if isinstance(knack_response, dict) else None
+    if not isinstance(records, list) or not records:
+        app_logger_instance.info("%s FAILED: No Object_112 candidates found. Response: %.200s", lookup_label, knack_response)
+        return None
+    candidates = [record for record in records if isinstance(record, dict)]
+    if len(candidates) < len(records):
+        app_logger_instance.warning(f"{lookup_label}: Skipped {len(records) - len(candidates)} Object_112 candidates that were not dicts.")
+    if rank_key:
+        candidates.sort(key=rank_key)
+    app_logger_instance.info(f"{lookup_label}: Found {len(candidates)} candidate profiles.")
+    for record in candidates:
+        subjects_summary = parse_subjects_from_profile_record(record, app_logger_instance)
+        if _has_valid_subjects(subjects_summary):
+            app_logger_instance.info(f"{lookup_label} SUCCESS: Object_112 ID {record.get('id')} has valid subjects. Profile Name: {record.get('field_3066')}")
+            return {"subjects": subjects_summary, "profile_record": record}
+        app_logger_instance.info(f"{lookup_label}: Object_112 ID {record.get('id')} yielded no valid subjects.")
+    return None
 
-    # Attempt 1: Fetch Object_112 using actual_student_obj3_id against Object_112.field_3064 (UserId - Short Text field)
-    if actual_student_obj3_id:
-        app_logger_instance.info(f"Attempt 1: Fetching Object_112 where field_3064 (UserId Text) is '{actual_student_obj3_id}'.")
-        filters_obj112_via_field3064 = [{'field': 'field_3064', 'operator': 'is', 'value': actual_student_obj3_id}]
-        obj112_response_attempt1 = get_knack_record("object_112", filters=filters_obj112_via_field3064)
-
-        temp_profiles_list_attempt1 = []
-        if obj112_response_attempt1 and isinstance(obj112_response_attempt1, dict) and \
-           'records' in obj112_response_attempt1 and isinstance(obj112_response_attempt1['records'], list):
-            temp_profiles_list_attempt1 = obj112_response_attempt1['records']
-            app_logger_instance.info(f"Attempt 1: Found {len(temp_profiles_list_attempt1)} candidate profiles via field_3064.")
-        else:
-            app_logger_instance.info(f"Attempt 1: Knack response for field_3064 query was not in expected format or no records. Response: {str(obj112_response_attempt1)[:200]}")
-
-        if temp_profiles_list_attempt1: 
-            if isinstance(temp_profiles_list_attempt1[0], dict):
-                academic_profile_record = temp_profiles_list_attempt1[0]
-                app_logger_instance.info(f"Attempt 1 SUCCESS: Found Object_112 record ID {academic_profile_record.get('id')} using field_3064 with Obj3 ID '{actual_student_obj3_id}'. Profile Name: {academic_profile_record.get('field_3066')}")
-                subjects_summary = parse_subjects_from_profile_record(academic_profile_record, app_logger_instance)
-                if not subjects_summary or (len(subjects_summary) == 1 and subjects_summary[0]["subject"].startswith("No academic subjects")):
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via field_3064) yielded no valid subjects. Will try other methods.")
-                    academic_profile_record = None 
-                else:
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via field_3064) has valid subjects. Using this profile.")
-                    return {"subjects": subjects_summary, "profile_record": academic_profile_record}
-            else:
-                app_logger_instance.warning(f"Attempt 1: First item in profiles_via_field3064 is not a dict: {type(temp_profiles_list_attempt1[0])}")
-        else:
-            app_logger_instance.info(f"Attempt 1 FAILED (empty list): No Object_112 profile found where field_3064 (UserId Text) is '{actual_student_obj3_id}'.")
+# Long-lived pool for single Knack GETs that callers wait on (the Object_112 lookups). Kept apart from
+# KNACK_BACKGROUND_POOL because get_academic_profile runs there and waits on these; jobs here never wait on anything.
+KNACK_READ_POOL = ThreadPoolExecutor(max_workers=KNACK_MAX_CONNECTIONS)
 
-    # Attempt 2: Fetch Object_112 using actual_student_obj3_id against Object_112.field_3070 (Account Connection field)
-    if not academic_profile_record and actual_student_obj3_id: 
-        app_logger_instance.info(f"Attempt 2: Fetching Object_112 where field_3070 (Account Connection) is '{actual_student_obj3_id}'.")
-        filters_obj112_via_field3070 = [{'field': 'field_3070_raw', 'operator': 'is', 'value': actual_student_obj3_id}]
-        obj112_response_attempt2 = get_knack_record("object_112", filters=filters_obj112_via_field3070)
-        
-        temp_profiles_list_attempt2 = []
-        if not (obj112_response_attempt2 and isinstance(obj112_response_attempt2, dict) and 'records' in obj112_response_attempt2 and isinstance(obj112_response_attempt2['records'], list) and obj112_response_attempt2['records']):
-            app_logger_instance.info(f"Attempt 2 (field_3070_raw): No records or unexpected format. Trying 'field_3070' (non-raw). Response: {str(obj112_response_attempt2)[:200]}" )
-            filters_obj112_via_field3070_alt = [{'field': 'field_3070', 'operator': 'is', 'value': actual_student_obj3_id}]
-            obj112_response_attempt2 = get_knack_record("object_112", filters=filters_obj112_via_field3070_alt)
-
-        if obj112_response_attempt2 and isinstance(obj112_response_attempt2, dict) and \
-           'records' in obj112_response_attempt2 and isinstance(obj112_response_attempt2['records'], list):
-            temp_profiles_list_attempt2 = obj112_response_attempt2['records']
-            app_logger_instance.info(f"Attempt 2: Found {len(temp_profiles_list_attempt2)} candidate profiles via field_3070 logic.")
-
-        if temp_profiles_list_attempt2: 
-            if isinstance(temp_profiles_list_attempt2[0], dict):
-                academic_profile_record = temp_profiles_list_attempt2[0]
-                app_logger_instance.info(f"Attempt 2 SUCCESS: Found Object_112 record ID {academic_profile_record.get('id')} using field_3070 (Account Connection) with Obj3 ID '{actual_student_obj3_id}'. Profile Name: {academic_profile_record.get('field_3066')}")
-                subjects_summary = parse_subjects_from_profile_record(academic_profile_record, app_logger_instance)
-                if not subjects_summary or (len(subjects_summary) == 1 and subjects_summary[0]["subject"].startswith("No academic subjects")):
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via field_3070) yielded no valid subjects. Will try name fallback.")
-                    academic_profile_record = None 
-                else:
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via field_3070) has valid subjects. Using this profile.")
-                    return {"subjects": subjects_summary, "profile_record": academic_profile_record}
-            else:
-                app_logger_instance.warning(f"Attempt 2: First item in profiles_via_field3070 is not a dict: {type(temp_profiles_list_attempt2[0])}")
-        else:
-            app_logger_instance.info(f"Attempt 2 FAILED (empty list): No Object_112 profile found where field_3070 (Account Connection) is '{actual_student_obj3_id}'.")
+def _prefetch_academic_profile_queries(actual_student_obj3_id, student_name_for_fallback):
+    """Starts the Object_112 lookups concurrently; returns {"account": Future, "name": Future} for those that apply.
 
-    # Attempt 3: Fallback to fetch by student name
-    if not academic_profile_record and student_name_for_fallback and student_name_for_fallback != "N/A":
-        app_logger_instance.info(f"Attempt 3: Fallback search for Object_112 by student name ('{student_name_for_fallback}') via field_3066.")
-        filters_object112_name = [{'field': 'field_3066', 'operator': 'is', 'value': student_name_for_fallback}]
-        obj112_response_attempt3 = get_knack_record("object_112", filters=filters_object112_name)
-        
-        temp_profiles_list_attempt3 = []
-        if obj112_response_attempt3 and isinstance(obj112_response_attempt3, dict) and \
-           'records' in obj112_response_attempt3 and isinstance(obj112_response_attempt3['records'], list):
-            temp_profiles_list_attempt3 = obj112_response_attempt3['records']
-            app_logger_instance.info(f"Attempt 3: Found {len(temp_profiles_list_attempt3)} candidate profiles via name fallback.")
-
-        if temp_profiles_list_attempt3: 
-            if isinstance(temp_profiles_list_attempt3[0], dict):
-                academic_profile_record = temp_profiles_list_attempt3[0]
-                app_logger_instance.info(f"Attempt 3 SUCCESS: Found Object_112 record ID {academic_profile_record.get('id')} via NAME fallback ('{student_name_for_fallback}'). Profile Name: {academic_profile_record.get('field_3066')}")
-                subjects_summary = parse_subjects_from_profile_record(academic_profile_record, app_logger_instance)
-                if not subjects_summary or (len(subjects_summary) == 1 and subjects_summary[0]["subject"].startswith("No academic subjects")):
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via name fallback) yielded no valid subjects.")
-                    # Fall through to default return
-                else:
-                    app_logger_instance.info(f"Object_112 ID {academic_profile_record.get('id')} (via name fallback) has valid subjects. Using this profile.")
-                    return {"subjects": subjects_summary, "profile_record": academic_profile_record}
-            else:
-                app_logger_instance.warning(f"Attempt 3: First item in homepage_profiles_name_search is not a dict: {type(temp_profiles_list_attempt3[0])}")
-        else:
-            app_logger_instance.warning(f"Attempt 3 FAILED (empty list): Fallback search: No Object_112 found for student name: '{student_name_for_fallback}'.")
+    The account lookup is a single OR query across field_3064 (UserId text), field_3070_raw and
+    field_3070 (Account Connection) instead of one round trip per field.
+    """
+    queries = {}
+    if actual_student_obj3_id:
+        queries["account"] = {'match': 'or', 'rules': [
+            {'field': field, 'operator': 'is', 'value': actual_student_obj3_id}
+            for field in ("field_3064", "field_3070_raw", "field_3070")
+        ]}
+    if student_name_for_fallback and student_name_for_fallback != "N/A":
+        queries["name"] = [{'field': 'field_3066', 'operator': 'is', 'value': student_name_for_fallback}]
+    if not queries:
+        return {}
+    # Lookups finish in the background; unused results are simply discarded
+    return {key: KNACK_READ_POOL.submit(get_knack_record, "object_112", filters=filters) for key, filters in queries.items()}
+
+# Long-lived pool for the background Knack fetches of a student load (academic profile, school averages,
+# save_chat's Object_10 lookup), sized like the Knack connection pool so every thread can hold a connection.
+# Jobs on it never submit to it (only to KNACK_READ_POOL), so waiting on its futures can't deadlock.
+# Threads start on first use.
+KNACK_BACKGROUND_POOL = ThreadPoolExecutor(max_workers=KNACK_MAX_CONNECTIONS)
+
+def _submit_background_fetch(fetch_fn, *args):
+    """Runs fetch_fn(*args) on KNACK_BACKGROUND_POOL and returns the Future, so independent Knack reads can overlap."""
+    return KNACK_BACKGROUND_POOL.submit(fetch_fn, *args)
+
+def _fetch_academic_profile(actual_student_obj3_id, student_name_for_fallback, app_logger_instance, student_obj10_id_log_ref="N/A"):
+    app_logger_instance.info(f"Starting academic profile fetch. Target Student's Object_3 ID: '{actual_student_obj3_id}', Fallback Name: '{student_name_for_fallback}', Original Obj10 ID for logging: {student_obj10_id_log_ref}.")
+
+    # The account and name lookups are issued together so the fallback doesn't add a round trip;
+    # results are still consumed in priority order.
+    obj112_lookups = _prefetch_academic_profile_queries(actual_student_obj3_id, student_name_for_fallback)
+
+    # Attempt 1: Object_3 ID against field_3064 / field_3070 (one OR query), field_3064 matches first
+    if "account" in obj112_lookups:
+        app_logger_instance.info(f"Attempt 1: Fetching Object_112 where field_3064 (UserId Text) or field_3070 (Account Connection) is '{actual_student_obj3_id}'.")
+        academic_profile = _first_valid_profile(obj112_lookups["account"].result(), "Attempt 1 (Obj3 ID)", app_logger_instance,
+                                                rank_key=_profile_match_rank(actual_student_obj3_id))
+        if academic_profile:
+            return academic_profile
+
+    # Attempt 2: Fallback to fetch by student name
+    if "name" in obj112_lookups:
+        app_logger_instance.info(f"Attempt 2: Fallback search for Object_112 by student name ('{student_name_for_fallback}') via field_3066.")
+        academic_profile = _first_valid_profile(obj112_lookups["name"].result(), "Attempt 2 (name fallback)", app_logger_instance)
+        if academic_profile:
+            return academic_profile
     
     app_logger_instance.warning(f"All attempts to fetch Object_112 failed (Student's Obj3 ID: '{actual_student_obj3_id}', Fallback name: '{student_name_for_fallback}').")
     default_subjects = [{"subject": "Academic profile not found by any method.", "currentGrade": "N/A", "targetGrade": "N/A", "effortGrade": "N/A", "examType": "N/A"}]
     return {"subjects": default_subjects, "profile_record": None}
 
 # --- Data Processing Helper (Simplified for now) ---
+# Lower bounds of each VESPA score band, in ascending order, and the label for each bisect position
+SCORE_PROFILE_BOUNDS = (0, 4, 6, 8)
+SCORE_PROFILE_LABELS = ("N/A", "Very Low", "Low", "Medium", "High")
+
 def get_score_profile_text(score_value):
     """Maps a VESPA score to a qualitative category like High, Medium, Low, Very Low."""
     if score_value is None: return "N/A"
-    try:
-        score = float(score_value)
-        if score >= 8: return "High"
-        if score >= 6: return "Medium"
-        if score >= 4: return "Low"
-        if score >= 0: return "Very Low" # Catches 0, 1, 2, 3
-        return "N/A" # Should not be reached if score is a number
-    except (ValueError, TypeError):
-        app.logger.debug(f"get_score_profile_text: Could not convert score '{score_value}' to float.")
-        return "N/A"
+    if type(score_value) in (int, float):
+        score = score_value # Already numeric - skip the float() conversion
+    else:
+        try:
+            score = float(score_value)
+        except (ValueError, TypeError):
+            app.logger.debug("get_score_profile_text: Could not convert score '%s' to float.", score_value)
+            return "N/A"
+    if score != score: return "N/A" # NaN fits no band
+    # bisect_right: 8+ -> High, 6-8 -> Medium, 4-6 -> Low, 0-4 -> Very Low, negative -> N/A
+    return SCORE_PROFILE_LABELS[bisect_right(SCORE_PROFILE_BOUNDS, score)]
 
 
 # --- NEW: Add comprehensive data processing functions ---
 
+def _parse_knack_page(response_data, object_key, page):
+    """Returns the records list from a Knack page response, or None if the page is unusable."""
+    if not response_data or not isinstance(response_data, dict):
+        app.logger.warning(f"No response_data or unexpected format on page {page} for {object_key}. Stopping pagination.")
+        return None
+    records_on_page = response_data.get('records', [])
+    if not isinstance(records_on_page, list):
+        app.logger.warning(f"'records' key in response_data for {object_key} page {page} is not a list. Type: {type(records_on_page)}. Stopping pagination.")
+        return None
+    return records_on_page
+
 def get_all_knack_records(object_key, filters=None, max_pages=20):
-    """Fetches all records from a Knack object using pagination."""
-    all_records = []
-    current_page = 1
-    total_pages = 1
+    """Fetches all records from a Knack object using pagination.
 
-    app.logger.info(f"Starting paginated fetch for {object_key} with filters: {filters}")
+    Page 1 is fetched first to learn total_pages; the remaining pages are then fetched
+    concurrently over the shared Knack session and stitched back together in page order.
+    """
+    app.logger.info("Starting paginated fetch for %s with filters: %s", object_key, filters)
 
-    while current_page <= total_pages and current_page <= max_pages:
-        app.logger.info(f"Fetching page {current_page} for {object_key}...")
-        response_data = get_knack_record(object_key, filters=filters, page=current_page, rows_per_page=1000)
-        
-        if response_data and isinstance(response_data, dict):
-            records_on_page = response_data.get('records', [])
-            
-            if isinstance(records_on_page, list):
-                all_records.extend(records_on_page)
-                app.logger.info(f"Fetched {len(records_on_page)} records from page {current_page} for {object_key}. Total so far: {len(all_records)}.")
-            else:
-                app.logger.warning(f"'records' key in response_data for {object_key} page {current_page} is not a list. Type: {type(records_on_page)}. Stopping pagination.")
-                break
-            
-            new_total_pages = response_data.get('total_pages')
-            if new_total_pages is not None:
-                try:
-                    total_pages = int(new_total_pages)
-                    if current_page == 1:
-                        app.logger.info(f"Total pages for {object_key} identified from API: {total_pages}")
-                except (ValueError, TypeError):
-                    app.logger.warning(f"Could not parse 'total_pages' ('{new_total_pages}') from response for {object_key} on page {current_page}.")
-            
-            if not records_on_page or len(records_on_page) < 1000 or current_page >= total_pages:
-                app.logger.info(f"Last page likely reached for {object_key} on page {current_page}.")
-                break
-            current_page += 1
-        else:
-            app.logger.warning(f"No response_data or unexpected format on page {current_page} for {object_key}. Stopping pagination.")
+    first_page_data = get_knack_record(object_key, filters=filters, page=1, rows_per_page=1000)
+    all_records = _parse_knack_page(first_page_data, object_key, 1)
+    if all_records is None:
+        return []
+    all_records = list(all_records)
+    app.logger.info("Fetched %d records from page 1 for %s.", len(all_records), object_key)
+
+    total_pages = 1
+    new_total_pages = first_page_data.get('total_pages')
+    if new_total_pages is not None:
+        try:
+            total_pages = int(new_total_pages)
+            app.logger.info("Total pages for %s identified from API: %s", object_key, total_pages)
+        except (ValueError, TypeError):
+            app.logger.warning(f"Could not parse 'total_pages' ('{new_total_pages}') from response for {object_key} on page 1.")
+
+    last_page = min(total_pages, max_pages)
+    if len(all_records) < 1000 or last_page <= 1:
+        app.logger.info("Completed paginated fetch for %s. Total records retrieved: %d.", object_key, len(all_records))
+        return all_records
+
+    remaining_pages = range(2, last_page + 1)
+    with ThreadPoolExecutor(max_workers=min(KNACK_PAGE_FETCH_WORKERS, len(remaining_pages))) as executor:
+        page_responses = list(executor.map(
+            lambda page: get_knack_record(object_key, filters=filters, page=page, rows_per_page=1000),
+            remaining_pages
+        ))
+
+    for page, response_data in zip(remaining_pages, page_responses):
+        records_on_page = _parse_knack_page(response_data, object_key, page)
+        if records_on_page is None:
             break
-            
-    app.logger.info(f"Completed paginated fetch for {object_key}. Total records retrieved: {len(all_records)}.")
+        all_records.extend(records_on_page)
+        if len(records_on_page) < 1000:
+            break
+
+    app.logger.info("Completed paginated fetch for %s. Total records retrieved: %d.", object_key, len(all_records))
     return all_records
 
+def _score_as_float(score_value):
+    "Returns a Knack score value as a number, or None if it is missing or not numeric."
+    if score_value is None or score_value == "": # Unscored students come back as blanks
+        return None
+    if type(score_value) in (int, float): # Knack already returns most scores as numbers
+        return score_value
+    try:
+        return float(score_value)
+    except (ValueError, TypeError):
+        app.logger.debug("Could not convert score %r to float.", score_value)
+        return None
+
+# VESPA element -> Object_10 score field for the current cycle
+VESPA_SCORE_FIELDS = (
+    ("Vision", "field_147"),
+    ("Effort", "field_148"),
+    ("Systems", "field_149"),
+    ("Practice", "field_150"),
+    ("Attitude", "field_151"),
+)
+
+# School averages also include the Overall score
+VESPA_AVERAGE_FIELDS = VESPA_SCORE_FIELDS + (("Overall", "field_152"),)
+
+def lowest_vespa_element(vespa_profile):
+    """Name of the element with the lowest score_1_to_10 in a vespa_profile dict ({element: {"score_1_to_10": ...}}),
+    or None. Overall, non-dict entries and unscored elements are ignored; a missing score counts as 10 and the
+    first element wins ties."""
+    lowest_element_name = None
+    lowest_score_val = 11
+    for element_name, element_details in (vespa_profile or {}).items():
+        if element_name == "Overall" or not isinstance(element_details, dict):
+            continue
+        score = _score_as_float(element_details.get('score_1_to_10', 10))
+        if score is not None and score < lowest_score_val:
+            lowest_score_val = score
+            lowest_element_name = element_name
+    return lowest_element_name
+
+# Object_29 questions resolved once from the KB as (score field, _raw fallback field or None, statement text, VESPA category)
+PSYCHOMETRIC_SCORE_FIELDS = tuple(
+    (field_id, field_id + '_raw' if field_id.startswith("field_") else None,
+     q_detail.get('questionText', 'Unknown Question'), q_detail.get('vespaCategory', 'N/A'))
+    for q_detail in psychometric_question_details_kb or ()
+    for field_id in (q_detail.get('currentCycleFieldId'),) if field_id # These are generic like field_794
+)
+
+def calculate_school_vespa_averages(student_records):
+    """Averages each VESPA_AVERAGE_FIELDS score over a list of Object_10 record dicts.
+    Blank or non-numeric scores are left out; an element with no scores averages 0."""
+    field_keys = [field_key for _, field_key in VESPA_AVERAGE_FIELDS]
+    # Read each record once into a row of floats, then transpose the rows into per-element columns
+    rows = ([_score_as_float(record.get(field_key)) for field_key in field_keys] for record in student_records)
+    columns = list(zip(*rows)) or [()] * len(field_keys)
+    averages = {}
+    for (element_name, _), column in zip(VESPA_AVERAGE_FIELDS, columns):
+        scores = [score for score in column if score is not None]
+        averages[element_name] = round(sum(scores) / len(scores), 2) if scores else 0
+    return averages
+
+# School-wide averages only move when students submit questionnaires, and computing them pages through
+# every Object_10 record for the school, so results are kept for ten minutes per school_id.
+SCHOOL_AVERAGES_CACHE = TTLCache(maxsize=512, ttl=600)
+
+@ttl_cached(SCHOOL_AVERAGES_CACHE)
 def get_school_vespa_averages(school_id):
     """Calculate average VESPA scores for all students in a school."""
     if not school_id:
         app.logger.warning("get_school_vespa_averages called with no school_id.")
         return None
 
-    app.logger.info(f"Calculating school VESPA averages for school_id: {school_id}")
+    app.logger.info("Calculating school VESPA averages for school_id: %s", school_id)
     
     # Use the correct filter from tutor app.py - field_133 is the school connection
     filters_primary = [{'field': 'field_133', 'operator': 'is', 'value': school_id}]
-    app.logger.info(f"Attempting to fetch all records for object_10 with primary filter: {filters_primary}")
+    app.logger.info("Attempting to fetch all records for object_10 with primary filter: %s", filters_primary)
     
     all_student_records_for_school = get_all_knack_records("object_10", filters=filters_primary)
 
     if not all_student_records_for_school:
-        app.logger.warning(f"No student records found for school_id {school_id} using primary filter (field_133). Trying fallback filter (field_133_raw).")
+        app.logger.warning("No student records found for school_id %s using primary filter (field_133). Trying fallback filter (field_133_raw).", school_id)
         filters_fallback = [{'field': 'field_133_raw', 'operator': 'contains', 'value': school_id}]
-        app.logger.info(f"Attempting to fetch all records for object_10 with fallback filter: {filters_fallback}")
+        app.logger.info("Attempting to fetch all records for object_10 with fallback filter: %s", filters_fallback)
         all_student_records_for_school = get_all_knack_records("object_10", filters=filters_fallback)
         
         if not all_student_records_for_school:
-            app.logger.error(f"Could not retrieve any student records for school_id: {school_id} using primary or fallback filters. Cannot calculate averages.")
+            app.logger.error("Could not retrieve any student records for school_id: %s using primary or fallback filters. Cannot calculate averages.", school_id)
             return None
-        app.logger.info(f"Retrieved {len(all_student_records_for_school)} student records for school_id {school_id} using fallback filter (field_133_raw).")
+        app.logger.info("Retrieved %s student records for school_id %s using fallback filter (field_133_raw).", len(all_student_records_for_school), school_id)
     else:
-        app.logger.info(f"Retrieved {len(all_student_records_for_school)} student records for school_id {school_id} using primary filter (field_133).")
+        app.logger.info("Retrieved %s student records for school_id %s using primary filter (field_133).", len(all_student_records_for_school), school_id)
     
-    vespa_elements = {
-        "Vision": "field_147", "Effort": "field_148",
-        "Systems": "field_149", "Practice": "field_150",
-        "Attitude": "field_151", "Overall": "field_152",
-    }
-    sums = {key: 0 for key in vespa_elements}
-    counts = {key: 0 for key in vespa_elements}
-
-    # Now all_student_records_for_school is a flat list of student record dictionaries
-    for record in all_student_records_for_school:
-        # Ensure record is a dictionary before trying to .get() from it
-        if not isinstance(record, dict):
-            app.logger.warning(f"Skipping an item in all_student_records_for_school because it is not a dictionary: {type(record)} - Content: {str(record)[:100]}...")
-            continue
-            
-        for element_name, field_key in vespa_elements.items():
-            score_value = record.get(field_key)
-            if score_value is not None:
-                try:
-                    score = float(score_value)
-                    sums[element_name] += score
-                    counts[element_name] += 1
-                except (ValueError, TypeError):
-                    app.logger.debug(f"Could not convert score '{score_value}' for {element_name} in record {record.get('id', 'N/A')} to float.")
-    
-    averages = {}
-    for element_name in vespa_elements:
-        if counts[element_name] > 0:
-            averages[element_name] = round(sums[element_name] / counts[element_name], 2)
-        else:
-            averages[element_name] = 0
+    # Drop malformed items once up front rather than re-checking per element
+    student_records = [record for record in all_student_records_for_school if isinstance(record, dict)]
+    skipped_count = len(all_student_records_for_school) - len(student_records)
+    if skipped_count:
+        app.logger.warning("Skipped %s items in all_student_records_for_school because they were not dictionaries.", skipped_count)
+
+    averages = calculate_school_vespa_averages(student_records)
     
-    app.logger.info(f"Calculated school VESPA averages for school_id {school_id}: {averages}")
+    app.logger.info("Calculated school VESPA averages for school_id %s: %s", school_id, averages)
     return averages
 
+# Qualification families in the order they are checked: (family pattern, ((sub-pattern, label), ...), default label).
+# Patterns are matched against the upper-cased input; the first family hit wins, then its first sub-pattern hit.
+_QUAL_TYPE_PATTERNS = (
+    (re.compile(r'A[ -]?LEVEL|A2'), (), "A Level"),
+    (re.compile(r'AS[ -]LEVEL'), (), "AS Level"),
+    (re.compile(r'IB HL|INTERNATIONAL BACCALAUREATE HL'), (), "IB HL"),
+    (re.compile(r'IB SL|INTERNATIONAL BACCALAUREATE SL'), (), "IB SL"),
+    (re.compile(r'BTEC'), (
+        (re.compile(r'EXTENDED DIPLOMA'), "BTEC Level 3 Extended Diploma"),
+        (re.compile(r'^(?!.*EXTENDED).*DIPLOMA', re.S), "BTEC Level 3 Diploma"),
+        (re.compile(r'SUBSIDIARY'), "BTEC Level 3 Subsidiary Diploma"),
+        (re.compile(r'CERTIFICATE'), "BTEC Level 3 Extended Certificate"),
+    ), "BTEC Level 3"),
+    (re.compile(r'PRE[- ]U'), (
+        (re.compile(r'SHORT'), "Pre-U Short Course"),
+    ), "Pre-U Principal Subject"),
+    (re.compile(r'UAL'), (
+        (re.compile(r'EXTENDED'), "UAL Level 3 Extended Diploma"),
+        (re.compile(r'DIPLOMA'), "UAL Level 3 Diploma"),
+    ), "UAL Level 3"),
+    (re.compile(r'CACHE'), (
+        (re.compile(r'EXTENDED'), "CACHE Level 3 Extended Diploma"),
+        (re.compile(r'DIPLOMA'), "CACHE Level 3 Diploma"),
+        (re.compile(r'CERTIFICATE'), "CACHE Level 3 Certificate"),
+        (re.compile(r'AWARD'), "CACHE Level 3 Award"),
+    ), "CACHE Level 3"),
+)
+
+# One alternation over every family pattern: strings that mention no known qualification (the raw
+# value is returned for those) are settled in a single scan instead of one search per family.
+_ANY_QUAL_FAMILY_RE = re.compile("|".join(f"(?:{family_re.pattern})" for family_re, _, _ in _QUAL_TYPE_PATTERNS))
+
 def normalize_qualification_type(exam_type_str):
     """Normalize qualification type strings to standard format."""
     if not exam_type_str:
         return "Unknown"
     
-    exam_type_str = str(exam_type_str).strip()
-    
-    # A-Level variations
-    if any(x in exam_type_str.upper() for x in ['A LEVEL', 'A-LEVEL', 'A2', 'ALEVEL']):
-        return "A Level"
-    
-    # AS Level
-    if 'AS LEVEL' in exam_type_str.upper() or 'AS-LEVEL' in exam_type_str.upper():
-        return "AS Level"
-    
-    # IB
-    if 'IB HL' in exam_type_str.upper() or 'INTERNATIONAL BACCALAUREATE HL' in exam_type_str.upper():
-        return "IB HL"
-    if 'IB SL' in exam_type_str.upper() or 'INTERNATIONAL BACCALAUREATE SL' in exam_type_str.upper():
-        return "IB SL"
-    
-    # BTEC
-    if 'BTEC' in exam_type_str.upper():
-        if 'EXTENDED DIPLOMA' in exam_type_str.upper():
-            return "BTEC Level 3 Extended Diploma"
-        elif 'DIPLOMA' in exam_type_str.upper() and 'EXTENDED' not in exam_type_str.upper():
-            return "BTEC Level 3 Diploma"
-        elif 'SUBSIDIARY' in exam_type_str.upper():
-            return "BTEC Level 3 Subsidiary Diploma"
-        elif 'CERTIFICATE' in exam_type_str.upper():
-            return "BTEC Level 3 Extended Certificate"
-        else:
-            return "BTEC Level 3"
-    
-    # Pre-U
-    if 'PRE-U' in exam_type_str.upper() or 'PRE U' in exam_type_str.upper():
-        if 'SHORT' in exam_type_str.upper():
-            return "Pre-U Short Course"
-        else:
-            return "Pre-U Principal Subject"
-    
-    # UAL
-    if 'UAL' in exam_type_str.upper():
-        if 'EXTENDED' in exam_type_str.upper():
-            return "UAL Level 3 Extended Diploma"
-        elif 'DIPLOMA' in exam_type_str.upper():
-            return "UAL Level 3 Diploma"
-        else:
-            return "UAL Level 3"
-    
-    # CACHE
-    if 'CACHE' in exam_type_str.upper():
-        if 'EXTENDED' in exam_type_str.upper():
-            return "CACHE Level 3 Extended Diploma"
-        elif 'DIPLOMA' in exam_type_str.upper():
-            return "CACHE Level 3 Diploma"
-        elif 'CERTIFICATE' in exam_type_str.upper():
-            return "CACHE Level 3 Certificate"
-        elif 'AWARD' in exam_type_str.upper():
-            return "CACHE Level 3 Award"
-        else:
-            return "CACHE Level 3"
+    if not isinstance(exam_type_str, str): # Knack text fields are already str; only coerce the odd number
+        exam_type_str = str(exam_type_str)
+    exam_type_str = exam_type_str.strip()
+    if exam_type_str in CANONICAL_QUAL_TYPES: # Most records already hold the canonical label, e.g. "A Level"
+        return exam_type_str
+    return _normalize_qualification_label(exam_type_str)
+
+@lru_cache(maxsize=512)
+def _normalize_qualification_label(exam_type_str):
+    """Cached body of normalize_qualification_type; takes an already stripped str.
+    Only a handful of distinct qualification strings occur, so repeat lookups from
+    the points/MEG loops become a dict hit."""
+    upper_type = exam_type_str.upper()
+    if not _ANY_QUAL_FAMILY_RE.search(upper_type):
+        return exam_type_str  # Return original if no match
+    # Family order decides ties (e.g. "A Level" before "BTEC"), so find the first family that matches
+    for family_re, sub_patterns, default_label in _QUAL_TYPE_PATTERNS:
+        if family_re.search(upper_type):
+            for sub_re, label in sub_patterns:
+                if sub_re.search(upper_type):
+                    return sys.intern(label)
+            return sys.intern(default_label)
     
     return exam_type_str  # Return original if no match
 
+# Labels the patterns map to themselves, so normalize_qualification_type can return them untouched.
+# Derived from _QUAL_TYPE_PATTERNS rather than listed by hand (e.g. "BTEC Level 3 Subsidiary Diploma" is not one).
+CANONICAL_QUAL_TYPES = frozenset(
+    label
+    for _, sub_patterns, default_label in _QUAL_TYPE_PATTERNS
+    for label in (default_label, *(sub_label for _, sub_label in sub_patterns))
+    if _normalize_qualification_label(label) == label
+)
+
+# Cleaned grades that score 0 in every table, so get_points can skip the lookup
+_ZERO_POINT_GRADES = frozenset({"", "N/A", "U"})
+
+# Spelled-out vocational grades -> the grade keys used in grade_to_points_mapping.json
+# (add other BTEC/vocational variations here if needed, e.g. D*D*, DD, MM)
+GRADE_ALIASES = {"DIST*": "D*", "DIST": "D", "MERIT": "M", "PASS": "P"}
+
+# A-Level points used if grade_to_points_mapping.json has no "A Level" table
+A_LEVEL_POINTS_FALLBACK = {'A*': 56, 'A': 48, 'B': 40, 'C': 32, 'D': 24, 'E': 16, 'U': 0}
+
+def build_points_lookup(mapping_kb):
+    """Flattens the grade points KB into {(qualification, GRADE): int points} once at import.
+
+    Grade aliases (e.g. "DIST*" for "D*") are expanded here so get_points needs a single
+    dict probe. An unloaded KB yields an empty table, i.e. every grade scores 0.
+    """
+    lookup = {}
+    if not mapping_kb or not isinstance(mapping_kb, dict):
+        return lookup
+    tables = {}
+    for qual, grade_map in mapping_kb.items():
+        if not isinstance(grade_map, dict):
+            continue
+        qual_points = {}
+        for grade, points in grade_map.items():
+            try:
+                qual_points[str(grade).strip().upper()] = int(points)
+            except (ValueError, TypeError):
+                app.logger.warning("build_points_lookup: Skipping non-numeric points '%s' for grade '%s' in '%s'.", points, grade, qual)
+        tables[qual] = qual_points
+    if not tables.get("A Level"):
+        tables["A Level"] = dict(A_LEVEL_POINTS_FALLBACK)
+
+    for qual, qual_points in tables.items():
+        # Handle common variations like "Dist*" vs "D*" where the table has no entry of its own
+        for alias, grade in GRADE_ALIASES.items():
+            if alias not in qual_points and grade in qual_points:
+                qual_points[alias] = qual_points[grade]
+        for grade, points in qual_points.items():
+            # Interned to match the labels normalize_qualification_type returns, so probes hit on identity
+            lookup[(sys.intern(qual), sys.intern(grade))] = points
+    return lookup
+
+POINTS_LOOKUP = build_points_lookup(grade_points_mapping_kb)
+
 def get_points(grade, qualification_type):
     """Convert grade to UCAS points based on qualification type."""
-    if not grade or grade == "N/A": # Removed check for grade_points_mapping_kb here, will check inside
-        app.logger.warning(f"get_points: Invalid input - grade: {grade}, qual_type: {qualification_type}")
+    if not grade or grade == "N/A":
+        app.logger.warning("get_points: Invalid input - grade: %s, qual_type: %s", grade, qualification_type)
         return 0
     
-    grade_cleaned = str(grade).strip().upper()
-    normalized_qual = normalize_qualification_type(qualification_type)
-    # app.logger.debug(f"get_points: Looking for grade '{grade_cleaned}' in qual '{normalized_qual}'")
-
-    if not grade_points_mapping_kb:
-        app.logger.error("get_points: grade_points_mapping_kb is not loaded.")
+    grade_cleaned = (grade if isinstance(grade, str) else str(grade)).strip().upper()
+    if grade_cleaned in _ZERO_POINT_GRADES:
         return 0
-
-    qual_specific_map = grade_points_mapping_kb.get(normalized_qual)
-    
-    if not qual_specific_map:
-        # app.logger.warning(f"get_points: No grade point mapping found for qualification type: '{normalized_qual}'. Attempting A-Level fallback if applicable.")
-        if normalized_qual == "A Level": # A-Level specific fallback if not in main map
-            grade_to_points_fallback = {
-                'A*': 56, 'A': 48, 'B': 40, 'C': 32, 'D': 24, 'E': 16, 'U': 0
-            }
-            points = grade_to_points_fallback.get(grade_cleaned)
-            if points is not None:
-                # app.logger.info(f"get_points: Used A-Level fallback for grade '{grade_cleaned}', points: {points}")
-                return points
+    return POINTS_LOOKUP.get((normalize_qualification_type(qualification_type), grade_cleaned), 0)
+
+# Key spellings seen across ALPS band KBs, in priority order (similar to tutor app)
+ALPS_MIN_KEYS = ("gcseMinScore", "gcseMin", "Avg GCSE score Min", "Prior Attainment Min", "lowerBound")
+ALPS_MAX_KEYS = ("gcseMaxScore", "gcseMax", "Avg GCSE score Max", "Prior Attainment Max", "upperBound")
+ALPS_MEG_KEYS = ("megAspiration", "MEG Aspiration", "minimumGrade", "megGrade", "MEG")
+
+def _resolve_alps_band_keys(band_info):
+    """(min_key, max_key, meg_key) actually used by a band; None where no known spelling is present."""
+    return tuple(
+        next((key for key in possible_keys if key in band_info), None)
+        for possible_keys in (ALPS_MIN_KEYS, ALPS_MAX_KEYS, ALPS_MEG_KEYS)
+    )
+
+def compile_alps_table(raw_bands, qualification_type):
+    """Resolves an ALPS band list once into (min, max, meg_grade, max_is_exclusive, meg_points) tuples,
+    with MEG points looked up for qualification_type.
+
+    Bands are [min, max) when a max is given, otherwise [min, inf). When the bands are
+    disjoint they are also sorted by min so lookups can bisect; otherwise "mins" is None
+    and find_alps_band scans them in KB order. Returns None for a missing/empty table.
+    """
+    if not raw_bands or not isinstance(raw_bands, list):
+        return None
+    bands = []
+    malformed_bands = []
+    band_key_layouts = {} # frozenset of a band's keys -> resolved keys; a table normally has one layout
+    for band_info in raw_bands: # raw_bands is a list of dicts
+        if not isinstance(band_info, dict):
+            continue
+        layout = frozenset(band_info)
+        band_keys = band_key_layouts.get(layout)
+        if band_keys is None:
+            band_keys = band_key_layouts[layout] = _resolve_alps_band_keys(band_info)
+        min_key, max_key, meg_key = band_keys
+
+        min_score_val = band_info[min_key] if min_key is not None else None
+        if min_score_val is None:
+            continue
+        max_score_val = band_info[max_key] if max_key is not None else None
+        try:
+            min_s = min_score_val if type(min_score_val) is float else float(min_score_val)
+            if max_score_val is None:
+                max_s = float('inf')
             else:
-                # app.logger.warning(f"get_points: A-Level fallback also failed for grade '{grade_cleaned}'. Available fallback grades: {list(grade_to_points_fallback.keys())}")
-                pass # Fall through to return 0 at the end
-        # app.logger.warning(f"get_points: No mapping for '{normalized_qual}' and not an A-Level fallback case. Returning 0.")
-        return 0
-
-    points = qual_specific_map.get(grade_cleaned)
-    
-    # Handle common variations like "Dist*" vs "D*"
-    if points is None:
-        if grade_cleaned == "DIST*": points = qual_specific_map.get("D*")
-        elif grade_cleaned == "DIST": points = qual_specific_map.get("D")
-        elif grade_cleaned == "MERIT": points = qual_specific_map.get("M")
-        elif grade_cleaned == "PASS": points = qual_specific_map.get("P")
-        # Add other BTEC/vocational grade variations if necessary, e.g. D*D*, DD, MM etc.
-        # For example, if grade_cleaned is "D*D*" and qual_specific_map has "D*D*", it will be found.
-
-    if points is not None:
-        # app.logger.debug(f"get_points: Found points: {points} for grade '{grade_cleaned}' in '{normalized_qual}'.")
-        return int(points)
-    else:
-        # app.logger.warning(f"get_points: No points found for grade '{grade_cleaned}' (original: '{grade}') in qualification '{normalized_qual}'. Available grades in map: {list(qual_specific_map.keys()) if qual_specific_map else 'N/A'}. Returning 0 points.")
-        pass # Added pass to satisfy indentation for the else block
-    return 0
+                max_s = max_score_val if type(max_score_val) is float else float(max_score_val)
+        except (ValueError, TypeError) as e_conv:
+            malformed_bands.append((band_info, e_conv))
+            continue
+        meg_grade = band_info[meg_key] if meg_key is not None else "N/A"
+        bands.append((min_s, max_s, meg_grade, max_score_val is not None, get_points(meg_grade, qualification_type)))
+
+    if malformed_bands:
+        first_band, first_error = malformed_bands[0]
+        app.logger.warning("compile_alps_table: Dropped %s band(s) with non-numeric scores, e.g. %s (%s).", len(malformed_bands), first_band, first_error)
+
+    sorted_bands = sorted(bands, key=lambda band: band[0])
+    disjoint = all(
+        lower[3] and lower[1] <= upper[0]
+        for lower, upper in zip(sorted_bands, sorted_bands[1:])
+    )
+    if disjoint:
+        return {"raw": raw_bands, "bands": sorted_bands, "mins": [band[0] for band in sorted_bands]}
+    return {"raw": raw_bands, "bands": bands, "mins": None}
+
+def _score_in_band(score, band):
+    min_s, max_s, _, max_is_exclusive, _ = band
+    return min_s <= score < max_s if max_is_exclusive else min_s <= score <= max_s
+
+def find_alps_band(compiled_table, score):
+    """Returns the band tuple containing score, or None."""
+    mins = compiled_table["mins"]
+    bands = compiled_table["bands"]
+    if mins is None: # Overlapping bands: first match in KB order wins
+        return next((band for band in bands if _score_in_band(score, band)), None)
+    idx = bisect_right(mins, score) - 1
+    if idx >= 0 and _score_in_band(score, bands[idx]):
+        return bands[idx]
+    return None
 
+@lru_cache(maxsize=4096) # Pure lookup against the static ALPS tables; repeated per subject and percentile
 def get_meg_for_prior_attainment(prior_attainment_score, qualification_type, percentile=75):
     """Get MEG based on prior attainment score and qualification type."""
     if prior_attainment_score is None:
-        app.logger.warning(f"get_meg_for_prior_attainment: prior_attainment_score is None for qual '{qualification_type}'.")
+        app.logger.warning("get_meg_for_prior_attainment: prior_attainment_score is None for qual '%s'.", qualification_type)
         return "N/A", 0
 
     try:
         score = float(prior_attainment_score)
     except (ValueError, TypeError):
-        app.logger.warning(f"get_meg_for_prior_attainment: Could not convert prior_attainment_score '{prior_attainment_score}' to float.")
+        app.logger.warning("get_meg_for_prior_attainment: Could not convert prior_attainment_score '%s' to float.", prior_attainment_score)
         return "N/A", 0
     
     normalized_qual = normalize_qualification_type(qualification_type)
@@ -616,21 +1090,21 @@ def get_meg_for_prior_attainment(prior_attainment_score, qualification_type, per
     benchmark_table_data = None
     if normalized_qual == "A Level":
         if percentile == 60:
-            benchmark_table_data = alps_bands_aLevel_60_kb
+            benchmark_table_data = ALPS_A_LEVEL_TABLES[60]
         elif percentile == 75:
-            benchmark_table_data = alps_bands_aLevel_75_kb
+            benchmark_table_data = ALPS_A_LEVEL_TABLES[75]
         elif percentile == 90:
-            benchmark_table_data = alps_bands_aLevel_90_kb
+            benchmark_table_data = ALPS_A_LEVEL_TABLES[90]
         elif percentile == 100:
-            benchmark_table_data = alps_bands_aLevel_100_kb
+            benchmark_table_data = ALPS_A_LEVEL_TABLES[100]
         else:
-            app.logger.warning(f"get_meg_for_prior_attainment: Unsupported percentile '{percentile}' for A-Level. Defaulting to 75th.")
-            benchmark_table_data = alps_bands_aLevel_75_kb
+            app.logger.warning("get_meg_for_prior_attainment: Unsupported percentile '%s' for A-Level. Defaulting to 75th.", percentile)
+            benchmark_table_data = ALPS_A_LEVEL_TABLES[75]
     # Add logic for other qualification types here if they have specific percentile tables
     # For now, if not A-Level, benchmark_table_data remains None and will hit the next check.
 
     if not benchmark_table_data:
-        app.logger.warning(f"get_meg_for_prior_attainment: No ALPS benchmark table data loaded or selected for qual '{normalized_qual}', percentile '{percentile}'.")
+        app.logger.warning("get_meg_for_prior_attainment: No ALPS benchmark table data loaded or selected for qual '%s', percentile '%s'.", normalized_qual, percentile)
         # Consider a more generic fallback or error handling if needed for non-A-Level quals
         # For now, this will lead to returning "N/A", 0 if no table is found.
         # If other qual types (BTEC, IB etc.) should use a default table (e.g. alps_bands_aLevel_75_kb as a proxy)
@@ -641,68 +1115,23 @@ def get_meg_for_prior_attainment(prior_attainment_score, qualification_type, per
         # For now, if not A-Level or table is missing, it will proceed to the loop (which won't run if benchmark_table_data is None)
         # and then hit the final fallback.
         if normalized_qual != "A Level":
-             app.logger.info(f"get_meg_for_prior_attainment: No specific ALPS percentile table logic for '{normalized_qual}'. Will use general fallback if score not in bands.")
+             app.logger.info("get_meg_for_prior_attainment: No specific ALPS percentile table logic for '%s'. Will use general fallback if score not in bands.", normalized_qual)
              # Attempt to use a default like A-Level 75th for non-A-Levels if a generic lookup is desired.
              # This depends on the expectation for non-A-Level MEGs.
              # For now, it will pass through and use the final fallback if the loop doesn't match.
 
     if benchmark_table_data: # Only proceed if a table was selected/loaded
-        for band_info in benchmark_table_data: # benchmark_table_data is a list of dicts
-            min_score_val = None
-            max_score_val = None
-            # More robust key checking, similar to tutor app
-            possible_min_keys = ["gcseMinScore", "gcseMin", "Avg GCSE score Min", "Prior Attainment Min", "lowerBound"]
-            possible_max_keys = ["gcseMaxScore", "gcseMax", "Avg GCSE score Max", "Prior Attainment Max", "upperBound"]
-            possible_meg_keys = ["megAspiration", "MEG Aspiration", "minimumGrade", "megGrade", "MEG"]
-
-            for key in possible_min_keys:
-                if key in band_info:
-                    min_score_val = band_info[key]
-                    break
-            for key in possible_max_keys:
-                if key in band_info:
-                    max_score_val = band_info[key]
-                    break
-            
-            meg_aspiration_grade = "N/A"
-            for key in possible_meg_keys:
-                if key in band_info:
-                    meg_aspiration_grade = band_info[key]
-                    break
-            
-            if min_score_val is not None:
-                try:
-                    min_s = float(min_score_val)
-                    # Determine max_s for range check. Assume inclusive max if only min_s is defined (point score)
-                    # or exclusive max if max_score_val is present (range).
-                    # This needs to align with how ALPS defines their bands.
-                    # Common ALPS tables are [min_score, max_score) - min inclusive, max exclusive
-                    max_s_is_exclusive_upper_bound = max_score_val is not None
-                    max_s = float(max_score_val) if max_score_val is not None else float('inf')
-                    
-                    in_band = False
-                    if max_s_is_exclusive_upper_bound:
-                        if score >= min_s and score < max_s:
-                            in_band = True
-                    else: # If max_score_val is not typical, could be point-based or inclusive upper
-                        if score >= min_s and (max_score_val is None or score <= max_s): # Default to inclusive if max_s logic unsure
-                             in_band = True
-
-                    if in_band:
-                        meg_points_val = get_points(meg_aspiration_grade, normalized_qual)
-                        # app.logger.info(f"get_meg_for_prior_attainment: Found band for score {score}. MEG Grade: {meg_aspiration_grade}, Points: {meg_points_val}")
-                        return meg_aspiration_grade, meg_points_val if meg_points_val is not None else 0
-                except (ValueError, TypeError) as e_conv:
-                    app.logger.warning(f"get_meg_for_prior_attainment: Error converting band scores for band {band_info}: {e_conv}")
-                    continue
-        app.logger.warning(f"get_meg_for_prior_attainment: Score {score} not in any band of the selected table for qual '{normalized_qual}', percentile '{percentile}'. Table (first 200 chars): {str(benchmark_table_data)[:200]}...")
+        band = find_alps_band(benchmark_table_data, score)
+        if band:
+            return band[2], band[4] # MEG grade and its points, resolved when the table was compiled
+        app.logger.warning("get_meg_for_prior_attainment: Score %s not in any band of the selected table for qual '%s', percentile '%s'. Table (first 200 chars): %.200s...", score, normalized_qual, percentile, benchmark_table_data['raw'])
     else: # If benchmark_table_data was None (e.g. missing KB or non-Alevel without specific table)
-        app.logger.warning(f"get_meg_for_prior_attainment: No benchmark_table_data to process for qual '{normalized_qual}', percentile '{percentile}'.")
+        app.logger.warning("get_meg_for_prior_attainment: No benchmark_table_data to process for qual '%s', percentile '%s'.", normalized_qual, percentile)
 
     # Fallback if score not in any band or no table was processed
     default_grade_fallback = "N/A" 
     default_points_fallback = 0 # get_points for "N/A" should yield 0 with the updated get_points
-    app.logger.warning(f"get_meg_for_prior_attainment: Using fallback MEG '{default_grade_fallback}' ({default_points_fallback} pts) for PA {score}, Qual '{normalized_qual}', Pctl '{percentile}'.")
+    app.logger.warning("get_meg_for_prior_attainment: Using fallback MEG '%s' (%s pts) for PA %s, Qual '%s', Pctl '%s'.", default_grade_fallback, default_points_fallback, score, normalized_qual, percentile)
     return default_grade_fallback, default_points_fallback
 
 # Load additional ALPS KBs if available
@@ -710,7 +1139,319 @@ alps_bands_aLevel_60_kb = load_json_file('alpsBands_aLevel_60.json')
 alps_bands_aLevel_90_kb = load_json_file('alpsBands_aLevel_90.json')
 alps_bands_aLevel_100_kb = load_json_file('alpsBands_aLevel_100.json')
 
+# Band key resolution and float parsing done once here instead of on every MEG lookup
+ALPS_A_LEVEL_TABLES = {
+    60: compile_alps_table(alps_bands_aLevel_60_kb, "A Level"),
+    75: compile_alps_table(alps_bands_aLevel_75_kb, "A Level"),
+    90: compile_alps_table(alps_bands_aLevel_90_kb, "A Level"),
+    100: compile_alps_table(alps_bands_aLevel_100_kb, "A Level"),
+}
+
 # --- LLM Integration for Student Insights (adapted from tutorapp.py) ---
+# The insights system message is identical for every student: framing, tasks and the JSON output spec.
+# Keeping it byte-for-byte stable and first in the request lets OpenAI's automatic prompt caching reuse
+# it; everything student-specific (name, data, RRC/goal) goes in the user message after it.
+_INSIGHTS_PROMPT_TASKS = "\n".join([
+    "--- Coach, please help me with these things: ---",
+    "Based ONLY on the data in my message, please provide the following insights FOR ME.",
+    "Your tone should be encouraging, supportive, and help me understand myself better. Give me practical, actionable advice. Subtly draw upon general coaching principles and insights related to mindset, goal-setting, self-reflection, and VESPA elements when formulating your responses, especially for the questionnaire analysis and overview. Frame suggestions as reflective points for me.",
+    "Please format your entire response as a single JSON object with the following EXACT keys: \"student_overview_summary\", \"chart_comparative_insights\", \"questionnaire_interpretation_and_reflection_summary\", \"academic_benchmark_analysis\", \"suggested_student_goals\", \"academic_quote\", \"academic_performance_ai_summary\".",
+    "Ensure all string values within the JSON are properly escaped.",
+])
+
+_INSIGHTS_PROMPT_OUTPUT_SPEC = "\n".join([
+    "\n\n--- REQUIRED OUTPUT STRUCTURE (JSON Object) ---",
+    "Please provide your response as a single, valid JSON object. Example:",
+    "'''",
+    "{",
+    "  \"student_overview_summary\": \"A concise 2-3 sentence AI Student Snapshot for me, highlighting 1-2 of my key strengths and 1-2 primary areas for development, rooted in VESPA principles and drawing from general coaching themes. Max 100-120 words. Speak directly to me (e.g., 'Your data shows...', 'You could focus on...').\",",
+    "  \"chart_comparative_insights\": \"A short paragraph (max 100 words) helping me understand my VESPA scores compared to the school averages (if provided). What could these differences or similarities mean for me? If a score is significantly different, suggest a brief reflective question for me based on general coaching principles related to that VESPA element (e.g., if 'Systems' is low, 'What's one small organizational change you could try?'). Use 'you' and 'your'.\",",
+    "  \"questionnaire_interpretation_and_reflection_summary\": \"A concise summary (approx. 150-200 words) interpreting my overall questionnaire responses (e.g., my tendencies towards 'Strongly Disagree' or 'Strongly Agree', as indicated by the counts of 1s, 2s, etc.). Highlight any notable patterns, such as a concentration of low or high responses in specific VESPA elements (refer to my Top/Bottom scoring statements). Subtly connect these patterns to general coaching insights about mindset, self-reflection, or goal-setting (e.g., if responses suggest a fixed mindset, gently introduce the idea of growth without being preachy). Also, briefly compare and contrast these questionnaire insights with my own RRC/Goal comments (My RRC and My Goal, repeated at the end of my message), noting any consistencies or discrepancies that could be valuable for me to reflect on. Use 'you' and 'your'.\",",
+    "  \"academic_benchmark_analysis\": \"A supportive and encouraging analysis (approx. 150-180 words) of my academic performance. Start by looking at my current grades in relation to my Subject Target Grades and my Standard Expected Grades (MEGs). Explain that MEGs show what students with similar prior GCSE scores typically achieve (top 25%) and are aspirational. Explain that my Subject Target Grade (STG) is a more nuanced target that considers subject difficulty. Emphasize that comparing my current grades, MEGs, and STGs should help me think about my progress, strengths, and potential next steps. The goal is to use this information to identify areas for support or challenge, always considering my broader context. Use 'you' and 'your'.\",",
+    "  \"suggested_student_goals\": [\"Based on the analysis, and inspired by general reflective statements and coaching principles (e.g., focusing on an area for development from the questionnaire or VESPA profile), suggest 2-3 S.M.A.R.T. goals FOR ME, reframed to my context. Make them actionable and specific.\", \"Goal 2...\"],",
+    "  \"academic_quote\": \"A short, inspirational or funny quote suitable for a student. e.g., 'The expert in anything was once a beginner.' or 'Why fall in love when you can fall asleep?'\",",
+    "  \"academic_performance_ai_summary\": \"A kind, encouraging, and professional AI summary (like a helpful teacher, approx. 200-250 words) analyzing my academic profile. Discuss my subject benchmarks in relation to my MEGs. If I'm not meeting MEGs, be gentle and positive, focusing on growth and understanding. Highlight strengths and areas for development based on my subject performance. The tone should be positive and empowering, even when pointing out challenges. Reference the MEG explainer text that I will see, which describes MEGs as aspirational and STGs as more personalized. Use 'you' and 'your'.\"",
+    "}",
+    "'''",
+])
+
+_INSIGHTS_SYSTEM_PROMPT = "\n\n".join([
+    "You are My VESPA AI Coach, an AI assistant designed to help students understand their VESPA profile (Vision, Effort, Systems, Practice, Attitude) "
+    "and academic performance. Your responses should be encouraging, supportive, and provide clear, actionable advice directly to the student using 'you' and 'your'. "
+    "Help them reflect on their data and identify steps for improvement. Your output MUST be a single JSON object with specific keys.",
+    _INSIGHTS_PROMPT_TASKS,
+    _INSIGHTS_PROMPT_OUTPUT_SPEC.lstrip("\n"),
+])
+
+# Very common words dropped from student keywords before matching coaching insights
+INSIGHT_KEYWORD_STOPWORDS = frozenset({"i", "me", "my", "is", "a", "the", "and", "to", "of", "it", "in", "for", "on", "with", "as", "an", "at", "by", "you", "your", "what", "how", "help", "can", "some", "this", "that", "area", "areas", "score", "scores"})
+
+# Newlines flattened and quotes backslash-escaped in one pass for the quoted RRC/Goal at the end of the prompt
+_PROMPT_QUOTE_ESCAPES = str.maketrans({'\n': ' ', "'": "\\'", '"': '\\"'})
+
+# The response distribution lines differ between students only in the five counts
+_RESPONSE_DISTRIBUTION_PROMPT = "\n".join([
+    "  - Statements I rated '1' (e.g., Strongly Disagree): {}",
+    "  - Statements I rated '2': {}",
+    "  - Statements I rated '3': {}",
+    "  - Statements I rated '4': {}",
+    "  - Statements I rated '5' (e.g., Strongly Agree): {}",
+])
+
+def build_student_insights_prompt(student_data_dict, app_logger_instance):
+    """Builds the (system message, user prompt) pair for a student's insights request.
+    The system message is the shared static _INSIGHTS_SYSTEM_PROMPT; the user prompt holds the student's data.
+    Pure CPU work with no I/O, kept apart from the OpenAI call."""
+    student_name = student_data_dict.get('student_name', 'Student')
+    student_level = student_data_dict.get('student_level', 'N/A') 
+    current_cycle = student_data_dict.get('current_cycle', 'N/A')
+    school_averages = student_data_dict.get('school_vespa_averages') 
+    vespa_profile_for_rag = student_data_dict.get('vespa_profile', {}) 
+    all_scored_questionnaire_statements = student_data_dict.get('all_scored_questionnaire_statements', [])
+
+    prompt_parts = []
+    prompt_parts.append(f"You are My VESPA AI Coach. I am '{student_name}'. This is my data:")
+    prompt_parts.append(f"Current Cycle: {current_cycle}.")
+
+    prompt_parts.append("\n--- My Current VESPA Profile (Vision, Effort, Systems, Practice, Attitude) ---")
+    if student_data_dict.get('vespa_profile'):
+        prompt_parts.extend(
+            f"- {element}: My score is {details.get('score_1_to_10', 'N/A')}/10, which is considered '{details.get('score_profile_text', 'N/A')}'."
+            for element, details in student_data_dict['vespa_profile'].items() if element != "Overall"
+        )
+
+    if school_averages:
+        prompt_parts.append("\n--- School's Average VESPA Scores (For Comparison) ---")
+        prompt_parts.extend(f"- {element} (School Avg): {avg_score}/10" for element, avg_score in school_averages.items())
+    
+    prompt_parts.append("\n--- My Academic Profile (First 3 Subjects with My Standard Expected Grade) ---")
+    if student_data_dict.get('academic_profile_summary'):
+        profile_data = student_data_dict['academic_profile_summary']
+        valid_subjects_shown = 0
+        if isinstance(profile_data, list) and profile_data and \
+           not (profile_data[0].get('subject','').startswith("Academic profile not found")) and \
+           not (profile_data[0].get('subject','').startswith("No academic subjects parsed")):
+            for subject_info in profile_data[:3]:
+                if subject_info.get('subject') and subject_info.get('subject') != "N/A":
+                    meg_text = f", My Standard Expected Grade (MEG): {subject_info.get('standard_meg', 'N/A')}" if subject_info.get('standard_meg') else ""
+                    prompt_parts.append(f"- Subject: {subject_info.get('subject')}, My Current Grade: {subject_info.get('currentGrade', 'N/A')}, My Target: {subject_info.get('targetGrade', 'N/A')}{meg_text}")
+                    valid_subjects_shown += 1
+            if valid_subjects_shown == 0:
+                prompt_parts.append("  It looks like my detailed subject information isn't available right now.")        
+        else:
+            prompt_parts.append("  My detailed academic profile summary isn't available at the moment.")
+    
+    if student_data_dict.get('academic_megs'):
+        meg_data = student_data_dict['academic_megs']
+        prompt_parts.append("\n--- My Academic Benchmarks (Based on My Prior Attainment) ---")
+        prompt_parts.append(f"  My GCSE Prior Attainment Score: {meg_data.get('prior_attainment_score', 'N/A')}")
+        if meg_data.get('aLevel_meg_grade_75th') and meg_data.get('aLevel_meg_grade_75th') != "N/A":
+             prompt_parts.append(f"  For A-Levels, students with similar prior scores typically achieve around a grade '{meg_data.get('aLevel_meg_grade_75th')}' (this is the standard MEG or top 25% benchmark).")
+
+    prompt_parts.append("\n--- My Reflections & Goals (Current Cycle) ---")
+    reflections_goals_found_student = False
+    current_rrc_text_student = "Not specified"
+    current_goal_text_student = "Not specified"
+    if student_data_dict.get('student_reflections_and_goals'):
+        reflections = student_data_dict['student_reflections_and_goals']
+        current_rrc_key_student = f"rrc{current_cycle}_comment"
+        current_goal_key_student = f"goal{current_cycle}"
+        rrc_val = reflections.get(current_rrc_key_student)
+        goal_val = reflections.get(current_goal_key_student)
+
+        if rrc_val and rrc_val != "Not specified":
+            current_rrc_text_student = str(rrc_val)[:300].replace('\n', ' ')
+            prompt_parts.append(f"- My Current Reflection (RRC{current_cycle}): {current_rrc_text_student}...")
+            reflections_goals_found_student = True
+        if goal_val and goal_val != "Not specified":
+            current_goal_text_student = str(goal_val)[:300].replace('\n', ' ')
+            prompt_parts.append(f"- My Current Goal (Goal {current_cycle}): {current_goal_text_student}...")
+            reflections_goals_found_student = True
+    if not reflections_goals_found_student:
+        prompt_parts.append("  I haven't specified any reflections or goals for the current cycle, or they are not available.")
+
+    prompt_parts.append("\n--- My Key Questionnaire Insights (My Top & Bottom Scoring Statements) ---")
+    obj29_highlights = student_data_dict.get("object29_question_highlights")
+    if obj29_highlights:
+        if obj29_highlights.get("top_3") and obj29_highlights["top_3"]:
+            prompt_parts.append("  Statements I Most Agreed With (1-5 scale, 5=Strongly Agree):")
+            prompt_parts.extend(
+                f"    - Score {q_data.get('score', 'N/A')}/5 ({q_data.get('category', 'N/A')}): \"{q_data.get('text', 'N/A')}\""
+                for q_data in obj29_highlights["top_3"]
+            )
+        if obj29_highlights.get("bottom_3") and obj29_highlights["bottom_3"]:
+            prompt_parts.append("  Statements I Least Agreed With (Areas to think about):")
+            prompt_parts.extend(
+                f"    - Score {q_data['score']}/5 ({q_data['category']}): \"{q_data['text']}\""
+                for q_data in obj29_highlights["bottom_3"]
+            )
+    else:
+        prompt_parts.append("  My top/bottom questionnaire statement highlights are not available.")
+
+    # Overall Questionnaire Statement Response Distribution (Student view)
+    prompt_parts.append("\n--- My Overall Questionnaire Statement Response Distribution ---")
+    if all_scored_questionnaire_statements and isinstance(all_scored_questionnaire_statements, list):
+        response_counts = Counter(q_data.get("score") for q_data in all_scored_questionnaire_statements) # Missing ratings read as 0
+        prompt_parts.append(_RESPONSE_DISTRIBUTION_PROMPT.format(*(response_counts[rating] for rating in range(1, 6))))
+    else:
+        prompt_parts.append("  My detailed questionnaire response distribution data is not available.")
+
+    # The tasks and output structure are in the static system message (_INSIGHTS_SYSTEM_PROMPT)
+
+    # --- RAG Elements for student prompt (Simplified for now, can be expanded) ---
+    # This section is less about the tutor's KB and more about general advice based on lowest VESPA or similar
+    lowest_vespa_element_student = lowest_vespa_element(vespa_profile_for_rag)
+
+    if lowest_vespa_element_student:
+        prompt_parts.append("\n\n--- Some Ideas to Consider ---")
+        prompt_parts.append(f"My lowest VESPA score seems to be in '{lowest_vespa_element_student}'. Can you give me some general tips or reflective questions for this area, and perhaps suggest a simple, actionable goal related to it? You can use the general reflective statements and coaching insights from your knowledge base for inspiration.")
+        # We don't directly inject KB content into student prompt like we do for tutor, 
+        # but we ask the LLM to use its general knowledge inspired by such KBs.
+
+    # --- Knowledge Base Excerpts (Student View - less direct, more for LLM's internal inspiration) ---
+    # We won't show the student the raw KB excerpts like we did for the tutor.
+    # Instead, the prompt will guide the LLM to use this type of knowledge implicitly.
+    # Example: If coaching_kb and REFLECTIVE_STATEMENTS_DATA are globally available in this backend scope:
+    relevant_coaching_insights = []
+    if COACHING_INSIGHTS_DATA and isinstance(COACHING_INSIGHTS_DATA, list):
+        # Attempt to find a few relevant insights based on keywords or student's lowest VESPA.
+        # This is a simple keyword match; more advanced RAG could be used.
+        # Stream every candidate word straight into one filtered set (stopwords and short words dropped)
+        reflections_for_kw = student_data_dict.get('student_reflections_and_goals') or {}
+        highlight_statements = (obj29_highlights.get("top_3", []) + obj29_highlights.get("bottom_3", [])) if obj29_highlights else []
+        candidate_keywords = chain(
+            (student_name.lower(), lowest_vespa_element_student.lower() if lowest_vespa_element_student else ""),
+            reflections_for_kw.get(f"rrc{current_cycle}_comment", "").lower().split()[:10], # First 10 words
+            reflections_for_kw.get(f"goal{current_cycle}", "").lower().split()[:10],
+            *(q_data.get('text', '').lower().split()[:5] for q_data in highlight_statements), # First 5 words of each top/bottom statement
+        )
+        meaningful_keywords = {kw for kw in candidate_keywords if len(kw) > 3 and kw not in INSIGHT_KEYWORD_STOPWORDS}
+
+        # Insights whose text contains any of the student's meaningful keywords, in KB order
+        matched_insight_ids = set()
+        for m_kw in meaningful_keywords:
+            matched_insight_ids.update(coaching_insight_ids_for_keyword(m_kw))
+        relevant_coaching_insights = [COACHING_INSIGHT_PROMPT_LINES[insight_idx] for insight_idx in sorted(matched_insight_ids)[:3]] # Limit to 3 for brevity in prompt
+        
+    if relevant_coaching_insights:
+        prompt_parts.append("\n\n--- General Coaching Principles (For AI's Inspiration) ---")
+        prompt_parts.append("Remember to draw inspiration from general coaching principles. For example, here are a few themes from your knowledge base that might be relevant to consider when interpreting my data and suggesting reflections (do not quote these directly, but use the underlying ideas):")
+        prompt_parts.extend(relevant_coaching_insights)
+    
+    if coaching_kb: # This KB is 'coaching_questions_knowledge_base.json'
+        prompt_parts.append(f"\n(For the AI: You also have access to a coaching questions knowledge base. Use its principles to help formulate your advice and goal suggestions, aiming for reflective and empowering questions for me, '{student_name}'.)")
+    if REFLECTIVE_STATEMENTS_DATA:
+        prompt_parts.append("(For the AI: You also have access to a list of general reflective statements. These can inspire the tone and nature of the S.M.A.R.T. goals you suggest for me.)")
+
+
+    # Student-specific values the output spec refers to, kept at the tail of the user message
+    cleaned_rrc_placeholder_student = current_rrc_text_student[:100].translate(_PROMPT_QUOTE_ESCAPES)
+    cleaned_goal_placeholder_student = current_goal_text_student[:100].translate(_PROMPT_QUOTE_ESCAPES)
+    prompt_parts.append(f"\n\nYou are speaking to '{student_name}'. For the questionnaire_interpretation_and_reflection_summary, My RRC is: '{cleaned_rrc_placeholder_student}...' and My Goal is: '{cleaned_goal_placeholder_student}...'")
+
+    prompt_to_send = "\n".join(prompt_parts)
+
+    if app_logger_instance.isEnabledFor(logging.INFO): # Skip slicing the prompt when INFO is off
+        app_logger_instance.info("Generated Student LLM Prompt (first 500 chars): %.500s", prompt_to_send)
+        app_logger_instance.info("Generated Student LLM Prompt (last 500 chars): %s", prompt_to_send[-500:])
+        app_logger_instance.info("Total Student LLM Prompt length: %s characters", len(prompt_to_send))
+
+    return _INSIGHTS_SYSTEM_PROMPT, prompt_to_send
+
+# Reloading a student whose profile hasn't meaningfully changed builds an equivalent prompt, so complete
+# insights are reused for a week instead of paying another multi-second OpenAI call. Per process, keyed by
+# _student_profile_fingerprint. Entries are a few KB, so a couple of thousand covers several year groups.
+LLM_INSIGHTS_CACHE = TTLCache(maxsize=2048, ttl=7 * 24 * 3600)
+
+def _round_if_number(value, ndigits=1):
+    return round(value, ndigits) if isinstance(value, float) else value
+
+def _student_profile_fingerprint(student_data_dict):
+    """blake2b digest of the parts of the student data the insights prompt actually uses, or None if they
+    cannot be serialized. School averages and benchmarks are rounded so that small drifts (another student
+    in the school submitting a questionnaire) still hit the cache. The name and RRC/Goal text are included
+    verbatim so the narrative is never reused for a different student or different reflections."""
+    vespa_profile = student_data_dict.get('vespa_profile') or {}
+    academic_summary = student_data_dict.get('academic_profile_summary')
+    highlights = student_data_dict.get('object29_question_highlights') or {}
+    canonical_profile = {
+        "name": student_data_dict.get('student_name'),
+        "level": student_data_dict.get('student_level'),
+        "cycle": student_data_dict.get('current_cycle'),
+        "vespa": {element: _round_if_number(details.get('score_1_to_10')) for element, details in vespa_profile.items() if isinstance(details, dict)},
+        "school_averages": {element: _round_if_number(avg) for element, avg in (student_data_dict.get('school_vespa_averages') or {}).items()},
+        "subjects": [
+            [subject_info.get(key) for key in ('subject', 'currentGrade', 'targetGrade', 'standard_meg')]
+            for subject_info in academic_summary[:3] if isinstance(subject_info, dict)
+        ] if isinstance(academic_summary, list) else None,
+        "megs": {key: _round_if_number(value) for key, value in (student_data_dict.get('academic_megs') or {}).items()},
+        "reflections": student_data_dict.get('student_reflections_and_goals'),
+        "top_3": [(statement.get('text'), statement.get('score')) for statement in highlights.get('top_3') or []],
+        "bottom_3": [(statement.get('text'), statement.get('score')) for statement in highlights.get('bottom_3') or []],
+        "score_distribution": {str(score): count for score, count in Counter(
+            statement.get('score') for statement in student_data_dict.get('all_scored_questionnaire_statements') or []).items()},
+    }
+    try:
+        canonical_json = json.dumps(canonical_profile, sort_keys=True, default=str)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.blake2b(canonical_json.encode('utf-8'), digest_size=16).hexdigest()
+
+# Chat completion settings shared by the live call and the Batch API request lines.
+INSIGHTS_COMPLETION_SETTINGS = {
+    "model": "gpt-4o-mini", # Cheaper and faster than gpt-3.5-turbo, and caches the static system prefix automatically
+    "max_tokens": 1200, # Adjusted for potentially detailed student-facing JSON, increased slightly
+    "temperature": 0.65, # Slightly higher for more nuanced and less wooden student advice
+    "response_format": {"type": "json_object"} # Request JSON output
+}
+
+STUDENT_INSIGHT_KEYS = (
+    "student_overview_summary",
+    "chart_comparative_insights",
+    "questionnaire_interpretation_and_reflection_summary",
+    "academic_benchmark_analysis",
+    "suggested_student_goals",
+    "academic_quote",
+    "academic_performance_ai_summary"
+)
+
+def _log_insights_usage(usage, app_logger_instance):
+    "Logs token usage, including how much of the prompt OpenAI served from its prompt cache."
+    if usage is None:
+        return
+    prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(prompt_tokens_details, "cached_tokens", None) or 0
+    app_logger_instance.info("Student LLM usage: %s prompt tokens (%s cached), %s completion tokens.",
+                             usage.prompt_tokens, cached_tokens, usage.completion_tokens)
+
+# Error insights built once; the error paths hand out copies
+_MISSING_INSIGHT_MESSAGES = {key: f"Error: AI response for '{key}' was not provided." for key in STUDENT_INSIGHT_KEYS}
+_PARSE_ERROR_INSIGHTS = {key: f"Error parsing AI response for {key}." for key in STUDENT_INSIGHT_KEYS}
+_PARSE_ERROR_AFTER_RETRIES_INSIGHTS = {key: f"Error parsing AI response for {key} after multiple attempts." for key in STUDENT_INSIGHT_KEYS}
+_BATCH_REQUEST_FAILED_INSIGHTS = {key: f"Error generating insights from AI for {key}. (Batch request failed.)" for key in STUDENT_INSIGHT_KEYS}
+_CRITICAL_ERROR_INSIGHTS = dict.fromkeys(STUDENT_INSIGHT_KEYS, "Critical error: AI processing failed after all retries.")
+_UNEXPECTED_ERROR_INSIGHTS = {
+    "student_overview_summary": "An unexpected error occurred while generating AI insights.",
+    "chart_comparative_insights": "Insights unavailable due to an error.",
+    "questionnaire_interpretation_and_reflection_summary": "Questionnaire interpretation unavailable due to an error.",
+    "academic_benchmark_analysis": "Academic benchmark analysis unavailable due to an error.",
+    "suggested_student_goals": ["Goal suggestions unavailable due to an error."],
+    "academic_quote": "Quote unavailable due to an error.",
+    "academic_performance_ai_summary": "Personalized academic summary unavailable due to an error."
+}
+
+def _api_error_insights(error):
+    "Insights for every key explaining that the OpenAI call failed with error."
+    error_details = str(error)[:50]
+    return {key: f"Error generating insights from AI for {key}. (Details: {error_details}...)" for key in STUDENT_INSIGHT_KEYS}
+
+def _fill_missing_insight_keys(parsed_llm_outputs):
+    """Fills any expected insight key the LLM left out with an error message. Returns True if none were missing."""
+    missing_keys = [key for key in STUDENT_INSIGHT_KEYS if key not in parsed_llm_outputs]
+    for key in missing_keys:
+        parsed_llm_outputs[key] = _MISSING_INSIGHT_MESSAGES[key]
+    return not missing_keys
+
 def generate_student_insights_with_llm(student_data_dict, app_logger_instance):
     """Generate personalized insights for students using OpenAI, adapted for student-facing content."""
     if not OPENAI_API_KEY:
@@ -725,690 +1466,947 @@ def generate_student_insights_with_llm(student_data_dict, app_logger_instance):
         }
 
     try:
-        openai.api_key = OPENAI_API_KEY # Ensure openai object is used if you aliased it, e.g. client.api_key
-        app_logger_instance.info(f"Attempting to generate LLM insights for student: {student_data_dict.get('student_name', 'N/A')}")
-
-        student_name = student_data_dict.get('student_name', 'Student')
-        student_level = student_data_dict.get('student_level', 'N/A') 
-        current_cycle = student_data_dict.get('current_cycle', 'N/A')
-        school_averages = student_data_dict.get('school_vespa_averages') 
-        vespa_profile_for_rag = student_data_dict.get('vespa_profile', {}) 
-        all_scored_questionnaire_statements = student_data_dict.get('all_scored_questionnaire_statements', [])
-
-        prompt_parts = []
-        prompt_parts.append(f"You are My VESPA AI Coach. I am '{student_name}'. This is my data:")
-        prompt_parts.append(f"Current Cycle: {current_cycle}.")
-
-        prompt_parts.append("\n--- My Current VESPA Profile (Vision, Effort, Systems, Practice, Attitude) ---")
-        if student_data_dict.get('vespa_profile'):
-            for element, details in student_data_dict['vespa_profile'].items():
-                if element == "Overall": continue
-                prompt_parts.append(f"- {element}: My score is {details.get('score_1_to_10', 'N/A')}/10, which is considered '{details.get('score_profile_text', 'N/A')}'.")
-
-        if school_averages:
-            prompt_parts.append("\n--- School's Average VESPA Scores (For Comparison) ---")
-            for element, avg_score in school_averages.items():
-                prompt_parts.append(f"- {element} (School Avg): {avg_score}/10")
-        
-        prompt_parts.append("\n--- My Academic Profile (First 3 Subjects with My Standard Expected Grade) ---")
-        if student_data_dict.get('academic_profile_summary'):
-            profile_data = student_data_dict['academic_profile_summary']
-            valid_subjects_shown = 0
-            if isinstance(profile_data, list) and profile_data and \
-               not (profile_data[0].get('subject','').startswith("Academic profile not found")) and \
-               not (profile_data[0].get('subject','').startswith("No academic subjects parsed")):
-                for subject_info in profile_data[:3]:
-                    if subject_info.get('subject') and subject_info.get('subject') != "N/A":
-                        meg_text = f", My Standard Expected Grade (MEG): {subject_info.get('standard_meg', 'N/A')}" if subject_info.get('standard_meg') else ""
-                        prompt_parts.append(f"- Subject: {subject_info.get('subject')}, My Current Grade: {subject_info.get('currentGrade', 'N/A')}, My Target: {subject_info.get('targetGrade', 'N/A')}{meg_text}")
-                        valid_subjects_shown += 1
-                if valid_subjects_shown == 0:
-                    prompt_parts.append("  It looks like my detailed subject information isn't available right now.")        
-            else:
-                prompt_parts.append("  My detailed academic profile summary isn't available at the moment.")
-        
-        if student_data_dict.get('academic_megs'):
-            meg_data = student_data_dict['academic_megs']
-            prompt_parts.append("\n--- My Academic Benchmarks (Based on My Prior Attainment) ---")
-            prompt_parts.append(f"  My GCSE Prior Attainment Score: {meg_data.get('prior_attainment_score', 'N/A')}")
-            if meg_data.get('aLevel_meg_grade_75th') and meg_data.get('aLevel_meg_grade_75th') != "N/A":
-                 prompt_parts.append(f"  For A-Levels, students with similar prior scores typically achieve around a grade '{meg_data.get('aLevel_meg_grade_75th')}' (this is the standard MEG or top 25% benchmark).")
-
-        prompt_parts.append("\n--- My Reflections & Goals (Current Cycle) ---")
-        reflections_goals_found_student = False
-        current_rrc_text_student = "Not specified"
-        current_goal_text_student = "Not specified"
-        if student_data_dict.get('student_reflections_and_goals'):
-            reflections = student_data_dict['student_reflections_and_goals']
-            current_rrc_key_student = f"rrc{current_cycle}_comment"
-            current_goal_key_student = f"goal{current_cycle}"
-            rrc_val = reflections.get(current_rrc_key_student)
-            goal_val = reflections.get(current_goal_key_student)
-
-            if rrc_val and rrc_val != "Not specified":
-                current_rrc_text_student = str(rrc_val)[:300].replace('\n', ' ')
-                prompt_parts.append(f"- My Current Reflection (RRC{current_cycle}): {current_rrc_text_student}...")
-                reflections_goals_found_student = True
-            if goal_val and goal_val != "Not specified":
-                current_goal_text_student = str(goal_val)[:300].replace('\n', ' ')
-                prompt_parts.append(f"- My Current Goal (Goal {current_cycle}): {current_goal_text_student}...")
-                reflections_goals_found_student = True
-        if not reflections_goals_found_student:
-            prompt_parts.append("  I haven't specified any reflections or goals for the current cycle, or they are not available.")
-
-        prompt_parts.append("\n--- My Key Questionnaire Insights (My Top & Bottom Scoring Statements) ---")
-        obj29_highlights = student_data_dict.get("object29_question_highlights")
-        if obj29_highlights:
-            if obj29_highlights.get("top_3") and obj29_highlights["top_3"]:
-                prompt_parts.append("  Statements I Most Agreed With (1-5 scale, 5=Strongly Agree):")
-                for q_data in obj29_highlights["top_3"]:
-                    prompt_parts.append(f"    - Score {q_data.get('score', 'N/A')}/5 ({q_data.get('category', 'N/A')}): \"{q_data.get('text', 'N/A')}\"")
-            if obj29_highlights.get("bottom_3") and obj29_highlights["bottom_3"]:
-                prompt_parts.append("  Statements I Least Agreed With (Areas to think about):")
-                for q_data in obj29_highlights["bottom_3"]:
-                    prompt_parts.append(f"    - Score {q_data['score']}/5 ({q_data['category']}): \"{q_data['text']}\"")
-        else:
-            prompt_parts.append("  My top/bottom questionnaire statement highlights are not available.")
-
-        # Overall Questionnaire Statement Response Distribution (Student view)
-        prompt_parts.append("\n--- My Overall Questionnaire Statement Response Distribution ---")
-        if all_scored_questionnaire_statements and isinstance(all_scored_questionnaire_statements, list):
-            response_counts = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-            for q_data in all_scored_questionnaire_statements:
-                score = q_data.get("score")
-                if score in response_counts: response_counts[score] += 1
-            prompt_parts.append(f"  - Statements I rated '1' (e.g., Strongly Disagree): {response_counts[1]}")
-            prompt_parts.append(f"  - Statements I rated '2': {response_counts[2]}")
-            prompt_parts.append(f"  - Statements I rated '3': {response_counts[3]}")
-            prompt_parts.append(f"  - Statements I rated '4': {response_counts[4]}")
-            prompt_parts.append(f"  - Statements I rated '5' (e.g., Strongly Agree): {response_counts[5]}")
-        else:
-            prompt_parts.append("  My detailed questionnaire response distribution data is not available.")
-
-        # --- TASKS FOR THE AI (Student View) ---
-        prompt_parts.append("\n\n--- Coach, please help me with these things: ---")
-        prompt_parts.append("Based ONLY on my data provided above, please provide the following insights FOR ME ('{student_name}').")
-        prompt_parts.append("Your tone should be encouraging, supportive, and help me understand myself better. Give me practical, actionable advice. Subtly draw upon general coaching principles and insights related to mindset, goal-setting, self-reflection, and VESPA elements when formulating your responses, especially for the questionnaire analysis and overview. Frame suggestions as reflective points for me.")
-        prompt_parts.append("Please format your entire response as a single JSON object with the following EXACT keys: \"student_overview_summary\", \"chart_comparative_insights\", \"questionnaire_interpretation_and_reflection_summary\", \"academic_benchmark_analysis\", \"suggested_student_goals\", \"academic_quote\", \"academic_performance_ai_summary\".")
-        prompt_parts.append("Ensure all string values within the JSON are properly escaped.")
-        
-        # --- RAG Elements for student prompt (Simplified for now, can be expanded) ---
-        # This section is less about the tutor's KB and more about general advice based on lowest VESPA or similar
-        lowest_vespa_element_student = None
-        lowest_score_student = 11 
-        if vespa_profile_for_rag:
-            for element, details in vespa_profile_for_rag.items():
-                if element == "Overall": continue
-                try:
-                    score = float(details.get('score_1_to_10', 10))
-                    if score < lowest_score_student:
-                        lowest_score_student = score
-                        lowest_vespa_element_student = element
-                except (ValueError, TypeError): pass
-
-        if lowest_vespa_element_student:
-            prompt_parts.append("\n\n--- Some Ideas to Consider ---")
-            prompt_parts.append(f"My lowest VESPA score seems to be in '{lowest_vespa_element_student}'. Can you give me some general tips or reflective questions for this area, and perhaps suggest a simple, actionable goal related to it? You can use the general reflective statements and coaching insights from your knowledge base for inspiration.")
-            # We don't directly inject KB content into student prompt like we do for tutor, 
-            # but we ask the LLM to use its general knowledge inspired by such KBs.
-
-        # --- Knowledge Base Excerpts (Student View - less direct, more for LLM's internal inspiration) ---
-        # We won't show the student the raw KB excerpts like we did for the tutor.
-        # Instead, the prompt will guide the LLM to use this type of knowledge implicitly.
-        # Example: If coaching_kb and REFLECTIVE_STATEMENTS_DATA are globally available in this backend scope:
-        relevant_coaching_insights = []
-        if COACHING_INSIGHTS_DATA and isinstance(COACHING_INSIGHTS_DATA, list):
-            # Attempt to find a few relevant insights based on keywords or student's lowest VESPA.
-            # This is a simple keyword match; more advanced RAG could be used.
-            keywords_from_student_data = [student_name.lower(), lowest_vespa_element_student.lower() if lowest_vespa_element_student else ""]
-            if student_data_dict.get('student_reflections_and_goals'):
-                rrc_text_for_kw = student_data_dict['student_reflections_and_goals'].get(f"rrc{current_cycle}_comment", "").lower()
-                goal_text_for_kw = student_data_dict['student_reflections_and_goals'].get(f"goal{current_cycle}", "").lower()
-                keywords_from_student_data.extend(rrc_text_for_kw.split()[:10]) # First 10 words
-                keywords_from_student_data.extend(goal_text_for_kw.split()[:10])
-
-            # Add keywords from top/bottom questionnaire statements if available
-            if obj29_highlights:
-                for q_data in obj29_highlights.get("top_3", []) + obj29_highlights.get("bottom_3", []):
-                    keywords_from_student_data.extend(q_data.get('text', '').lower().split()[:5])
-
-
-            # Filter out very common words to make keywords more meaningful for matching insights
-            common_filter_words = {"i", "me", "my", "is", "a", "the", "and", "to", "of", "it", "in", "for", "on", "with", "as", "an", "at", "by", "you", "your", "what", "how", "help", "can", "some", "this", "that", "area", "areas", "score", "scores"}
-            meaningful_keywords = [kw for kw in keywords_from_student_data if kw not in common_filter_words and len(kw) > 3]
-
-
-            for insight in COACHING_INSIGHTS_DATA:
-                insight_text_corpus = (
-                    str(insight.get('name', '')).lower() + " " +
-                    str(insight.get('description', '')).lower() + " " +
-                    str(insight.get('implications_for_tutor', '')).lower() + " " +
-                    " ".join(insight.get('keywords', [])).lower()
-                )
-                # Check if any of the student's meaningful keywords appear in the insight's text corpus
-                if any(m_kw in insight_text_corpus for m_kw in meaningful_keywords):
-                    if len(relevant_coaching_insights) < 3: # Limit to 3 for brevity in prompt
-                        insight_summary_for_prompt = f"Insight: {insight.get('name')}. Focus: {insight.get('description')[:100]}..."
-                        relevant_coaching_insights.append(insight_summary_for_prompt)
-            
-        if relevant_coaching_insights:
-            prompt_parts.append("\n\n--- General Coaching Principles (For AI's Inspiration) ---")
-            prompt_parts.append("Remember to draw inspiration from general coaching principles. For example, here are a few themes from your knowledge base that might be relevant to consider when interpreting my data and suggesting reflections (do not quote these directly, but use the underlying ideas):")
-            for RAG_insight_summary in relevant_coaching_insights:
-                prompt_parts.append(f"- {RAG_insight_summary}")
-        
-        if coaching_kb: # This KB is 'coaching_questions_knowledge_base.json'
-            prompt_parts.append("\n(For the AI: You also have access to a coaching questions knowledge base. Use its principles to help formulate your advice and goal suggestions, aiming for reflective and empowering questions for me, '{student_name}'.)")
-        if REFLECTIVE_STATEMENTS_DATA:
-            prompt_parts.append("(For the AI: You also have access to a list of general reflective statements. These can inspire the tone and nature of the S.M.A.R.T. goals you suggest for me.)")
-
-
-        # --- REQUIRED OUTPUT STRUCTURE (JSON Object - Student View) ---
-        prompt_parts.append("\n\n--- REQUIRED OUTPUT STRUCTURE (JSON Object) ---")
-        prompt_parts.append("Please provide your response as a single, valid JSON object. Example:")
-        prompt_parts.append("'''") # Start of code block marker for prompt
-        prompt_parts.append("{")
-        prompt_parts.append("  \"student_overview_summary\": \"A concise 2-3 sentence AI Student Snapshot for me, '{student_name}', highlighting 1-2 of my key strengths and 1-2 primary areas for development, rooted in VESPA principles and drawing from general coaching themes. Max 100-120 words. Speak directly to me (e.g., 'Your data shows...', 'You could focus on...').\",")
-        prompt_parts.append("  \"chart_comparative_insights\": \"A short paragraph (max 100 words) helping me understand my VESPA scores compared to the school averages (if provided). What could these differences or similarities mean for me? If a score is significantly different, suggest a brief reflective question for me based on general coaching principles related to that VESPA element (e.g., if 'Systems' is low, 'What's one small organizational change you could try?'). Use 'you' and 'your'.\",")
-        prompt_parts.append("  \"questionnaire_interpretation_and_reflection_summary\": \"A concise summary (approx. 150-200 words) interpreting my overall questionnaire responses (e.g., my tendencies towards 'Strongly Disagree' or 'Strongly Agree', as indicated by the counts of 1s, 2s, etc.). Highlight any notable patterns, such as a concentration of low or high responses in specific VESPA elements (refer to my Top/Bottom scoring statements). Subtly connect these patterns to general coaching insights about mindset, self-reflection, or goal-setting (e.g., if responses suggest a fixed mindset, gently introduce the idea of growth without being preachy). Also, briefly compare and contrast these questionnaire insights with my own RRC/Goal comments (My RRC: '{RRC_COMMENT_PLACEHOLDER}', My Goal: '{GOAL_COMMENT_PLACEHOLDER}'), noting any consistencies or discrepancies that could be valuable for me to reflect on. Use 'you' and 'your'.\",")
-        prompt_parts.append("  \"academic_benchmark_analysis\": \"A supportive and encouraging analysis (approx. 150-180 words) of my academic performance. Start by looking at my current grades in relation to my Subject Target Grades and my Standard Expected Grades (MEGs). Explain that MEGs show what students with similar prior GCSE scores typically achieve (top 25%) and are aspirational. Explain that my Subject Target Grade (STG) is a more nuanced target that considers subject difficulty. Emphasize that comparing my current grades, MEGs, and STGs should help me think about my progress, strengths, and potential next steps. The goal is to use this information to identify areas for support or challenge, always considering my broader context. Use 'you' and 'your'.\",")
-        prompt_parts.append("  \"suggested_student_goals\": [\"Based on the analysis, and inspired by general reflective statements and coaching principles (e.g., focusing on an area for development from the questionnaire or VESPA profile), suggest 2-3 S.M.A.R.T. goals FOR ME, reframed to my context. Make them actionable and specific.\", \"Goal 2...\"],")
-        prompt_parts.append("  \"academic_quote\": \"A short, inspirational or funny quote suitable for a student. e.g., 'The expert in anything was once a beginner.' or 'Why fall in love when you can fall asleep?'\",")
-        prompt_parts.append("  \"academic_performance_ai_summary\": \"A kind, encouraging, and professional AI summary (like a helpful teacher, approx. 200-250 words) analyzing my academic profile. Discuss my subject benchmarks in relation to my MEGs. If I'm not meeting MEGs, be gentle and positive, focusing on growth and understanding. Highlight strengths and areas for development based on my subject performance. The tone should be positive and empowering, even when pointing out challenges. Reference the MEG explainer text that I will see, which describes MEGs as aspirational and STGs as more personalized. Use 'you' and 'your'.\"")
-        prompt_parts.append("}")
-        prompt_parts.append("'''") # End of code block marker
-
-        # Prepare cleaned versions of current_rrc_text and current_goal_text for the prompt placeholder replacement
-        cleaned_rrc_placeholder_student = current_rrc_text_student[:100].replace('\n', ' ').replace("'", "\\'").replace('"', '\\"')
-        cleaned_goal_placeholder_student = current_goal_text_student[:100].replace('\n', ' ').replace("'", "\\'").replace('"', '\\"')
-        prompt_parts.append(f"REMEMBER to replace RRC_COMMENT_PLACEHOLDER with: '{cleaned_rrc_placeholder_student}...' and GOAL_COMMENT_PLACEHOLDER with: '{cleaned_goal_placeholder_student}...' in your actual questionnaire_interpretation_and_reflection_summary output.")
-
-        prompt_to_send = "\n".join(prompt_parts)
-        # Substitute placeholders in the final prompt string
-        prompt_to_send = prompt_to_send.replace("'{RRC_COMMENT_PLACEHOLDER}'", f"'{cleaned_rrc_placeholder_student}...'")
-        prompt_to_send = prompt_to_send.replace("'{GOAL_COMMENT_PLACEHOLDER}'", f"'{cleaned_goal_placeholder_student}...'")
-
-        app_logger_instance.info(f"Generated Student LLM Prompt (first 500 chars): {prompt_to_send[:500]}")
-        app_logger_instance.info(f"Generated Student LLM Prompt (last 500 chars): {prompt_to_send[-500:]}")
-        app_logger_instance.info(f"Total Student LLM Prompt length: {len(prompt_to_send)} characters")
-
-        system_message_content = (
-            f"You are My VESPA AI Coach, an AI assistant designed to help students understand their VESPA profile (Vision, Effort, Systems, Practice, Attitude) "
-            f"and academic performance. Your responses should be encouraging, supportive, and provide clear, actionable advice directly to the student using 'you' and 'your'. "
-            f"You are speaking to '{student_name}'. Help them reflect on their data and identify steps for improvement. Your output MUST be a single JSON object with specific keys."
-        )
+        app_logger_instance.info("Attempting to generate LLM insights for student: %s", student_data_dict.get('student_name', 'N/A'))
+
+        cache_key = _student_profile_fingerprint(student_data_dict)
+        cached_insights = LLM_INSIGHTS_CACHE.get(cache_key) if cache_key else None
+        if cached_insights is not None:
+            app_logger_instance.info("Using cached LLM insights (profile fingerprint %.12s).", cache_key)
+            return cached_insights
 
+        system_message_content, prompt_to_send = build_student_insights_prompt(student_data_dict, app_logger_instance)
+
+        messages = [
+            {"role": "system", "content": system_message_content},
+            {"role": "user", "content": prompt_to_send}
+        ]
         max_retries = 2
         for attempt in range(max_retries):
             try:
-                # Using openai.chat.completions.create for newer OpenAI library versions
-                response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                        {"role": "system", "content": system_message_content},
-                        {"role": "user", "content": prompt_to_send}
-                    ],
-                    max_tokens=1200, # Adjusted for potentially detailed student-facing JSON, increased slightly
-                    temperature=0.65, # Slightly higher for more nuanced and less wooden student advice
+                # Using the shared openai_client (OpenAI library v1+)
+                response = openai_client.chat.completions.create(
+                    messages=messages,
                     n=1,
                     stop=None,
-                    response_format={"type": "json_object"} # Request JSON output
+                    **INSIGHTS_COMPLETION_SETTINGS
                 )
                 
+                _log_insights_usage(response.usage, app_logger_instance)
                 raw_response_content = response.choices[0].message.content.strip()
-                app_logger_instance.info(f"Student LLM raw response: {raw_response_content}")
+                app_logger_instance.info("Student LLM raw response: %s", raw_response_content)
 
                 parsed_llm_outputs = json.loads(raw_response_content)
                 
                 # Validate expected keys for student response
-                expected_keys_student = [
-                    "student_overview_summary", 
-                    "chart_comparative_insights", 
-                    "questionnaire_interpretation_and_reflection_summary", 
-                    "academic_benchmark_analysis", 
-                    "suggested_student_goals",
-                    "academic_quote",
-                    "academic_performance_ai_summary"
-                ]
                 # Fill missing keys with error messages if LLM doesn't provide them
-                all_keys_present = True
-                for key in expected_keys_student:
-                    if key not in parsed_llm_outputs:
-                        all_keys_present = False
-                        parsed_llm_outputs[key] = f"Error: AI response for '{key}' was not provided."
+                all_keys_present = _fill_missing_insight_keys(parsed_llm_outputs)
                 if not all_keys_present:
-                    app_logger_instance.warning(f"Student LLM response missing one or more expected keys. Filled with defaults. Response: {raw_response_content}")
+                    app_logger_instance.warning("Student LLM response missing one or more expected keys. Filled with defaults. Response: %s", raw_response_content)
+                elif cache_key:
+                    LLM_INSIGHTS_CACHE.set(cache_key, parsed_llm_outputs)
                 
-                app_logger_instance.info(f"Student LLM generated structured data: {parsed_llm_outputs}")
+                app_logger_instance.info("Student LLM generated structured data: %s", parsed_llm_outputs)
                 return parsed_llm_outputs
 
             except json.JSONDecodeError as e_json:
-                app_logger_instance.error(f"JSONDecodeError from Student LLM response (Attempt {attempt + 1}/{max_retries}): {e_json}")
-                app_logger_instance.error(f"Problematic Student LLM response content: {raw_response_content}")
+                app_logger_instance.error("JSONDecodeError from Student LLM response (Attempt %s/%s): %s", attempt + 1, max_retries, e_json)
+                app_logger_instance.error("Problematic Student LLM response content: %s", raw_response_content)
                 if attempt == max_retries - 1:
-                    return {key: f"Error parsing AI response for {key} after multiple attempts." for key in expected_keys_student}
-            except Exception as e_general:
-                app_logger_instance.error(f"Error calling OpenAI API or processing response for student (Attempt {attempt + 1}/{max_retries}): {e_general}")
+                    return dict(_PARSE_ERROR_AFTER_RETRIES_INSIGHTS)
+                # Show the model its invalid output and ask again, rather than resending the same prompt
+                messages = messages + [
+                    {"role": "assistant", "content": raw_response_content},
+                    {"role": "user", "content": f"The previous response was not valid JSON ({e_json}). Please respond with only the JSON object."}
+                ]
+                continue
+            except RETRYABLE_OPENAI_ERRORS as e_transient:
+                app_logger_instance.error("Transient OpenAI error for student (Attempt %s/%s): %s", attempt + 1, max_retries, e_transient)
                 if attempt == max_retries - 1:
-                     return {key: f"Error generating insights from AI for {key}. (Details: {str(e_general)[:50]}...)" for key in expected_keys_student}
-            time.sleep(1) # Wait before retrying
+                     return _api_error_insights(e_transient)
+            except Exception as e_general:
+                # Bad requests, auth failures etc. will fail the same way again, so don't retry them
+                app_logger_instance.error("Error calling OpenAI API or processing response for student (Attempt %s/%s): %s", attempt + 1, max_retries, e_general)
+                return _api_error_insights(e_general)
+            # Exponential backoff with jitter so retries from concurrent workers don't land together
+            time.sleep(LLM_RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, LLM_RETRY_BASE_DELAY_SECONDS))
 
         # Fallback if all retries fail
         app_logger_instance.error("Student LLM processing failed after all retries.")
-        return {key: "Critical error: AI processing failed after all retries." for key in expected_keys_student}
+        return dict(_CRITICAL_ERROR_INSIGHTS)
 
     except Exception as e_outer:
-        app_logger_instance.error(f"Outer exception in generate_student_insights_with_llm: {e_outer}")
-        return {
-            "student_overview_summary": "An unexpected error occurred while generating AI insights.",
-            "chart_comparative_insights": "Insights unavailable due to an error.",
-            "questionnaire_interpretation_and_reflection_summary": "Questionnaire interpretation unavailable due to an error.",
-            "academic_benchmark_analysis": "Academic benchmark analysis unavailable due to an error.",
-            "suggested_student_goals": ["Goal suggestions unavailable due to an error."],
-            "academic_quote": "Quote unavailable due to an error.",
-            "academic_performance_ai_summary": "Personalized academic summary unavailable due to an error."
-        }
+        app_logger_instance.error("Outer exception in generate_student_insights_with_llm: %s", e_outer)
+        return dict(_UNEXPECTED_ERROR_INSIGHTS)
+
+# Long-lived pool for the multi-student OpenAI calls. Its threads are reused across requests, and its size
+# caps the completions in flight for the whole process however many class views arrive together.
+# Jobs on it never submit to it, so waiting on its futures can't deadlock. Threads start on first use.
+INSIGHTS_LLM_POOL = ThreadPoolExecutor(max_workers=INSIGHTS_LLM_WORKERS)
+
+def _generate_insights_for_student_group(student_data_by_id, app_logger_instance, timeout=INSIGHTS_GROUP_TIMEOUT_SECONDS):
+    """One chat completion for up to INSIGHTS_MULTI_STUDENT_MAX students; returns {student id: insights}.
+    The static system prefix and the round trip are paid once for the whole group."""
+    student_sections = []
+    for student_id, student_data_dict in student_data_by_id.items():
+        _, student_prompt = build_student_insights_prompt(student_data_dict, app_logger_instance)
+        student_sections.append(f"=== Student id: {student_id} ===\n{student_prompt}")
+    student_ids_json = json.dumps(list(student_data_by_id))
+    prompt_to_send = "\n\n".join(student_sections) + (
+        f"\n\nThe messages above are from {len(student_sections)} different students. Return ONE JSON object whose keys are "
+        f"exactly these student ids: {student_ids_json}. The value for each id must be the complete JSON object described "
+        "in your instructions, written for that student only."
+    )
+    completion_settings = dict(INSIGHTS_COMPLETION_SETTINGS)
+    completion_settings["max_tokens"] = INSIGHTS_COMPLETION_SETTINGS["max_tokens"] * len(student_sections)
+    response = openai_client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+        messages=[
+            {"role": "system", "content": _INSIGHTS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt_to_send}
+        ],
+        n=1,
+        stop=None,
+        **completion_settings
+    )
+    _log_insights_usage(response.usage, app_logger_instance)
+    parsed_by_id = json.loads(response.choices[0].message.content.strip())
+    if not isinstance(parsed_by_id, dict):
+        raise ValueError("combined insights response was not a JSON object")
+    results = {}
+    for student_id in student_data_by_id:
+        parsed_llm_outputs = parsed_by_id.get(str(student_id))
+        if not isinstance(parsed_llm_outputs, dict):
+            app_logger_instance.warning("Combined insights response had no entry for student id %s.", student_id)
+            continue
+        if not _fill_missing_insight_keys(parsed_llm_outputs):
+            app_logger_instance.warning("Combined insights for student id %s missing one or more expected keys. Filled with defaults.", student_id)
+        else:
+            cache_key = _student_profile_fingerprint(student_data_by_id[student_id])
+            if cache_key:
+                LLM_INSIGHTS_CACHE.set(cache_key, parsed_llm_outputs)
+        results[student_id] = parsed_llm_outputs
+    return results
+
+def generate_insights_for_student_ids(student_data_by_id, app_logger_instance, deadline):
+    """Insights for several students, packing uncached ones into combined requests of up to INSIGHTS_MULTI_STUDENT_MAX
+    that overlap on INSIGHTS_LLM_POOL. Returns {student id: insights} by `deadline` (a time.monotonic() value).
+    Students a combined request fails for, or leaves out, get one request of their own if INSIGHTS_MIN_CALL_SECONDS
+    are still left; any unanswered at the deadline are left out for the caller to fill in."""
+    results = {}
+    uncached = {}
+    for student_id, student_data_dict in student_data_by_id.items():
+        cache_key = _student_profile_fingerprint(student_data_dict)
+        cached_insights = LLM_INSIGHTS_CACHE.get(cache_key) if cache_key else None
+        if cached_insights is not None:
+            results[student_id] = cached_insights
+        else:
+            uncached[student_id] = student_data_dict
+
+    if not OPENAI_API_KEY: # Placeholder insights; no request is made
+        results.update((student_id, generate_student_insights_with_llm(student_data_dict, app_logger_instance)) for student_id, student_data_dict in uncached.items())
+        return results
+
+    def run_group(group_ids):
+        # Checked when the job starts, as it may have queued behind other requests' calls
+        timeout = min(INSIGHTS_GROUP_TIMEOUT_SECONDS, deadline - time.monotonic())
+        if timeout < INSIGHTS_MIN_CALL_SECONDS:
+            return {}
+        try:
+            return _generate_insights_for_student_group({student_id: uncached[student_id] for student_id in group_ids}, app_logger_instance, timeout)
+        except Exception as e:
+            app_logger_instance.error("Combined insights request for %s students failed: %s", len(group_ids), e)
+            return {}
+
+    uncached_ids = list(uncached)
+    groups = [uncached_ids[i:i + INSIGHTS_MULTI_STUDENT_MAX] for i in range(0, len(uncached_ids), INSIGHTS_MULTI_STUDENT_MAX)]
+    while groups and deadline - time.monotonic() >= INSIGHTS_MIN_CALL_SECONDS:
+        futures = [INSIGHTS_LLM_POOL.submit(run_group, group_ids) for group_ids in groups]
+        done, not_done = wait(futures, timeout=deadline - time.monotonic())
+        for future in not_done:
+            future.cancel() # Drops jobs still queued; a running call ends at its own timeout
+        for future in done:
+            results.update(future.result())
+        if not_done or len(groups) == len(uncached_ids): # Out of time, or every request already had one student
+            break
+        uncached_ids = [student_id for student_id in uncached_ids if student_id not in results]
+        groups = [[student_id] for student_id in uncached_ids]
+    missing_count = sum(1 for student_id in uncached if student_id not in results)
+    if missing_count:
+        app_logger_instance.warning("No insights for %s of %s students by the request deadline; they get the generic fallback.", missing_count, len(uncached))
+    return results
+
+# Partial-JSON parse attempts are rate limited (~60 Hz) rather than run for every streamed token.
+INSIGHTS_STREAM_PARSE_INTERVAL_SECONDS = 1 / 60
+
+_json_decoder = json.JSONDecoder()
+
+def _pop_completed_json_members(buffer, position):
+    """Parses the top-level "key": value members of a streamed JSON object that are complete in buffer[position:].
+
+    Returns ([(key, value), ...], new_position). A member counts as complete only once the ',' or '}' after its
+    value has arrived, so a number that is still streaming (e.g. "12." of 12.5) is never cut short.
+    """
+    members = []
+    buffer_len = len(buffer)
+    while True:
+        index = position
+        while index < buffer_len and buffer[index] in ' \t\r\n,{':
+            index += 1
+        try:
+            key, index = _json_decoder.raw_decode(buffer, index)
+            while index < buffer_len and buffer[index] in ' \t\r\n':
+                index += 1
+            if index >= buffer_len or buffer[index] != ':':
+                return members, position
+            index += 1
+            while index < buffer_len and buffer[index] in ' \t\r\n':
+                index += 1
+            value, index = _json_decoder.raw_decode(buffer, index)
+        except json.JSONDecodeError:
+            return members, position
+        while index < buffer_len and buffer[index] in ' \t\r\n':
+            index += 1
+        if index >= buffer_len or buffer[index] not in ',}' or not isinstance(key, str):
+            return members, position
+        members.append((key, value))
+        position = index
+
+def _peek_partial_json_string_member(buffer, position):
+    """If the next member in buffer[position:] is a string value the model is still writing, returns
+    (key, text so far); otherwise None. An escape sequence cut off at the end of the buffer is left out."""
+    buffer_len = len(buffer)
+    index = position
+    while index < buffer_len and buffer[index] in ' \t\r\n,{':
+        index += 1
+    try:
+        key, index = _json_decoder.raw_decode(buffer, index)
+    except json.JSONDecodeError:
+        return None
+    while index < buffer_len and buffer[index] in ' \t\r\n':
+        index += 1
+    if index >= buffer_len or buffer[index] != ':':
+        return None
+    index += 1
+    while index < buffer_len and buffer[index] in ' \t\r\n':
+        index += 1
+    if index >= buffer_len or buffer[index] != '"' or not isinstance(key, str):
+        return None
+    partial_value = buffer[index:]
+    for trim in range(7): # The longest cut-off escape is a backslash plus 'uXXX'; trimming also drops a bare closing quote
+        try:
+            text = json.loads(partial_value[:len(partial_value) - trim] + '"')
+        except json.JSONDecodeError:
+            continue
+        if text and '\ud800' <= text[-1] <= '\udbff': # First half of a \uXXXX\uXXXX surrogate pair
+            text = text[:-1]
+        return key, text
+    return None
+
+def stream_student_insights_with_llm(student_data_dict, app_logger_instance):
+    """Streaming variant of generate_student_insights_with_llm.
+
+    Yields (key, value, complete). While the model is writing a string insight, (key, text so far, False)
+    is yielded each time that text has grown, so the overview can be shown as it is generated. Once an
+    insight is finished, (key, value, True) is yielded. Expected keys the model never produced are then
+    filled like the buffered path. Every key in STUDENT_INSIGHT_KEYS is yielded exactly once with complete=True.
+    Nothing is retried: keys already sent can't be taken back, so a failure fills the remaining keys with errors.
+    """
+    if not OPENAI_API_KEY:
+        for key, value in generate_student_insights_with_llm(student_data_dict, app_logger_instance).items():
+            yield key, value, True
+        return
+
+    cache_key = _student_profile_fingerprint(student_data_dict)
+    cached_insights = LLM_INSIGHTS_CACHE.get(cache_key) if cache_key else None
+    if cached_insights is not None:
+        app_logger_instance.info("Using cached LLM insights (profile fingerprint %.12s).", cache_key)
+        for key, value in cached_insights.items():
+            yield key, value, True
+        return
+
+    streamed_insights = {}
+    response_parts = []
+    try:
+        app_logger_instance.info("Streaming LLM insights for student: %s", student_data_dict.get('student_name', 'N/A'))
+        system_message_content, prompt_to_send = build_student_insights_prompt(student_data_dict, app_logger_instance)
+        llm_stream = openai_client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_message_content},
+                {"role": "user", "content": prompt_to_send}
+            ],
+            n=1,
+            stop=None,
+            stream=True,
+            stream_options={"include_usage": True},
+            **INSIGHTS_COMPLETION_SETTINGS
+        )
+        buffer = ""
+        parse_position = 0
+        last_parse_time = 0.0
+        last_partial = None
+        for chunk in llm_stream:
+            if getattr(chunk, "usage", None) is not None: # Only on the final, choice-less chunk
+                _log_insights_usage(chunk.usage, app_logger_instance)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            response_parts.append(chunk.choices[0].delta.content)
+            now = time.monotonic()
+            if now - last_parse_time < INSIGHTS_STREAM_PARSE_INTERVAL_SECONDS:
+                continue
+            last_parse_time = now
+            buffer = "".join(response_parts)
+            members, parse_position = _pop_completed_json_members(buffer, parse_position)
+            for key, value in members:
+                if key not in streamed_insights:
+                    streamed_insights[key] = value
+                    yield key, value, True
+            partial = _peek_partial_json_string_member(buffer, parse_position)
+            if partial is not None and partial[1] and partial != last_partial and partial[0] not in streamed_insights:
+                last_partial = partial
+                yield partial[0], partial[1], False
+
+        raw_response_content = "".join(response_parts).strip()
+        app_logger_instance.info("Student LLM raw (streamed) response: %s", raw_response_content)
+        parsed_llm_outputs = json.loads(raw_response_content)
+        all_keys_present = _fill_missing_insight_keys(parsed_llm_outputs)
+        if not all_keys_present:
+            app_logger_instance.warning("Streamed student LLM response missing one or more expected keys. Filled with defaults.")
+        elif cache_key:
+            LLM_INSIGHTS_CACHE.set(cache_key, parsed_llm_outputs)
+    except json.JSONDecodeError as e_json:
+        app_logger_instance.error("JSONDecodeError from streamed Student LLM response: %s", e_json)
+        parsed_llm_outputs = dict(_PARSE_ERROR_INSIGHTS)
+    except Exception as e_general:
+        app_logger_instance.error("Error streaming OpenAI insights for student: %s", e_general)
+        parsed_llm_outputs = _api_error_insights(e_general)
+
+    for key, value in parsed_llm_outputs.items():
+        if key not in streamed_insights:
+            streamed_insights[key] = value
+            yield key, value, True
+
+def submit_student_insights_batch(student_data_by_id, app_logger_instance):
+    """Queues insights for many students on the OpenAI Batch API (half the per-token cost, results within 24h).
+    student_data_by_id maps a caller-chosen id (e.g. the Object_10 record id) to the same dict the live path uses.
+    Returns the batch id to pass to collect_student_insights_batch, or None if nothing could be submitted."""
+    if not OPENAI_API_KEY or not student_data_by_id:
+        return None
+    request_lines = []
+    for custom_id, student_data_dict in student_data_by_id.items():
+        system_message_content, prompt_to_send = build_student_insights_prompt(student_data_dict, app_logger_instance)
+        body = dict(INSIGHTS_COMPLETION_SETTINGS)
+        body["messages"] = [
+            {"role": "system", "content": system_message_content},
+            {"role": "user", "content": prompt_to_send}
+        ]
+        request_lines.append(json.dumps({"custom_id": str(custom_id), "method": "POST", "url": "/v1/chat/completions", "body": body}))
+    try:
+        batch_input_file = openai_client.files.create(
+            file=("student_insights_batch.jsonl", "\n".join(request_lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = openai_client.batches.create(
+            input_file_id=batch_input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except Exception as e:
+        app_logger_instance.error("Failed to submit student insights batch of %s requests: %s", len(request_lines), e)
+        return None
+    app_logger_instance.info("Submitted student insights batch %s with %s requests.", batch.id, len(request_lines))
+    return batch.id
+
+def collect_student_insights_batch(batch_id, app_logger_instance):
+    """Polls a batch from submit_student_insights_batch. Returns None while it is still running, otherwise
+    a dict of custom_id -> insights (validated like the live path; failed requests get error placeholders).
+    OpenAI errors, e.g. openai.NotFoundError for an unknown batch id, are raised to the caller."""
+    if openai_client is None:
+        raise RuntimeError("OpenAI is not configured")
+    batch = openai_client.batches.retrieve(batch_id)
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        app_logger_instance.info("Student insights batch %s is still %s.", batch_id, batch.status)
+        return None
+
+    results = {}
+    if batch.output_file_id:
+        for line in openai_client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                batch_result = json.loads(line)
+                custom_id = batch_result["custom_id"]
+            except (KeyError, TypeError, json.JSONDecodeError) as e:
+                app_logger_instance.error("Skipping unreadable output line in batch %s: %s", batch_id, e)
+                continue
+            try:
+                raw_response_content = batch_result["response"]["body"]["choices"][0]["message"]["content"].strip()
+                parsed_llm_outputs = json.loads(raw_response_content)
+            except (KeyError, IndexError, TypeError, json.JSONDecodeError) as e:
+                app_logger_instance.error("Unusable batch result for %s in batch %s: %s", custom_id, batch_id, e)
+                results[custom_id] = dict(_PARSE_ERROR_INSIGHTS)
+                continue
+            if not _fill_missing_insight_keys(parsed_llm_outputs):
+                app_logger_instance.warning("Batch insights for %s missing one or more expected keys. Filled with defaults.", custom_id)
+            results[custom_id] = parsed_llm_outputs
+    if batch.error_file_id:
+        for line in openai_client.files.content(batch.error_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                custom_id = json.loads(line)["custom_id"]
+            except (KeyError, TypeError, json.JSONDecodeError) as e:
+                app_logger_instance.error("Skipping unreadable error line in batch %s: %s", batch_id, e)
+                continue
+            results.setdefault(custom_id, dict(_BATCH_REQUEST_FAILED_INSIGHTS))
+    app_logger_instance.info("Student insights batch %s finished as %s with %s results.", batch_id, batch.status, len(results))
+    return results
 
 # --- Main API Endpoint --- 
-@app.route('/api/v1/student_coaching_data', methods=['POST', 'OPTIONS'])
-def student_coaching_data():
-    app.logger.info(f"Received request for /api/v1/student_coaching_data. Method: {request.method}")
-    if request.method == 'OPTIONS':
-        return _build_cors_preflight_response()
-    
-    if request.method == 'POST':
-        data = request.get_json()
-        student_object3_id = data.get('student_object3_id')
-        if not student_object3_id:
-            app.logger.error("Missing 'student_object3_id' in request.")
-            return jsonify({"error": "Missing student_object3_id"}), 400
+def _prepare_student_coaching_data(student_object3_id):
+    """Fetches everything the coaching dashboard shows for one student from Knack and the KBs.
 
-        app.logger.info(f"Processing data for student Object_3 ID: {student_object3_id}")
-
-        # 1. Fetch Student User Details (Object_3)
-        student_user_data = get_student_user_details(student_object3_id)
-        student_email = None
-        student_name_from_obj3 = f"Student_{student_object3_id[:6]}" # Default
-        if student_user_data:
-            # field_70 in Object_3 is the email field.
-            # Knack email fields when fetched as objects can be like: {'email': 'actual.email@example.com', 'label': 'actual.email@example.com'}
-            # Or the _raw version might sometimes just be the string, or an HTML string as observed.
-            raw_val_field70 = student_user_data.get('field_70_raw') # Knack raw value
-            obj_val_field70 = student_user_data.get('field_70') # Knack object value
-
-            # Priority 1: Try to get email from field_70 if it's a Knack email object
-            if isinstance(obj_val_field70, dict) and 'email' in obj_val_field70 and isinstance(obj_val_field70['email'], str):
-                student_email = obj_val_field70['email'].strip()
-            # Priority 2: Try to get email from field_70_raw if it's a Knack email object (less common for _raw to be object)
-            elif isinstance(raw_val_field70, dict) and 'email' in raw_val_field70 and isinstance(raw_val_field70['email'], str):
-                 student_email = raw_val_field70['email'].strip()
-            # Priority 3: If field_70_raw is a string (as suggested by logs)
-            elif isinstance(raw_val_field70, str):
-                temp_email_str = raw_val_field70.strip()
-                # Check if it's an HTML string like <a href="mailto:email@example.com">text</a>
-                if temp_email_str.lower().startswith('<a') and 'mailto:' in temp_email_str.lower() and temp_email_str.lower().endswith('</a>'):
-                    try:
-                        # Extract from within mailto:"..." part of href
-                        mailto_keyword = 'mailto:'
-                        mailto_start_index = temp_email_str.lower().find(mailto_keyword) + len(mailto_keyword)
-                        
-                        # Find the end of the email address in href. It could be terminated by ", ', >.
-                        end_char_index = len(temp_email_str) 
-                        
-                        quote_index = temp_email_str.find('"', mailto_start_index)
-                        if quote_index != -1:
-                            end_char_index = min(end_char_index, quote_index)
-                        
-                        single_quote_index = temp_email_str.find("'", mailto_start_index)
-                        if single_quote_index != -1:
-                            end_char_index = min(end_char_index, single_quote_index)
-                            
-                        angle_bracket_index = temp_email_str.find('>', mailto_start_index)
-                        if angle_bracket_index != -1: # Should be present if parsing href part of <a> tag
-                            end_char_index = min(end_char_index, angle_bracket_index)
-
-                        extracted_from_href = temp_email_str[mailto_start_index:end_char_index].strip()
-                        
-                        if '@' in extracted_from_href and ' ' not in extracted_from_href and '<' not in extracted_from_href:
-                            student_email = extracted_from_href
-                        
-                        # Fallback: if mailto parsing didn't yield a good email, try getting link text
-                        if not student_email:
-                            text_start_actual_index = temp_email_str.find('>') 
-                            if text_start_actual_index != -1:
-                                text_start_actual_index +=1 # move past '>'
-                                text_end_index = temp_email_str.lower().rfind('</a>') # Use rfind for last occurrence
-                                if text_end_index > text_start_actual_index :
-                                    extracted_text = temp_email_str[text_start_actual_index:text_end_index].strip()
-                                    if '@' in extracted_text and ' ' not in extracted_text and '<' not in extracted_text:
-                                        student_email = extracted_text
-                                        app.logger.info(f"Used email from link text: {student_email}")
-
-                    except Exception as e_parse:
-                        app.logger.warning(f"Error parsing specific HTML email string '{temp_email_str}': {e_parse}")
-                # If it's just a plain email string (no HTML detected or parsing failed)
-                elif '@' in temp_email_str and not '<' in temp_email_str:
-                    student_email = temp_email_str
-            # Priority 4: Fallback to field_70 if it's a plain string and others failed
-            elif isinstance(obj_val_field70, str) and '@' in obj_val_field70 and not '<' in obj_val_field70 :
-                 student_email = obj_val_field70.strip()
-            
-            if student_email:
-                app.logger.info(f"Extracted student email: {student_email} for Object_3 ID {student_object3_id}")
-            else:
-                app.logger.warning(f"Could not extract plain email from Object_3 field_70 for ID {student_object3_id}. "
-                                   f"field_70_raw: '{raw_val_field70}', field_70: '{obj_val_field70}'")
-
-            # Correctly get student name from field_69 (Name field in Object_3)
-            name_data_raw = student_user_data.get('field_69_raw')
-            name_data_obj = student_user_data.get('field_69')
-
-            if isinstance(name_data_raw, dict) and name_data_raw.get('full'):
-                student_name_from_obj3 = name_data_raw['full']
-            elif isinstance(name_data_obj, dict) and name_data_obj.get('full'):
-                student_name_from_obj3 = name_data_obj['full']
-            elif isinstance(name_data_raw, dict): # Fallback if 'full' isn't present but it's a dict
-                first = name_data_raw.get('first', '')
-                last = name_data_raw.get('last', '')
-                title = name_data_raw.get('title', '')
-                constructed_name = f"{title} {first} {last}".replace('  ', ' ').strip()
-                if constructed_name and constructed_name != title: # Ensure some name was actually built
-                    student_name_from_obj3 = constructed_name
-            elif isinstance(name_data_obj, dict): # Fallback for object version
-                first = name_data_obj.get('first', '')
-                last = name_data_obj.get('last', '')
-                title = name_data_obj.get('title', '')
-                constructed_name = f"{title} {first} {last}".replace('  ', ' ').strip()
-                if constructed_name and constructed_name != title:
-                    student_name_from_obj3 = constructed_name
-            # If it's a direct string (less common for Knack name fields but possible)
-            elif isinstance(name_data_raw, str) and name_data_raw.strip():
-                student_name_from_obj3 = name_data_raw.strip()
-            elif isinstance(name_data_obj, str) and name_data_obj.strip():
-                student_name_from_obj3 = name_data_obj.strip()
+    Returns (error_response, None) if the student can't be loaded, otherwise (None, context) where
+    context holds the LLM input data plus the Object_10 record and email needed to save the overview.
+    Shared by the buffered and streaming student_coaching_data endpoints.
+    """
+    app.logger.info("Processing data for student Object_3 ID: %s", student_object3_id)
+
+    # 1. Fetch Student User Details (Object_3)
+    student_user_data = get_student_user_details(student_object3_id)
+    student_email = None
+    student_name_from_obj3 = f"Student_{student_object3_id[:6]}" # Default
+    if student_user_data:
+        # field_70 in Object_3 is the email field.
+        # Knack email fields when fetched as objects can be like: {'email': 'actual.email@example.com', 'label': 'actual.email@example.com'}
+        # Or the _raw version might sometimes just be the string, or an HTML string as observed.
+        raw_val_field70 = student_user_data.get('field_70_raw') # Knack raw value
+        obj_val_field70 = student_user_data.get('field_70') # Knack object value
+
+        student_email = extract_email_from_field70(raw_val_field70, obj_val_field70)
+
+        if student_email:
+            app.logger.info("Extracted student email: %s for Object_3 ID %s", student_email, student_object3_id)
         else:
-            app.logger.warning(f"Could not fetch Object_3 details for ID {student_object3_id}")
-            # Return error or limited dummy if core student info fails
-            return jsonify({"error": f"Could not retrieve user details for {student_object3_id}"}), 404
-
-        # 2. Fetch Student's VESPA Profile (Object_10)
-        object10_data = get_student_object10_record(student_email) if student_email else None
-        current_cycle = 0
-        vespa_scores_for_profile = {}
-        student_reflections = {}
-        school_id = None
-        school_vespa_averages = None
-        student_level_raw = "N/A" # For educational level
+            app.logger.warning("Could not extract plain email from Object_3 field_70 for ID %s. "
+                               "field_70_raw: '%s', field_70: '%s'", student_object3_id, raw_val_field70, obj_val_field70)
+
+        # Correctly get student name from field_69 (Name field in Object_3)
+        name_data_raw = student_user_data.get('field_69_raw')
+        name_data_obj = student_user_data.get('field_69')
+
+        if isinstance(name_data_raw, dict) and name_data_raw.get('full'):
+            student_name_from_obj3 = name_data_raw['full']
+        elif isinstance(name_data_obj, dict) and name_data_obj.get('full'):
+            student_name_from_obj3 = name_data_obj['full']
+        elif isinstance(name_data_raw, dict): # Fallback if 'full' isn't present but it's a dict
+            first = name_data_raw.get('first', '')
+            last = name_data_raw.get('last', '')
+            title = name_data_raw.get('title', '')
+            constructed_name = f"{title} {first} {last}".replace('  ', ' ').strip()
+            if constructed_name and constructed_name != title: # Ensure some name was actually built
+                student_name_from_obj3 = constructed_name
+        elif isinstance(name_data_obj, dict): # Fallback for object version
+            first = name_data_obj.get('first', '')
+            last = name_data_obj.get('last', '')
+            title = name_data_obj.get('title', '')
+            constructed_name = f"{title} {first} {last}".replace('  ', ' ').strip()
+            if constructed_name and constructed_name != title:
+                student_name_from_obj3 = constructed_name
+        # If it's a direct string (less common for Knack name fields but possible)
+        elif isinstance(name_data_raw, str) and name_data_raw.strip():
+            student_name_from_obj3 = name_data_raw.strip()
+        elif isinstance(name_data_obj, str) and name_data_obj.strip():
+            student_name_from_obj3 = name_data_obj.strip()
+    else:
+        app.logger.warning("Could not fetch Object_3 details for ID %s", student_object3_id)
+        # Return error or limited dummy if core student info fails
+        return (jsonify({"error": f"Could not retrieve user details for {student_object3_id}"}), 404), None
+
+    # The academic profile (Object_112) only needs the Object_3 ID and name, so start it now and let it
+    # run alongside the Object_10 / Object_29 / school-average fetches below; it is collected in step 4.
+    academic_profile_future = _submit_background_fetch(get_academic_profile, student_object3_id, student_name_from_obj3, app.logger)
+
+    # 2. Fetch Student's VESPA Profile (Object_10)
+    object10_data = get_student_object10_record(student_email) if student_email else None
+    current_cycle = 0
+    vespa_scores_for_profile = {}
+    student_reflections = {}
+    school_id = None
+    school_vespa_averages = None
+    school_averages_future = None
+    student_level_raw = "N/A" # For educational level
+    
+    if object10_data:
+        o10_get = object10_data.get
+        student_level_raw = o10_get("field_568_raw", "N/A")
+        current_cycle_str = o10_get("field_146_raw", "0")
+        # Ensure current_cycle_str is treated as a string before isdigit()
+        current_cycle = int(str(current_cycle_str)) if str(current_cycle_str).isdigit() else 0
+        app.logger.info("Student's current cycle from Object_10: %s, Student Level Raw: %s", current_cycle, student_level_raw)
         
-        if object10_data:
-            student_level_raw = object10_data.get("field_568_raw", "N/A")
-            current_cycle_str = object10_data.get("field_146_raw", "0")
-            # Ensure current_cycle_str is treated as a string before isdigit()
-            current_cycle = int(str(current_cycle_str)) if str(current_cycle_str).isdigit() else 0
-            app.logger.info(f"Student's current cycle from Object_10: {current_cycle}, Student Level Raw: {student_level_raw}")
-            
-            # Get school ID for averages calculation (from tutor app.py)
-            school_id = None
-            school_connection_raw = object10_data.get("field_133_raw")
-            if isinstance(school_connection_raw, list) and school_connection_raw:
-                school_id = school_connection_raw[0].get('id')
-                app.logger.info(f"Extracted school_id '{school_id}' from student's Object_10 field_133_raw (list).")
-            elif isinstance(school_connection_raw, str):
-                school_id = school_connection_raw
-                app.logger.info(f"Extracted school_id '{school_id}' (string) from student's Object_10 field_133_raw.")
-            else:
-                # Attempt to get from non-raw field if raw is not helpful
-                school_connection_obj = object10_data.get("field_133")
-                if isinstance(school_connection_obj, list) and school_connection_obj:
-                    school_id = school_connection_obj[0].get('id')
-                    app.logger.info(f"Extracted school_id '{school_id}' from student's Object_10 field_133 (non-raw object).")
-                else:
-                    app.logger.warning(f"Could not determine school_id from field_133_raw or field_133. Data (raw): {school_connection_raw}, Data (obj): {school_connection_obj}")
-            
-            vespa_scores_for_profile = {
-                "Vision": {"score_1_to_10": object10_data.get("field_147"), "score_profile_text": get_score_profile_text(object10_data.get("field_147"))},
-                "Effort": {"score_1_to_10": object10_data.get("field_148"), "score_profile_text": get_score_profile_text(object10_data.get("field_148"))},
-                "Systems": {"score_1_to_10": object10_data.get("field_149"), "score_profile_text": get_score_profile_text(object10_data.get("field_149"))},
-                "Practice": {"score_1_to_10": object10_data.get("field_150"), "score_profile_text": get_score_profile_text(object10_data.get("field_150"))},
-                "Attitude": {"score_1_to_10": object10_data.get("field_151"), "score_profile_text": get_score_profile_text(object10_data.get("field_151"))}
-            }
-            student_reflections = {
-                f"rrc{current_cycle}_comment": object10_data.get(f"field_{2301+current_cycle}"), # RRC1=2302, RRC2=2303, RRC3=2304
-                f"goal{current_cycle}": object10_data.get(f"field_{2498+current_cycle}" if current_cycle==1 else f"field_{2491+current_cycle}") # Goal1=2499, Goal2=2493, Goal3=2494
-            }
-            
-            # Calculate school VESPA averages
-            school_vespa_averages = None
-            if school_id:
-                school_vespa_averages = get_school_vespa_averages(school_id)
-                if school_vespa_averages:
-                    app.logger.info(f"Successfully retrieved school-wide VESPA averages for school {school_id}: {school_vespa_averages}")
-                else:
-                    app.logger.warning(f"Failed to retrieve school-wide VESPA averages for school {school_id}.")
+        # Get school ID for averages calculation (from tutor app.py)
+        school_id = None
+        school_connection_raw = o10_get("field_133_raw")
+        if isinstance(school_connection_raw, list) and school_connection_raw:
+            school_id = school_connection_raw[0].get('id')
+            app.logger.info("Extracted school_id '%s' from student's Object_10 field_133_raw (list).", school_id)
+        elif isinstance(school_connection_raw, str):
+            school_id = school_connection_raw
+            app.logger.info("Extracted school_id '%s' (string) from student's Object_10 field_133_raw.", school_id)
+        else:
+            # Attempt to get from non-raw field if raw is not helpful
+            school_connection_obj = o10_get("field_133")
+            if isinstance(school_connection_obj, list) and school_connection_obj:
+                school_id = school_connection_obj[0].get('id')
+                app.logger.info("Extracted school_id '%s' from student's Object_10 field_133 (non-raw object).", school_id)
             else:
-                app.logger.warning("Cannot fetch school-wide VESPA averages as school_id is unknown.")
+                app.logger.warning("Could not determine school_id from field_133_raw or field_133. Data (raw): %s, Data (obj): %s", school_connection_raw, school_connection_obj)
+        
+        vespa_scores_for_profile = {
+            element: {"score_1_to_10": score, "score_profile_text": get_score_profile_text(score)}
+            for element, field_id in VESPA_SCORE_FIELDS for score in (o10_get(field_id),) # Each score fetched once
+        }
+        student_reflections = {
+            f"rrc{current_cycle}_comment": o10_get(f"field_{2301+current_cycle}"), # RRC1=2302, RRC2=2303, RRC3=2304
+            f"goal{current_cycle}": o10_get(f"field_{2498+current_cycle}" if current_cycle==1 else f"field_{2491+current_cycle}") # Goal1=2499, Goal2=2493, Goal3=2494
+        }
+        
+        # Calculate school VESPA averages (in the background while Object_29 is fetched)
+        if school_id:
+            school_averages_future = _submit_background_fetch(get_school_vespa_averages, school_id)
         else:
-            app.logger.warning(f"No Object_10 data for student {student_name_from_obj3} (Email: {student_email})")
-            # Populate with N/A or defaults if Object_10 is missing
-            for v_element in ["Vision", "Effort", "Systems", "Practice", "Attitude"]:
-                vespa_scores_for_profile[v_element] = {"score_1_to_10": "N/A", "score_profile_text": "N/A"}
-            student_reflections = {"rrc_comment": "Not available", "goal": "Not available"}
-
-        # 3. Fetch Questionnaire Data (Object_29)
-        all_scored_statements = []
-        object29_highlights_top_bottom = {"top_3": [], "bottom_3": []}
-        if object10_data and current_cycle > 0 and psychometric_question_details_kb:
-            object29_data = get_student_object29_questionnaire_data(object10_data.get('id'), current_cycle)
-            if object29_data:
-                for q_detail in psychometric_question_details_kb:
-                    field_id = q_detail.get('currentCycleFieldId') # These are generic like field_794
-                    if not field_id: continue
-                    raw_score = object29_data.get(field_id) # Or field_id + "_raw" depending on Knack field type
-                    if raw_score is None and field_id.startswith("field_"):
-                        score_obj = object29_data.get(field_id + '_raw')
-                        if isinstance(score_obj, dict):
-                            raw_score = score_obj.get('value') 
-                        elif score_obj is not None:
-                            raw_score = score_obj
-                    
-                    try:
-                        score = int(raw_score)
-                        all_scored_statements.append({
-                            "text": q_detail.get('questionText', 'Unknown Question'), # Changed key to 'text'
-                            "score": score,
-                            "category": q_detail.get('vespaCategory', 'N/A')
-                        })
-                    except (ValueError, TypeError):
-                        app.logger.debug(f"Could not parse score '{raw_score}' for {field_id} in Object_29.")
+            app.logger.warning("Cannot fetch school-wide VESPA averages as school_id is unknown.")
+    else:
+        app.logger.warning("No Object_10 data for student %s (Email: %s)", student_name_from_obj3, student_email)
+        # Populate with N/A or defaults if Object_10 is missing
+        vespa_scores_for_profile = {element: {"score_1_to_10": "N/A", "score_profile_text": "N/A"} for element, _ in VESPA_SCORE_FIELDS}
+        student_reflections = {"rrc_comment": "Not available", "goal": "Not available"}
+
+    # 3. Fetch Questionnaire Data (Object_29)
+    all_scored_statements = []
+    object29_highlights_top_bottom = {"top_3": [], "bottom_3": []}
+    if object10_data and current_cycle > 0 and psychometric_question_details_kb:
+        object29_data = get_student_object29_questionnaire_data(object10_data.get('id'), current_cycle)
+        if object29_data:
+            # Local aliases for the per-question loop (~30 questions per request)
+            o29_get = object29_data.get
+            add_statement = all_scored_statements.append
+            log_debug = app.logger.debug
+            for field_id, raw_field_id, question_text, vespa_category in PSYCHOMETRIC_SCORE_FIELDS:
+                raw_score = o29_get(field_id) # Or field_id + "_raw" depending on Knack field type
+                if raw_score is None and raw_field_id:
+                    score_obj = o29_get(raw_field_id)
+                    if isinstance(score_obj, dict):
+                        raw_score = score_obj.get('value') 
+                    elif score_obj is not None:
+                        raw_score = score_obj
                 
-                if all_scored_statements:
-                    all_scored_statements.sort(key=lambda x: x["score"])
-                    object29_highlights_top_bottom["bottom_3"] = all_scored_statements[:3]
-                    object29_highlights_top_bottom["top_3"] = all_scored_statements[-3:][::-1]
-            else:
-                 app.logger.warning(f"No Object_29 data retrieved for student {student_name_from_obj3}, cycle {current_cycle}")       
-        elif not psychometric_question_details_kb:
-            app.logger.error("Psychometric Question Details KB not loaded. Cannot process Object_29.")
-
-        # 4. Fetch Academic Profile (Object_112)
-        academic_summary = []
-        academic_megs = {}
-        prior_attainment_score = None
-        object112_profile_record_data = None # To store the whole Object_112 record
+                try:
+                    score = int(raw_score)
+                    add_statement({
+                        "text": question_text, # Changed key to 'text'
+                        "score": score,
+                        "category": vespa_category
+                    })
+                except (ValueError, TypeError):
+                    log_debug("Could not parse score %r for %s in Object_29.", raw_score, field_id)
+            
+            if all_scored_statements:
+                # Only six statements are needed, so select them instead of sorting everything. Ties keep the
+                # order the full sort gave: earliest questions first in bottom_3, latest first in top_3.
+                score_key = itemgetter("score")
+                object29_highlights_top_bottom["bottom_3"] = heapq.nsmallest(3, all_scored_statements, key=score_key)
+                object29_highlights_top_bottom["top_3"] = heapq.nlargest(3, reversed(all_scored_statements), key=score_key)
+        else:
+             app.logger.warning("No Object_29 data retrieved for student %s, cycle %s", student_name_from_obj3, current_cycle)       
+    elif not psychometric_question_details_kb:
+        app.logger.error("Psychometric Question Details KB not loaded. Cannot process Object_29.")
+
+    if school_averages_future is not None:
+        school_vespa_averages = school_averages_future.result()
+        if school_vespa_averages:
+            app.logger.info("Successfully retrieved school-wide VESPA averages for school %s: %s", school_id, school_vespa_averages)
+        else:
+            app.logger.warning("Failed to retrieve school-wide VESPA averages for school %s.", school_id)
+
+    # 4. Fetch Academic Profile (Object_112)
+    academic_summary = []
+    academic_megs = {}
+    prior_attainment_score = None
+    object112_profile_record_data = None # To store the whole Object_112 record
+    
+    # Collect the get_academic_profile call started after Object_3 (app.logger was passed as app_logger_instance)
+    academic_profile_response = academic_profile_future.result()
+    
+    if academic_profile_response:
+        academic_summary = academic_profile_response.get("subjects", [])
+        object112_profile_record_data = academic_profile_response.get("profile_record")
+
+    if object112_profile_record_data: # Check if the record itself was found
+        app.logger.info("Fetched Object_112 data for student: %s (Name in Obj112)", object112_profile_record_data.get('field_3066'))
         
-        # Call the new get_academic_profile function
-        # Pass app.logger as the app_logger_instance argument
-        academic_profile_response = get_academic_profile(student_object3_id, student_name_from_obj3, app.logger)
+        # Get prior attainment score (field_3272 from tutorapp.py)
+        # Ensure robust checking for _raw and direct field, and convert to float
+        prior_attainment_val = None
+        raw_pa = object112_profile_record_data.get('field_3272_raw')
+        direct_pa = object112_profile_record_data.get('field_3272')
+
+        if isinstance(raw_pa, (str, int, float)) and str(raw_pa).strip() != '':
+            try: prior_attainment_val = float(raw_pa)
+            except (ValueError, TypeError): pass
         
-        if academic_profile_response:
-            academic_summary = academic_profile_response.get("subjects", [])
-            object112_profile_record_data = academic_profile_response.get("profile_record")
+        if prior_attainment_val is None and isinstance(direct_pa, (str, int, float)) and str(direct_pa).strip() != '':
+            try: prior_attainment_val = float(direct_pa)
+            except (ValueError, TypeError): pass
 
-        if object112_profile_record_data: # Check if the record itself was found
-            app.logger.info(f"Fetched Object_112 data for student: {object112_profile_record_data.get('field_3066')} (Name in Obj112)")
-            
-            # Get prior attainment score (field_3272 from tutorapp.py)
-            # Ensure robust checking for _raw and direct field, and convert to float
-            prior_attainment_val = None
-            raw_pa = object112_profile_record_data.get('field_3272_raw')
-            direct_pa = object112_profile_record_data.get('field_3272')
-
-            if isinstance(raw_pa, (str, int, float)) and str(raw_pa).strip() != '':
-                try: prior_attainment_val = float(raw_pa)
-                except (ValueError, TypeError): pass
+        if prior_attainment_val is not None:
+            prior_attainment_score = prior_attainment_val
+            app.logger.info("Prior attainment score: %s", prior_attainment_score)
+        else:
+            app.logger.warning("Could not parse prior attainment score from field_3272/field_3272_raw in Object_112. Raw: '%s', Direct: '%s'.", raw_pa, direct_pa)
+        
+        # Calculate overall MEGs if prior attainment is available
+        if prior_attainment_score is not None:
+            academic_megs["prior_attainment_score"] = prior_attainment_score
             
-            if prior_attainment_val is None and isinstance(direct_pa, (str, int, float)) and str(direct_pa).strip() != '':
-                try: prior_attainment_val = float(direct_pa)
-                except (ValueError, TypeError): pass
+            for percentile, label_suffix in [(60, "60th"), (75, "75th"), (90, "90th"), (100, "100th")]:
+                meg_grade, meg_points = get_meg_for_prior_attainment(prior_attainment_score, "A Level", percentile)
+                # Ensure meg_grade is not None before trying to use it, and meg_points is not None
+                academic_megs[f"aLevel_meg_grade_{label_suffix}"] = meg_grade if meg_grade is not None else "N/A"
+                academic_megs[f"aLevel_meg_points_{label_suffix}"] = meg_points if meg_points is not None else 0
+        
+        # The academic_summary list should now be populated by parse_subjects_from_profile_record 
+        # which is called inside the new get_academic_profile. We then need to iterate it here to add points and MEGs.
+        # The old logic for iterating field_3080 etc. is now inside parse_subjects_from_profile_record.
+        # We now need to process the `academic_summary` list that came from `get_academic_profile`
+        # to add points and detailed MEGs per subject.
+
+        processed_academic_summary = []
+        if isinstance(academic_summary, list):
+            for subject_entry in academic_summary:
+                if isinstance(subject_entry, dict) and subject_entry.get("subject") and not subject_entry["subject"].startswith("Academic profile not found") and not subject_entry["subject"].startswith("No academic subjects parsed") :
+                    exam_type = subject_entry.get("examType", "A Level")
+                    norm_qual = normalize_qualification_type(exam_type)
+                    current_grade = subject_entry.get("currentGrade", "N/A")
+                    
+                    current_points = get_points(current_grade, norm_qual) if current_grade != 'N/A' else 0
+                    
+                    standard_meg_grade, standard_meg_points_val = "N/A", 0
+                    if prior_attainment_score is not None:
+                        # Get details for MEG lookup if needed (e.g. BTEC year/size)
+                        qual_details_for_meg = extract_qual_details(exam_type, norm_qual, app.logger)
+                        # The get_meg_for_prior_attainment in tutorapp also takes qual_details. We might need to adapt it or this call.
+                        # For now, assuming the student version of get_meg_for_prior_attainment primarily uses percentile for A-Level
+                        # and might need future enhancement for detailed non-Alevel MEG lookup based on qual_details.
+                        standard_meg_grade, standard_meg_points_val = get_meg_for_prior_attainment(prior_attainment_score, norm_qual, 75) # Default 75th for standard
+                    
+                    # Build the processed entry in one literal (keys in a fixed order) rather than
+                    # growing a copy of the cached subject dict key by key.
+                    processed_entry = {
+                        **subject_entry,
+                        'normalized_qualification_type': norm_qual,
+                        'currentGradePoints': current_points,
+                        'standard_meg': standard_meg_grade if standard_meg_grade is not None else "N/A",
+                        'standardMegPoints': standard_meg_points_val if standard_meg_points_val is not None else 0,
+                    }
+                    
+                    if norm_qual == "A Level" and prior_attainment_score is not None:
+                        for percentile in (60, 90, 100): # 75th is already standard_meg
+                            meg_grade_p, meg_points_p = get_meg_for_prior_attainment(prior_attainment_score, norm_qual, percentile)
+                            if meg_points_p is not None:
+                                processed_entry[f"megPoints{percentile}"] = meg_points_p
+                    processed_academic_summary.append(processed_entry)
+                else: # if subject entry is not valid, still add it to maintain list structure if it was a placeholder
+                    processed_academic_summary.append(subject_entry)
+            academic_summary = processed_academic_summary # Replace with the processed list
+
+    else: # if object112_profile_record_data is None (academic profile not found by any method)
+        app.logger.warning("No Object_112 data for student %s. Academic summary will be default.", student_name_from_obj3)
+        # academic_summary will be the default from get_academic_profile e.g. [{"subject": "Academic profile not found..."}]
+        # Ensure it's a list for consistency
+        if not isinstance(academic_summary, list) or not academic_summary: # Ensure academic_summary is the default list if record was None
+            academic_summary = [{"subject": "Academic profile not found by any method.", "currentGrade": "N/A", "targetGrade": "N/A", "effortGrade": "N/A", "examType": "N/A"}]
+
+
+    # Generate LLM insights
+    # Ensure all necessary data for the LLM is included in this dictionary
+    llm_data_for_insights = {
+        "student_name": student_name_from_obj3,
+        "student_level": student_level_raw, # Use the raw value from field_568
+        "current_cycle": current_cycle,
+        "vespa_profile": vespa_scores_for_profile, # This should be the dict with score_1_to_10 and score_profile_text
+        "school_vespa_averages": school_vespa_averages, # Add school averages
+        "academic_profile_summary": academic_summary, # List of subject dicts
+        "academic_megs": academic_megs, # Dict of overall MEGs
+        "student_reflections_and_goals": student_reflections,
+        "object29_question_highlights": object29_highlights_top_bottom, # Dict with top_3 and bottom_3 lists
+        "all_scored_questionnaire_statements": all_scored_statements # List of all scored statements for distribution calculation
+    }
 
-            if prior_attainment_val is not None:
-                prior_attainment_score = prior_attainment_val
-                app.logger.info(f"Prior attainment score: {prior_attainment_score}")
-            else:
-                app.logger.warning(f"Could not parse prior attainment score from field_3272/field_3272_raw in Object_112. Raw: '{raw_pa}', Direct: '{direct_pa}'.")
-            
-            # Calculate overall MEGs if prior attainment is available
-            if prior_attainment_score is not None:
-                academic_megs["prior_attainment_score"] = prior_attainment_score
-                
-                for percentile, label_suffix in [(60, "60th"), (75, "75th"), (90, "90th"), (100, "100th")]:
-                    meg_grade, meg_points = get_meg_for_prior_attainment(prior_attainment_score, "A Level", percentile)
-                    # Ensure meg_grade is not None before trying to use it, and meg_points is not None
-                    academic_megs[f"aLevel_meg_grade_{label_suffix}"] = meg_grade if meg_grade is not None else "N/A"
-                    academic_megs[f"aLevel_meg_points_{label_suffix}"] = meg_points if meg_points is not None else 0
+    return None, {
+        "student_email": student_email,
+        "object10_data": object10_data,
+        "llm_data_for_insights": llm_data_for_insights,
+    }
+
+def _fallback_student_insights(student_name):
+    "Generic insights shown if the LLM returned nothing at all."
+    return {
+        "student_overview_summary": f"Welcome {student_name}! Your VESPA profile shows unique strengths and opportunities for growth. Let's explore them together.",
+        "chart_comparative_insights": "Your VESPA scores show your current learning approach. Compare them with the school average to see where you stand.",
+        "questionnaire_interpretation_and_reflection_summary": "Your questionnaire responses reveal important insights about your learning mindset and habits.",
+        "academic_benchmark_analysis": "Your grades show your current performance. The MEG benchmarks indicate what's possible with focused effort.",
+        "suggested_student_goals": [
+            "Focus on improving your lowest VESPA score this week",
+            "Set a specific study goal for your most challenging subject",
+            "Track your progress daily using a simple journal"
+        ]
+    }
+
+def _student_coaching_response_data(llm_data_for_insights, llm_insights):
+    "The student_coaching_data response body: the gathered student data plus the LLM insights."
+    return {
+        "student_name": llm_data_for_insights["student_name"],
+        "student_level": llm_data_for_insights["student_level"], # Send raw level to frontend
+        "current_cycle": llm_data_for_insights["current_cycle"],
+        "vespa_profile": llm_data_for_insights["vespa_profile"],
+        "academic_profile_summary": llm_data_for_insights["academic_profile_summary"],
+        "academic_megs": llm_data_for_insights["academic_megs"],
+        "student_reflections_and_goals": llm_data_for_insights["student_reflections_and_goals"],
+        "object29_question_highlights": llm_data_for_insights["object29_question_highlights"],
+        "llm_generated_insights": llm_insights, 
+        "all_scored_questionnaire_statements": llm_data_for_insights["all_scored_questionnaire_statements"],
+        "school_vespa_averages": llm_data_for_insights["school_vespa_averages"]
+    }
+
+# Knack writes the response doesn't depend on (like saving the overview) run here, off the request thread.
+# Threads start on first use, i.e. in the gunicorn workers rather than the preloading master.
+KNACK_WRITE_POOL = ThreadPoolExecutor(max_workers=4)
+
+def _save_overview_summary_to_object10(llm_insights, object10_data, student_email):
+    "Saves the LLM student_overview_summary to Object_10 field_3289 unless it is an error or placeholder."
+    # --- NEW: Save student_overview_summary to Object_10, field_3289 ---
+    if llm_insights and isinstance(llm_insights, dict) and object10_data and object10_data.get('id'):
+        student_overview_summary_for_knack = llm_insights.get('student_overview_summary')
+        if student_overview_summary_for_knack and isinstance(student_overview_summary_for_knack, str) and \
+           not student_overview_summary_for_knack.lower().startswith("error:") and \
+           not student_overview_summary_for_knack.lower().startswith("ai insights for") and \
+           not student_overview_summary_for_knack.lower().startswith("an unexpected error") and \
+           not student_overview_summary_for_knack.lower().startswith("welcome") and \
+           student_overview_summary_for_knack.strip() != "": # Check for non-empty, non-generic summaries
             
-            # The academic_summary list should now be populated by parse_subjects_from_profile_record 
-            # which is called inside the new get_academic_profile. We then need to iterate it here to add points and MEGs.
-            # The old logic for iterating field_3080 etc. is now inside parse_subjects_from_profile_record.
-            # We now need to process the `academic_summary` list that came from `get_academic_profile`
-            # to add points and detailed MEGs per subject.
-
-            processed_academic_summary = []
-            if isinstance(academic_summary, list):
-                for subject_entry in academic_summary:
-                    if isinstance(subject_entry, dict) and subject_entry.get("subject") and not subject_entry["subject"].startswith("Academic profile not found") and not subject_entry["subject"].startswith("No academic subjects parsed") :
-                        exam_type = subject_entry.get("examType", "A Level")
-                        norm_qual = normalize_qualification_type(exam_type)
-                        current_grade = subject_entry.get("currentGrade", "N/A")
-                        
-                        current_points = get_points(current_grade, norm_qual) if current_grade != 'N/A' else 0
-                        subject_entry['normalized_qualification_type'] = norm_qual
-                        subject_entry['currentGradePoints'] = current_points
-                        
-                        standard_meg_grade, standard_meg_points_val = "N/A", 0
-                        if prior_attainment_score is not None:
-                            # Get details for MEG lookup if needed (e.g. BTEC year/size)
-                            qual_details_for_meg = extract_qual_details(exam_type, norm_qual, app.logger)
-                            # The get_meg_for_prior_attainment in tutorapp also takes qual_details. We might need to adapt it or this call.
-                            # For now, assuming the student version of get_meg_for_prior_attainment primarily uses percentile for A-Level
-                            # and might need future enhancement for detailed non-Alevel MEG lookup based on qual_details.
-                            standard_meg_grade, standard_meg_points_val = get_meg_for_prior_attainment(prior_attainment_score, norm_qual, 75) # Default 75th for standard
-                        
-                        subject_entry['standard_meg'] = standard_meg_grade if standard_meg_grade is not None else "N/A"
-                        subject_entry['standardMegPoints'] = standard_meg_points_val if standard_meg_points_val is not None else 0
-                        
-                        if norm_qual == "A Level" and prior_attainment_score is not None:
-                            for percentile in [60, 90, 100]: # 75th is already standard_meg
-                                meg_grade_p, meg_points_p = get_meg_for_prior_attainment(prior_attainment_score, norm_qual, percentile)
-                                if meg_points_p is not None:
-                                    subject_entry[f"megPoints{percentile}"] = meg_points_p
-                        processed_academic_summary.append(subject_entry)
-                    else: # if subject entry is not valid, still add it to maintain list structure if it was a placeholder
-                        processed_academic_summary.append(subject_entry)
-                academic_summary = processed_academic_summary # Replace with the processed list
-
-        else: # if object112_profile_record_data is None (academic profile not found by any method)
-            app.logger.warning(f"No Object_112 data for student {student_name_from_obj3}. Academic summary will be default.")
-            # academic_summary will be the default from get_academic_profile e.g. [{"subject": "Academic profile not found..."}]
-            # Ensure it's a list for consistency
-            if not isinstance(academic_summary, list) or not academic_summary: # Ensure academic_summary is the default list if record was None
-                academic_summary = [{"subject": "Academic profile not found by any method.", "currentGrade": "N/A", "targetGrade": "N/A", "effortGrade": "N/A", "examType": "N/A"}]
-
-
-        # Generate LLM insights
-        # Ensure all necessary data for the LLM is included in this dictionary
-        llm_data_for_insights = {
-            "student_name": student_name_from_obj3,
-            "student_level": student_level_raw, # Use the raw value from field_568
-            "current_cycle": current_cycle,
-            "vespa_profile": vespa_scores_for_profile, # This should be the dict with score_1_to_10 and score_profile_text
-            "school_vespa_averages": school_vespa_averages, # Add school averages
-            "academic_profile_summary": academic_summary, # List of subject dicts
-            "academic_megs": academic_megs, # Dict of overall MEGs
-            "student_reflections_and_goals": student_reflections,
-            "object29_question_highlights": object29_highlights_top_bottom, # Dict with top_3 and bottom_3 lists
-            "all_scored_questionnaire_statements": all_scored_statements # List of all scored statements for distribution calculation
-        }
+            object10_record_id_to_update = object10_data.get('id')
+            payload_to_update_obj10 = {
+                "field_3289": student_overview_summary_for_knack[:10000] # Knack paragraph text limit
+            }
+            # Insights served from LLM_INSIGHTS_CACHE repeat the summary already saved on an earlier load
+            stored_summary = object10_data.get('field_3289_raw', object10_data.get('field_3289'))
+            if stored_summary == payload_to_update_obj10["field_3289"]:
+                app.logger.info("field_3289 for Object_10 record %s already holds this summary; skipping update.", object10_record_id_to_update)
+                return
+            update_url_obj10 = f"{KNACK_API_BASE_URL}/object_10/records/{object10_record_id_to_update}"
+            try:
+                app.logger.info("Attempting to update Object_10 record %s with student chat summary for field_3289. Summary (first 100 chars): '%.100s...'", object10_record_id_to_update, student_overview_summary_for_knack)
+                update_response = KNACK_SESSION.put(update_url_obj10, json=payload_to_update_obj10, timeout=KNACK_REQUEST_TIMEOUT)
+                update_response.raise_for_status()
+                app.logger.info("Successfully updated field_3289 for Object_10 record %s.", object10_record_id_to_update)
+                STUDENT_RECORD_CACHE.pop(("get_student_object10_record", student_email))
+                invalidate_knack_cache("object_10")
+            except requests.exceptions.HTTPError as e_http_obj10:
+                app.logger.error("HTTP error updating field_3289 for Object_10 %s: %s. Response: %s", object10_record_id_to_update, e_http_obj10, e_http_obj10.response.content if e_http_obj10.response is not None else 'N/A')
+            except requests.exceptions.RequestException as e_req_obj10:
+                app.logger.error("Request exception updating field_3289 for Object_10 %s: %s", object10_record_id_to_update, e_req_obj10)
+            except Exception as e_gen_obj10:
+                app.logger.error("General error updating field_3289 for Object_10 %s: %s", object10_record_id_to_update, e_gen_obj10)
+        else:
+            app.logger.info("Skipping update of field_3289 for Object_10 as LLM student_overview_summary was an error, placeholder, or empty: '%s'", student_overview_summary_for_knack)
+    else:
+        app.logger.warning("Could not update field_3289 for Object_10 as llm_insights or object10_data (with ID) was missing/invalid.")
+
+@app.route('/api/v1/student_coaching_data', methods=['POST', 'OPTIONS'])
+def student_coaching_data():
+    app.logger.info("Received request for /api/v1/student_coaching_data. Method: %s", request.method)
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            app.logger.error("student_coaching_data request body is not a JSON object.")
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        if request.args.get('mode') == 'batch': # Operator-only bulk runs, at half the OpenAI cost
+            if not _has_admin_token():
+                app.logger.warning("Rejected student_coaching_data?mode=batch request without a valid admin token.")
+                return jsonify({"error": "Forbidden"}), 403
+            if data.get('batch_id') is not None:
+                return _collect_student_coaching_batch(data.get('batch_id'))
+            return _submit_student_coaching_batch(data.get('student_object3_ids'))
+        student_object3_ids = data.get('student_object3_ids')
+        if student_object3_ids is not None:
+            return _student_coaching_data_for_group(student_object3_ids)
+        student_object3_id = data.get('student_object3_id')
+        if not student_object3_id:
+            app.logger.error("Missing 'student_object3_id' in request.")
+            return jsonify({"error": "Missing student_object3_id"}), 400
+
+        error_response, coaching_context = _prepare_student_coaching_data(student_object3_id)
+        if error_response is not None:
+            return error_response
+        student_email = coaching_context["student_email"]
+        object10_data = coaching_context["object10_data"]
+        llm_data_for_insights = coaching_context["llm_data_for_insights"]
+        student_name_from_obj3 = llm_data_for_insights["student_name"]
         
         # Pass app.logger to the LLM function
         llm_insights = generate_student_insights_with_llm(llm_data_for_insights, app.logger)
         
         # Use LLM insights if available, otherwise fall back to placeholders
         if not llm_insights:
-            llm_insights = {
-                "student_overview_summary": f"Welcome {student_name_from_obj3}! Your VESPA profile shows unique strengths and opportunities for growth. Let's explore them together.",
-                "chart_comparative_insights": "Your VESPA scores show your current learning approach. Compare them with the school average to see where you stand.",
-                "questionnaire_interpretation_and_reflection_summary": "Your questionnaire responses reveal important insights about your learning mindset and habits.",
-                "academic_benchmark_analysis": "Your grades show your current performance. The MEG benchmarks indicate what's possible with focused effort.",
-                "suggested_student_goals": [
-                    "Focus on improving your lowest VESPA score this week",
-                    "Set a specific study goal for your most challenging subject",
-                    "Track your progress daily using a simple journal"
-                ]
-            }
+            llm_insights = _fallback_student_insights(student_name_from_obj3)
 
-        final_response = {
-            "student_name": student_name_from_obj3,
-            "student_level": student_level_raw, # Send raw level to frontend
-            "current_cycle": current_cycle,
-            "vespa_profile": vespa_scores_for_profile,
-            "academic_profile_summary": academic_summary,
-            "academic_megs": academic_megs,
-            "student_reflections_and_goals": student_reflections,
-            "object29_question_highlights": object29_highlights_top_bottom,
-            "llm_generated_insights": llm_insights, 
-            "all_scored_questionnaire_statements": all_scored_statements,
-            "school_vespa_averages": school_vespa_averages
-        }
+        final_response = _student_coaching_response_data(llm_data_for_insights, llm_insights)
 
-        # --- NEW: Save student_overview_summary to Object_10, field_3289 ---
-        if llm_insights and isinstance(llm_insights, dict) and object10_data and object10_data.get('id'):
-            student_overview_summary_for_knack = llm_insights.get('student_overview_summary')
-            if student_overview_summary_for_knack and isinstance(student_overview_summary_for_knack, str) and \
-               not student_overview_summary_for_knack.lower().startswith("error:") and \
-               not student_overview_summary_for_knack.lower().startswith("ai insights for") and \
-               not student_overview_summary_for_knack.lower().startswith("an unexpected error") and \
-               not student_overview_summary_for_knack.lower().startswith("welcome") and \
-               student_overview_summary_for_knack.strip() != "": # Check for non-empty, non-generic summaries
-                
-                object10_record_id_to_update = object10_data.get('id')
-                payload_to_update_obj10 = {
-                    "field_3289": student_overview_summary_for_knack[:10000] # Knack paragraph text limit
-                }
-                headers_knack_update = {
-                    'X-Knack-Application-Id': KNACK_APP_ID,
-                    'X-Knack-REST-API-Key': KNACK_API_KEY,
-                    'Content-Type': 'application/json'
-                }
-                update_url_obj10 = f"{KNACK_API_BASE_URL}/object_10/records/{object10_record_id_to_update}"
-                try:
-                    app.logger.info(f"Attempting to update Object_10 record {object10_record_id_to_update} with student chat summary for field_3289. Summary (first 100 chars): '{student_overview_summary_for_knack[:100]}...'")
-                    update_response = requests.put(update_url_obj10, headers=headers_knack_update, json=payload_to_update_obj10)
-                    update_response.raise_for_status()
-                    app.logger.info(f"Successfully updated field_3289 for Object_10 record {object10_record_id_to_update}.")
-                except requests.exceptions.HTTPError as e_http_obj10:
-                    app.logger.error(f"HTTP error updating field_3289 for Object_10 {object10_record_id_to_update}: {e_http_obj10}. Response: {update_response.content if 'update_response' in locals() and update_response else 'N/A'}")
-                except requests.exceptions.RequestException as e_req_obj10:
-                    app.logger.error(f"Request exception updating field_3289 for Object_10 {object10_record_id_to_update}: {e_req_obj10}")
-                except Exception as e_gen_obj10:
-                    app.logger.error(f"General error updating field_3289 for Object_10 {object10_record_id_to_update}: {e_gen_obj10}")
-            else:
-                app.logger.info(f"Skipping update of field_3289 for Object_10 as LLM student_overview_summary was an error, placeholder, or empty: '{student_overview_summary_for_knack}'")
-        else:
-            app.logger.warning("Could not update field_3289 for Object_10 as llm_insights or object10_data (with ID) was missing/invalid.")
+        KNACK_WRITE_POOL.submit(_save_overview_summary_to_object10, llm_insights, object10_data, student_email)
 
         return jsonify(final_response), 200
 
+def _validated_student_object3_ids(student_object3_ids, max_count):
+    """Checks a `student_object3_ids` request field. Returns (error_response, None) or (None, the IDs de-duplicated)."""
+    if not isinstance(student_object3_ids, list) or not student_object3_ids or not all(isinstance(student_id, str) and student_id for student_id in student_object3_ids):
+        app.logger.error("'student_object3_ids' must be a non-empty list of Object_3 IDs.")
+        return (jsonify({"error": "student_object3_ids must be a non-empty list of IDs"}), 400), None
+    student_object3_ids = list(dict.fromkeys(student_object3_ids))
+    if len(student_object3_ids) > max_count:
+        app.logger.error("'student_object3_ids' has %s IDs; at most %s are allowed per request.", len(student_object3_ids), max_count)
+        return (jsonify({"error": f"student_object3_ids may contain at most {max_count} IDs"}), 400), None
+    return None, student_object3_ids
+
+def _prepare_student_coaching_group(student_object3_ids, deadline=None):
+    """Runs _prepare_student_coaching_data for several students at once; returns {id: context} for those that loaded.
+    Students still loading at `deadline` (a time.monotonic() value, if given) are left out."""
+    app.logger.info("Processing student coaching data for %s students.", len(student_object3_ids))
+
+    def prepare(student_id):
+        with app.app_context(): # The error path builds a jsonify response
+            return _prepare_student_coaching_data(student_id)
+    executor = ThreadPoolExecutor(max_workers=min(INSIGHTS_BATCH_WORKERS, len(student_object3_ids)))
+    futures = {student_id: executor.submit(prepare, student_id) for student_id in student_object3_ids}
+    done, not_done = wait(futures.values(), timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+    executor.shutdown(wait=False, cancel_futures=True) # Loads still running finish in the background
+    if not_done:
+        app.logger.warning("%s of %s students were still loading at the request deadline.", len(not_done), len(student_object3_ids))
+    prepared = {student_id: future.result() for student_id, future in futures.items() if future in done}
+    return {student_id: context for student_id, (error_response, context) in prepared.items() if error_response is None}
+
+def _student_coaching_data_for_group(student_object3_ids):
+    """student_coaching_data for a class view: `student_object3_ids` in, `{"students": {id: response body}}` out.
+    Students that can't be loaded get `{"error": ...}` in place of their body."""
+    deadline = time.monotonic() + STUDENT_GROUP_DEADLINE_SECONDS
+    error_response, student_object3_ids = _validated_student_object3_ids(student_object3_ids, STUDENT_GROUP_MAX)
+    if error_response is not None:
+        return error_response
+    coaching_contexts = _prepare_student_coaching_group(student_object3_ids, deadline)
+
+    llm_insights_by_id = generate_insights_for_student_ids(
+        {student_id: context["llm_data_for_insights"] for student_id, context in coaching_contexts.items()}, app.logger, deadline)
+
+    students = {}
+    for student_id in student_object3_ids:
+        coaching_context = coaching_contexts.get(student_id)
+        if coaching_context is None:
+            students[student_id] = {"error": f"Could not retrieve user details for {student_id}"}
+            continue
+        llm_data_for_insights = coaching_context["llm_data_for_insights"]
+        llm_insights = llm_insights_by_id.get(student_id) or _fallback_student_insights(llm_data_for_insights["student_name"])
+        students[student_id] = _student_coaching_response_data(llm_data_for_insights, llm_insights)
+        KNACK_WRITE_POOL.submit(_save_overview_summary_to_object10, llm_insights, coaching_context["object10_data"], coaching_context["student_email"])
+
+    return jsonify({"students": students}), 200
+
+def _submit_student_coaching_batch(student_object3_ids):
+    """student_coaching_data?mode=batch with `student_object3_ids`: loads each student and queues their insights on
+    the OpenAI Batch API (see submit_student_insights_batch). Responds 202 with the `batch_id` to collect later;
+    students that couldn't be loaded are listed under "failed"."""
+    error_response, student_object3_ids = _validated_student_object3_ids(student_object3_ids, INSIGHTS_BATCH_STUDENT_MAX)
+    if error_response is not None:
+        return error_response
+    coaching_contexts = _prepare_student_coaching_group(student_object3_ids)
+    failed_ids = [student_id for student_id in student_object3_ids if student_id not in coaching_contexts]
+    if not coaching_contexts:
+        return jsonify({"error": "None of the students could be loaded", "failed": failed_ids}), 404
+
+    batch_id = submit_student_insights_batch(
+        {student_id: context["llm_data_for_insights"] for student_id, context in coaching_contexts.items()}, app.logger)
+    if batch_id is None:
+        return jsonify({"error": "Could not submit the insights batch"}), 502
+    return jsonify({"batch_id": batch_id, "submitted": list(coaching_contexts), "failed": failed_ids}), 202
+
+def _collect_student_coaching_batch(batch_id):
+    """student_coaching_data?mode=batch with `batch_id`: `{"batch_id", "students": {id: insights}}` once the batch
+    has finished; 202 with status "in_progress" while it is still running. An unknown batch id gets 404, one
+    OpenAI rejects 400, and any other failure to read the batch 502."""
+    if not isinstance(batch_id, str) or not batch_id:
+        app.logger.error("'batch_id' must be a non-empty string.")
+        return jsonify({"error": "batch_id must be a non-empty string"}), 400
+    try:
+        results = collect_student_insights_batch(batch_id, app.logger)
+    except openai.NotFoundError as e:
+        app.logger.error("Student insights batch %s not found: %s", batch_id, e)
+        return jsonify({"error": f"Unknown batch_id {batch_id}"}), 404
+    except openai.BadRequestError as e:
+        app.logger.error("OpenAI rejected student insights batch id %s: %s", batch_id, e)
+        return jsonify({"error": f"Invalid batch_id {batch_id}"}), 400
+    except Exception as e:
+        app.logger.error("Failed to collect student insights batch %s: %s", batch_id, e)
+        return jsonify({"error": "Could not retrieve the insights batch"}), 502
+    if results is None:
+        return jsonify({"batch_id": batch_id, "status": "in_progress"}), 202
+    return jsonify({"batch_id": batch_id, "students": results}), 200
+
+@app.route('/api/v1/student_coaching_data_stream', methods=['POST', 'OPTIONS'])
+def student_coaching_data_stream():
+    """Streaming variant of student_coaching_data.
+
+    Sends the Knack/KB data as one `{"student_data": {...}}` SSE event straight away so the dashboard can
+    render, then `{"insight": {key: value}}` as each LLM insight completes, and finally
+    `{"done": true, "llm_generated_insights": {...}}` (the overview is saved to field_3289 in the background).
+    While a text insight such as the overview is still being written, `{"insight_partial": {key: text so far}}`
+    events carry its growing text; each replaces the previous one and the `insight` event is authoritative.
+    """
+    app.logger.info("Received request for /api/v1/student_coaching_data_stream. Method: %s", request.method)
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+
+    data = request.get_json(silent=True) or {}
+    student_object3_id = data.get('student_object3_id')
+    if not student_object3_id:
+        app.logger.error("Missing 'student_object3_id' in request.")
+        return jsonify({"error": "Missing student_object3_id"}), 400
+
+    error_response, coaching_context = _prepare_student_coaching_data(student_object3_id)
+    if error_response is not None:
+        return error_response
+    llm_data_for_insights = coaching_context["llm_data_for_insights"]
+
+    def generate():
+        yield _sse_event({"student_data": _student_coaching_response_data(llm_data_for_insights, None)})
+        llm_insights = {}
+        for key, value, complete in stream_student_insights_with_llm(llm_data_for_insights, app.logger):
+            if not complete:
+                yield _sse_event({"insight_partial": {key: value}})
+                continue
+            llm_insights[key] = value
+            yield _sse_event({"insight": {key: value}})
+        if not llm_insights:
+            llm_insights = _fallback_student_insights(llm_data_for_insights["student_name"])
+        KNACK_WRITE_POOL.submit(_save_overview_summary_to_object10, llm_insights, coaching_context["object10_data"], coaching_context["student_email"])
+        yield _sse_event({"done": True, "llm_generated_insights": llm_insights})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 # --- Helper function to determine student's educational level for coaching KBs ---
 def get_student_educational_level(student_level_raw):
     """
@@ -1418,435 +2416,455 @@ def get_student_educational_level(student_level_raw):
     """
     if not student_level_raw or student_level_raw == "N/A":
         return "Level 3" # Default if unknown
+    # field_568 only takes a handful of values, and the raw value may be a list, so cache on its string form
+    return _educational_level_for(str(student_level_raw))
+
+# Substrings of a lower-cased field_568 value that identify each coaching KB level, Level 3 checked first
+_LEVEL_3_KEYWORDS = ("year 12", "year 13", "a-level", "level 3", "l3", "sixth form", "a level") # A-Level, Year 12, Year 13, L3, etc.
+_LEVEL_2_KEYWORDS = ("year 10", "year 11", "gcse", "level 2", "l2") # GCSE, Year 10, Year 11, L2, etc.
+_LEVEL_3_RE = re.compile("|".join(map(re.escape, _LEVEL_3_KEYWORDS)))
+_LEVEL_2_RE = re.compile("|".join(map(re.escape, _LEVEL_2_KEYWORDS)))
+
+@lru_cache(maxsize=256) # The unmapped-level warning is therefore logged once per distinct value
+def _educational_level_for(student_level_str):
+    level_lower = student_level_str.lower()
     
-    level_lower = str(student_level_raw).lower()
-    
-    # Keywords for Level 3 (A-Level, Year 12, Year 13, L3, etc.)
-    if any(kw in level_lower for kw in ["year 12", "year 13", "a-level", "level 3", "l3", "sixth form", "a level"]):
+    if _LEVEL_3_RE.search(level_lower):
         return "Level 3"
-    # Keywords for Level 2 (GCSE, Year 10, Year 11, L2, etc.)
-    elif any(kw in level_lower for kw in ["year 10", "year 11", "gcse", "level 2", "l2"]):
+    elif _LEVEL_2_RE.search(level_lower):
         return "Level 2"
     
-    app.logger.warning(f"Could not map student_level_raw '{student_level_raw}' to 'Level 2' or 'Level 3'. Defaulting to Level 3 for coaching questions.")
+    app.logger.warning("Could not map student_level_raw '%s' to 'Level 2' or 'Level 3'. Defaulting to Level 3 for coaching questions.", student_level_str)
     return "Level 3" # Default
 
 
-@app.route('/api/v1/chat_turn', methods=['POST', 'OPTIONS'])
-def chat_turn():
-    app.logger.info(f"Received request for /api/v1/chat_turn. Method: {request.method}")
-    if request.method == 'OPTIONS':
-        return _build_cors_preflight_response()
+_CHAT_FALLBACK_RESPONSE = "I'm having a little trouble formulating a response right now. Could you try rephrasing your question, or perhaps we can talk about something else?"
+
+# Static chat payloads are serialized once at import instead of per request.
+_AI_NOT_CONFIGURED_CHAT_BODY = json.dumps({"ai_response": "I am currently unable to respond (AI not configured). Your message has been logged."})
+_EMPTY_CHAT_HISTORY_BODY = json.dumps({"chat_history": [], "total_count": 0, "liked_count": 0, "summary": "No chat history found for you yet."})
+
+# Chat query keywords that point at a VESPA element, checked in this order (first element with any match wins)
+_VESPA_ELEMENT_KEYWORDS = {
+    ("vision", "goal", "future", "career", "motivation", "purpose", "direction", "aspiration", "dream", "ambition", "achieve", "aims", "objectives"): "Vision",
+    ("effort", "hard work", "procrastination", "trying", "persevere", "lazy", "energy", "work ethic", "dedication", "commitment"): "Effort",
+    ("systems", "organization", "plan", "notes", "timetable", "deadline", "homework", "complete", "time management", "schedule", "diary", "planner", "organised", "organize", "structure", "routine"): "Systems", # "notes" is a keyword here
+    ("practice", "revision", "revise", "exam prep", "test myself", "study", "memory", "technique", "method", "preparation", "learning", "highlighting", "note-taking", "flashcards", "past papers", "past paper", "exam paper", "mock exam", "question practice", "testing"): "Practice",
+    ("attitude", "mindset", "stress", "pressure", "confidence", "difficult", "anxiety", "worry", "belief", "resilience", "positive", "negative"): "Attitude"
+}
+# One compiled alternation per element, so each element is a single scan of the query instead of one `in` per keyword
+VESPA_ELEMENT_KEYWORD_PATTERNS = tuple(
+    (element_name, re.compile("|".join(map(re.escape, keywords_tuple))))
+    for keywords_tuple, element_name in _VESPA_ELEMENT_KEYWORDS.items()
+)
+
+# Punctuation stripped from a chat message (in one pass) before keyword matching against activities
+_KEYWORD_SEARCH_PUNCTUATION = str.maketrans('', '', '?.,\'"!')
+
+# One academic-profile row of the chat context; rendered in a single format call per subject
+_CHAT_SUBJECT_LINE = " - {subject}: Current={current}, Target={target}{meg}"
+
+# Chat RAG lines for the coaching-question and activity sections; only the bracketed parts vary per turn
+_CHAT_FOCUS_AREA_LINE = "\nStudent wants to focus on an area. Their lowest VESPA element is '{element}' (Profile: '{profile}'). Prioritize questions/activities for this."
+_CHAT_COACHING_QUESTIONS_HEADER = "\n--- Potentially Relevant Coaching Questions for '{element}' (Level: {level}, Profile: {profile}) ---"
+_CHAT_SUGGESTED_ACTIVITIES_HEADER = "\n--- Suggested Activities for '{element}' (If student asks or after more discussion) ---"
+_CHAT_POTENTIAL_ACTIVITIES_HEADER = "\n--- Potential Activities for '{element}' (Available if student expresses need) ---"
+_CHAT_ACTIVITIES_LATER_NOTE = "\n[Coach Note: Relevant activities exist for '{element}'. Consider asking if student wants suggestions later if the conversation heads that way.]"
+_CHAT_ACTIVITY_LINE = "\n- Name: {name}{pdf}.\n  Summary: {summary}"
+_CHAT_FALLBACK_ACTIVITY_LINE = "- Name: {name}{pdf}. Summary: {summary}..."
+_CHAT_ACTIVITY_PDF_NOTE = " (Resource PDF available)"
+
+# Words ignored when matching a chat message against activities by keyword
+_ACTIVITY_SEARCH_STOPWORDS = frozenset({"is", "a", "the", "and", "to", "of", "it", "in", "for", "on", "with", "as", "an", "at", "by", "my", "i", "me", "what", "how", "help", "can", "some", "this", "that", "area", "areas", "score", "scores"})
+# Themes for the activity keyword fallback: if the message mentions any word of a theme, activities score
+# 2 points per theme word in their name/keywords/summary
+_ACTIVITY_CONTEXT_KEYWORDS = {
+    "active_learning": ("flashcard", "test", "quiz", "retrieval", "practice", "leitner", "command verb", "past paper", "exam paper", "mock exam", "question practice", "self-testing", "spaced repetition", "interleaving"),
+    "organization": ("plan", "schedule", "diary", "timetable", "system", "organize", "task management", "prioritization", "notes"), # "notes" added
+    "mindset": ("confidence", "stress", "anxiety", "belief", "attitude", "resilience", "growth mindset", "coping"),
+    "goal_setting": ("goal", "target", "vision", "future", "career", "aspiration", "objective", "plan"),
+}
+
+# Reflection/goal values in the chat context that mean nothing was entered (compared lower-cased)
+_UNSPECIFIED_REFLECTION_VALUES = frozenset(("not specified", "n/a"))
+
+# Substrings marking a chat message as being about revision/note-taking methods
+_REVISION_MARKERS = ("revis", "highlight", "note")
+
+def _prepare_chat_turn(data):
+    """Saves the student's message and builds the LLM messages for one chat turn.
+
+    Returns (error_response, None) if the turn can't go to the LLM, otherwise
+    (None, context) where context holds the student ID, LLM messages and RAG activities.
+    Shared by the buffered and streaming chat endpoints.
+    """
+    student_object3_id = data.get('student_knack_id') 
+    chat_history = data.get('chat_history', []) 
+    current_user_message = data.get('current_user_message')
+    initial_ai_context = data.get('initial_ai_context') # This is the rich student data payload
+    context_type = data.get('context_type', 'student')
+
+    if not student_object3_id or not current_user_message:
+        app.logger.error("chat_turn: Missing student_knack_id (Object_3 ID) or current_user_message.")
+        return (jsonify({"error": "Missing student ID or message"}), 400), None
     
-    if request.method == 'POST':
-        data = request.get_json()
-        app.logger.info(f"Chat turn data received: {str(data)[:500]}...")
-
-        student_object3_id = data.get('student_knack_id') 
-        chat_history = data.get('chat_history', []) 
-        current_user_message = data.get('current_user_message')
-        initial_ai_context = data.get('initial_ai_context') # This is the rich student data payload
-        context_type = data.get('context_type', 'student')
-
-        if not student_object3_id or not current_user_message:
-            app.logger.error("chat_turn: Missing student_knack_id (Object_3 ID) or current_user_message.")
-            return jsonify({"error": "Missing student ID or message"}), 400
+    if not OPENAI_API_KEY:
+        app.logger.error("chat_turn: OpenAI API key not configured.")
+        save_chat_message_to_knack(student_object3_id, "Student", current_user_message)
+        return app.response_class(_AI_NOT_CONFIGURED_CHAT_BODY, status=200, mimetype='application/json'), None
+
+    user_message_saved_id = save_chat_message_to_knack(student_object3_id, "Student", current_user_message)
+    if not user_message_saved_id:
+        app.logger.error(f"chat_turn: Failed to save student's message to Knack for student Object_3 ID {student_object3_id}.")
+
+    student_name_for_chat = "there"
+    student_vespa_profile = {}
+    student_educational_level_kb = "Level 3" # Default
+
+    if initial_ai_context:
+        if initial_ai_context.get('student_name'):
+            student_name_for_chat = initial_ai_context['student_name'].split(' ')[0]
+        student_vespa_profile = initial_ai_context.get('vespa_profile', {}) 
+        student_level_raw_from_context = initial_ai_context.get('student_level', "N/A") 
+        student_educational_level_kb = get_student_educational_level(student_level_raw_from_context)
+        app.logger.info(f"Chat Turn: Student Name: {student_name_for_chat}, Mapped Edu Level for KB: {student_educational_level_kb}")
         
-        if not OPENAI_API_KEY:
-            app.logger.error("chat_turn: OpenAI API key not configured.")
-            save_chat_message_to_knack(student_object3_id, "Student", current_user_message)
-            return jsonify({"ai_response": "I am currently unable to respond (AI not configured). Your message has been logged."}), 200
-
-        user_message_saved_id = save_chat_message_to_knack(student_object3_id, "Student", current_user_message)
-        if not user_message_saved_id:
-            app.logger.error(f"chat_turn: Failed to save student's message to Knack for student Object_3 ID {student_object3_id}.")
-
-        student_name_for_chat = "there"
-        student_vespa_profile = {}
-        student_educational_level_kb = "Level 3" # Default
-
-        if initial_ai_context:
-            if initial_ai_context.get('student_name'):
-                student_name_for_chat = initial_ai_context['student_name'].split(' ')[0]
-            student_vespa_profile = initial_ai_context.get('vespa_profile', {}) 
-            student_level_raw_from_context = initial_ai_context.get('student_level', "N/A") 
-            student_educational_level_kb = get_student_educational_level(student_level_raw_from_context)
-            app.logger.info(f"Chat Turn: Student Name: {student_name_for_chat}, Mapped Edu Level for KB: {student_educational_level_kb}")
-            
-            app.logger.info(f"Initial AI Context Keys Available: {list(initial_ai_context.keys())}")
-            app.logger.info(f"VESPA Profile Data from initial_ai_context: {student_vespa_profile}")
-            if initial_ai_context.get('academic_profile_summary'):
-                app.logger.info(f"Academic Profile Available from initial_ai_context: {len(initial_ai_context['academic_profile_summary'])} subjects")
-            if initial_ai_context.get('object29_question_highlights'):
-                app.logger.info(f"Questionnaire highlights available from initial_ai_context")
-        else:
-            app.logger.warning("No initial_ai_context provided to chat_turn!")
-
-        conversation_depth = len([msg for msg in chat_history if msg.get('role') == 'user'])
-        app.logger.info(f"Conversation depth: {conversation_depth} user messages")
-
-        user_asking_for_activity = any(phrase in current_user_message.lower() for phrase in [
-            "suggest an activity", "recommend an activity", "what activity", "any activities",
-            "activity suggestion", "activity recommendation", "yes please suggest", "yes, suggest"
-        ])
-
-        rag_context_parts = ["--- Context for My VESPA AI Coach ---"]
-        suggested_activities_for_response = []
-        chosen_coaching_questions_for_llm = []
-        inferred_vespa_element_from_query = None
-        relevant_vespa_statements = []
-        relevant_coaching_insights_for_chat = []
+        app.logger.info(f"Initial AI Context Keys Available: {list(initial_ai_context.keys())}")
+        app.logger.info(f"VESPA Profile Data from initial_ai_context: {student_vespa_profile}")
+        if initial_ai_context.get('academic_profile_summary'):
+            app.logger.info(f"Academic Profile Available from initial_ai_context: {len(initial_ai_context['academic_profile_summary'])} subjects")
+        if initial_ai_context.get('object29_question_highlights'):
+            app.logger.info(f"Questionnaire highlights available from initial_ai_context")
+    else:
+        app.logger.warning("No initial_ai_context provided to chat_turn!")
+
+    conversation_depth = len([msg for msg in chat_history if msg.get('role') == 'user'])
+    app.logger.info(f"Conversation depth: {conversation_depth} user messages")
+
+    # Lowercased once for all the keyword matching below; query_words feeds the insight scoring
+    query_lower = current_user_message.lower()
+    query_words = {word for word in query_lower.split() if len(word) > 3}
+    is_revision_query = any(marker in query_lower for marker in _REVISION_MARKERS)
+
+    user_asking_for_activity = any(phrase in query_lower for phrase in [
+        "suggest an activity", "recommend an activity", "what activity", "any activities",
+        "activity suggestion", "activity recommendation", "yes please suggest", "yes, suggest"
+    ])
+
+    rag_context_parts = ["--- Context for My VESPA AI Coach ---"]
+    suggested_activities_for_response = []
+    chosen_coaching_questions_for_llm = []
+    inferred_vespa_element_from_query = None
+    relevant_vespa_statements = []
+    relevant_coaching_insights_for_chat = []
+    
+    # 1. Add student's data summary to RAG from initial_ai_context
+    if initial_ai_context:
+        rag_context_parts.append("\n--- About Me (Student's Data Summary from Initial Context) ---")
+        llm_insights_from_context = initial_ai_context.get('llm_generated_insights', {})
         
-        # 1. Add student's data summary to RAG from initial_ai_context
-        if initial_ai_context:
-            rag_context_parts.append("\n--- About Me (Student's Data Summary from Initial Context) ---")
-            llm_insights_from_context = initial_ai_context.get('llm_generated_insights', {})
-            
-            if llm_insights_from_context.get('student_overview_summary'):
-                rag_context_parts.append(f"My Overall AI Snapshot: {llm_insights_from_context['student_overview_summary']}")
-
-            # Use student_vespa_profile which was already populated from initial_ai_context if available
-            if student_vespa_profile: # This was set earlier from initial_ai_context.get('vespa_profile', {})
-                rag_context_parts.append("\nMy VESPA Scores:")
-                for el, el_data in student_vespa_profile.items():
-                    if el != "Overall" and isinstance(el_data, dict):
-                         rag_context_parts.append(f" - {el}: {el_data.get('score_1_to_10', 'N/A')}/10 (Profile: '{el_data.get('score_profile_text', 'N/A')}')")
-            
-            school_avgs_from_context = initial_ai_context.get('school_vespa_averages')
-            if school_avgs_from_context and student_vespa_profile:
-                rag_context_parts.append("\nHow I Compare to School Averages:")
-                for el, el_data in student_vespa_profile.items():
-                    if el != "Overall" and el in school_avgs_from_context and isinstance(el_data, dict):
-                        my_score = el_data.get('score_1_to_10', 'N/A')
-                        school_avg = school_avgs_from_context.get(el)
-                        if my_score != 'N/A' and school_avg is not None:
-                            try:
-                                diff = float(my_score) - float(school_avg)
-                                if diff > 0: rag_context_parts.append(f" - {el}: I'm {diff:.1f} points above school average")
-                                elif diff < 0: rag_context_parts.append(f" - {el}: I'm {abs(diff):.1f} points below school average")
-                                else: rag_context_parts.append(f" - {el}: I'm at the school average")
-                            except (ValueError, TypeError): pass
-            
-            academic_data_from_context = initial_ai_context.get('academic_profile_summary')
-            if isinstance(academic_data_from_context, list) and academic_data_from_context:
-                rag_context_parts.append("\nMy Academic Profile (first few subjects):")
-                for subject in academic_data_from_context[:3]: 
-                    if isinstance(subject, dict) and subject.get('subject') and subject['subject'] != 'N/A' and not subject['subject'].lower().startswith("academic profile not found"):
-                        subj_text = f" - {subject.get('subject')}: Current={subject.get('currentGrade', 'N/A')}, Target={subject.get('targetGrade', 'N/A')}"
-                        if subject.get('standard_meg'): subj_text += f", MEG={subject.get('standard_meg')}"
-                        rag_context_parts.append(subj_text)
-            
-            meg_data_from_context = initial_ai_context.get('academic_megs')
-            if meg_data_from_context and meg_data_from_context.get('prior_attainment_score'):
-                rag_context_parts.append(f"\nMy Prior Attainment Score: {meg_data_from_context['prior_attainment_score']} (influences MEGs)")
-            
-            reflections_from_context = initial_ai_context.get('student_reflections_and_goals')
-            if reflections_from_context and isinstance(reflections_from_context, dict):
-                added_reflection_context = False
-                for key, value in reflections_from_context.items():
-                    if value and str(value).strip() and str(value).lower() not in ["not specified", "n/a"]:
-                        if not added_reflection_context:
-                            rag_context_parts.append("\nMy Recent Reflections & Goals (from initial context):")
-                            added_reflection_context = True
-                        if 'rrc' in key: rag_context_parts.append(f" - Reflection: {str(value)[:150]}...")
-                        elif 'goal' in key: rag_context_parts.append(f" - Goal: {str(value)[:150]}...")
-            
-            highlights_from_context = initial_ai_context.get('object29_question_highlights')
-            if highlights_from_context and isinstance(highlights_from_context, dict):
-                if highlights_from_context.get('top_3') or highlights_from_context.get('bottom_3'):
-                    rag_context_parts.append("\nMy Questionnaire Insights (from initial context):")
-                    if highlights_from_context.get('top_3'):
-                        rag_context_parts.append(" Strengths (I strongly agreed with):")
-                        for item in highlights_from_context['top_3'][:2]: rag_context_parts.append(f"  • {item.get('category')}: \"{str(item.get('text',''))[:80]}...\"")
-                    if highlights_from_context.get('bottom_3'):
-                        rag_context_parts.append(" Areas to consider (I disagreed with):")
-                        for item in highlights_from_context['bottom_3'][:2]: rag_context_parts.append(f"  • {item.get('category')}: \"{str(item.get('text',''))[:80]}...\"")
-            
-            if llm_insights_from_context.get('suggested_student_goals'):
-                goals = llm_insights_from_context['suggested_student_goals']
-                if goals and isinstance(goals, list) and any(str(g).strip() for g in goals):
-                    rag_context_parts.append(f"\nPreviously suggested goals for me (from initial context): {'; '.join([str(g) for g in goals[:2] if str(g).strip()])}")
-
-            q_interp_from_context = llm_insights_from_context.get('questionnaire_interpretation_and_reflection_summary')
-            if q_interp_from_context and len(str(q_interp_from_context)) > 50:
-                rag_context_parts.append(f"\nMy Questionnaire Analysis Summary (from initial context): {str(q_interp_from_context)[:200]}...")
-        else:
-            rag_context_parts.append("\n(Note: Detailed student data summary from initial context is not available for this turn.)")
+        overview_summary_from_context = llm_insights_from_context.get('student_overview_summary')
+        if overview_summary_from_context:
+            rag_context_parts.append(f"My Overall AI Snapshot: {overview_summary_from_context}")
+
+        # Use student_vespa_profile which was already populated from initial_ai_context if available
+        if student_vespa_profile: # This was set earlier from initial_ai_context.get('vespa_profile', {})
+            rag_context_parts.append("\nMy VESPA Scores:")
+            for el, el_data in student_vespa_profile.items():
+                if el != "Overall" and isinstance(el_data, dict):
+                    el_get = el_data.get
+                    rag_context_parts.append(f" - {el}: {el_get('score_1_to_10', 'N/A')}/10 (Profile: '{el_get('score_profile_text', 'N/A')}')")
+        
+        school_avgs_from_context = initial_ai_context.get('school_vespa_averages')
+        if school_avgs_from_context and student_vespa_profile:
+            rag_context_parts.append("\nHow I Compare to School Averages:")
+            for el, el_data in student_vespa_profile.items():
+                if el != "Overall" and el in school_avgs_from_context and isinstance(el_data, dict):
+                    my_score = _score_as_float(el_data.get('score_1_to_10')) # None for 'N/A' or blank scores
+                    school_avg = _score_as_float(school_avgs_from_context.get(el))
+                    if my_score is not None and school_avg is not None:
+                        diff = my_score - school_avg
+                        if diff > 0: rag_context_parts.append(f" - {el}: I'm {diff:.1f} points above school average")
+                        elif diff < 0: rag_context_parts.append(f" - {el}: I'm {abs(diff):.1f} points below school average")
+                        else: rag_context_parts.append(f" - {el}: I'm at the school average")
+        
+        academic_data_from_context = initial_ai_context.get('academic_profile_summary')
+        if isinstance(academic_data_from_context, list) and academic_data_from_context:
+            rag_context_parts.append("\nMy Academic Profile (first few subjects):")
+            for subject in academic_data_from_context[:3]: 
+                if not isinstance(subject, dict):
+                    continue
+                subject_get = subject.get
+                subject_name = subject_get('subject')
+                if subject_name and subject_name != 'N/A' and not subject_name.lower().startswith("academic profile not found"):
+                    standard_meg = subject_get('standard_meg')
+                    rag_context_parts.append(_CHAT_SUBJECT_LINE.format_map({
+                        'subject': subject_name,
+                        'current': subject_get('currentGrade', 'N/A'),
+                        'target': subject_get('targetGrade', 'N/A'),
+                        'meg': f", MEG={standard_meg}" if standard_meg else "",
+                    }))
+        
+        meg_data_from_context = initial_ai_context.get('academic_megs')
+        if meg_data_from_context and meg_data_from_context.get('prior_attainment_score'):
+            rag_context_parts.append(f"\nMy Prior Attainment Score: {meg_data_from_context['prior_attainment_score']} (influences MEGs)")
+        
+        reflections_from_context = initial_ai_context.get('student_reflections_and_goals')
+        if reflections_from_context and isinstance(reflections_from_context, dict):
+            added_reflection_context = False
+            for key, value in reflections_from_context.items():
+                if not value:
+                    continue
+                value_text = value if isinstance(value, str) else str(value) # Knack text fields are normally str already
+                if value_text.strip() and value_text.lower() not in _UNSPECIFIED_REFLECTION_VALUES:
+                    if not added_reflection_context:
+                        rag_context_parts.append("\nMy Recent Reflections & Goals (from initial context):")
+                        added_reflection_context = True
+                    if 'rrc' in key: rag_context_parts.append(f" - Reflection: {value_text[:150]}...")
+                    elif 'goal' in key: rag_context_parts.append(f" - Goal: {value_text[:150]}...")
+        
+        highlights_from_context = initial_ai_context.get('object29_question_highlights')
+        if highlights_from_context and isinstance(highlights_from_context, dict):
+            top_highlights = highlights_from_context.get('top_3')
+            bottom_highlights = highlights_from_context.get('bottom_3')
+            if top_highlights or bottom_highlights:
+                rag_context_parts.append("\nMy Questionnaire Insights (from initial context):")
+                if top_highlights:
+                    rag_context_parts.append(" Strengths (I strongly agreed with):")
+                    for item in top_highlights[:2]: rag_context_parts.append(f"  • {item.get('category')}: \"{str(item.get('text',''))[:80]}...\"")
+                if bottom_highlights:
+                    rag_context_parts.append(" Areas to consider (I disagreed with):")
+                    for item in bottom_highlights[:2]: rag_context_parts.append(f"  • {item.get('category')}: \"{str(item.get('text',''))[:80]}...\"")
+        
+        goals = llm_insights_from_context.get('suggested_student_goals')
+        if goals:
+            if isinstance(goals, list):
+                goal_texts = [g if isinstance(g, str) else str(g) for g in goals]
+                if any(goal_text.strip() for goal_text in goal_texts):
+                    rag_context_parts.append(f"\nPreviously suggested goals for me (from initial context): {'; '.join([goal_text for goal_text in goal_texts[:2] if goal_text.strip()])}")
+
+        q_interp_from_context = llm_insights_from_context.get('questionnaire_interpretation_and_reflection_summary')
+        if q_interp_from_context and len(str(q_interp_from_context)) > 50:
+            rag_context_parts.append(f"\nMy Questionnaire Analysis Summary (from initial context): {str(q_interp_from_context)[:200]}...")
+    else:
+        rag_context_parts.append("\n(Note: Detailed student data summary from initial context is not available for this turn.)")
 
 
-        # 2. Determine if it's a "Focus Area" request or infer VESPA element from query
-        is_focus_area_query = "what area to focus on" in current_user_message.lower() or "focus area" in current_user_message.lower()
+    # 2. Determine if it's a "Focus Area" request or infer VESPA element from query
+    is_focus_area_query = "what area to focus on" in query_lower or "focus area" in query_lower
 
-        if not is_focus_area_query:
-            query_lower = current_user_message.lower()
-            app.logger.info(f"Attempting to infer VESPA element. Query_lower: '{query_lower}'")
-            keyword_to_element_map = {
-                ("vision", "goal", "future", "career", "motivation", "purpose", "direction", "aspiration", "dream", "ambition", "achieve", "aims", "objectives"): "Vision",
-                ("effort", "hard work", "procrastination", "trying", "persevere", "lazy", "energy", "work ethic", "dedication", "commitment"): "Effort",
-                ("systems", "organization", "plan", "notes", "timetable", "deadline", "homework", "complete", "time management", "schedule", "diary", "planner", "organised", "organize", "structure", "routine"): "Systems", # "notes" is a keyword here
-                ("practice", "revision", "revise", "exam prep", "test myself", "study", "memory", "technique", "method", "preparation", "learning", "highlighting", "note-taking", "flashcards", "past papers", "past paper", "exam paper", "mock exam", "question practice", "testing"): "Practice",
-                ("attitude", "mindset", "stress", "pressure", "confidence", "difficult", "anxiety", "worry", "belief", "resilience", "positive", "negative"): "Attitude"
+    if not is_focus_area_query:
+        app.logger.info(f"Attempting to infer VESPA element. Query_lower: '{query_lower}'")
+        element_found = False
+        for element_name, element_keywords_re in VESPA_ELEMENT_KEYWORD_PATTERNS: # Element order sets priority
+            keyword_match = element_keywords_re.search(query_lower)
+            if keyword_match:
+                inferred_vespa_element_from_query = element_name
+                app.logger.info("SUCCESS: Inferred VESPA element '%s' from user query using keyword: '%s'.", inferred_vespa_element_from_query, keyword_match.group(0))
+                element_found = True
+                break
+        if not element_found:
+            app.logger.info(f"FAILED: Could not infer VESPA element from query: '{query_lower}'")
+    
+    # 3. Add relevant VESPA statements from vespa-statements.json (indexed at load time)
+    if VESPA_STATEMENT_INDEX:
+        if is_revision_query:
+            relevant_vespa_statements.extend(dict(statement) for statement in REVISION_PRACTICE_STATEMENTS)
+
+        if len(relevant_vespa_statements) < 4:
+            if inferred_vespa_element_from_query:
+                statement_candidates = VESPA_STATEMENTS_BY_CATEGORY.get(inferred_vespa_element_from_query.lower(), ())
+            else:
+                statement_candidates = (statement for statement in VESPA_STATEMENT_INDEX if any(kw in query_lower for kw in statement[2]))
+            for statement_category, statement_text, _ in islice(statement_candidates, 4 - len(relevant_vespa_statements)): # Stops matching at 4 statements
+                relevant_vespa_statements.append({
+                    'element': statement_category.capitalize(),
+                    'type': 'positive' if len(relevant_vespa_statements) < 2 else 'negative',
+                    'text': statement_text
+                })
+
+    if relevant_vespa_statements:
+        rag_context_parts.append("\n--- VESPA Framework Perspectives (General Principles) ---")
+        current_element_for_statement = None
+        for vs_item in relevant_vespa_statements:
+            if vs_item['element'] != current_element_for_statement:
+                current_element_for_statement = vs_item['element']
+                rag_context_parts.append(f"\nOn {current_element_for_statement}:")
+            statement_prefix = "✓ Effective approaches often involve..." if vs_item['type'] == 'positive' else "✗ Less effective approaches might include..."
+            rag_context_parts.append(f"  {statement_prefix} {vs_item['text']}")
+        rag_context_parts.append("\n(Use these general VESPA perspectives to understand common patterns and guide your questions subtly.)")
+
+    # 4. Add relevant coaching insights - ENHANCED for revision strategies
+    if COACHING_INSIGHTS_DATA and isinstance(COACHING_INSIGHTS_DATA, list):
+        inferred_element_l = inferred_vespa_element_from_query.lower() if inferred_vespa_element_from_query else None
+        
+        # One pass: the revision-keyword score is precomputed per insight, so only the query-dependent parts are added here
+        scored_insights = []
+        for insight_name, insight_summary, insight_tags, insight_all_text_corpus, revision_score, insight in COACHING_INSIGHT_CHAT_INDEX:
+            relevance_score_insight = revision_score + 2 * sum(1 for word_in_query in query_words if word_in_query in insight_all_text_corpus)
+            if inferred_element_l and (inferred_element_l in insight_tags or inferred_element_l in insight_name or inferred_element_l in insight_summary):
+                relevance_score_insight += 3
+            if relevance_score_insight > 1: # Minimum relevance
+                scored_insights.append((relevance_score_insight, insight))
+    
+        relevant_coaching_insights_for_chat = [ # Top 3; ties keep KB order
+            {
+                'name': insight.get('name'), 'summary': insight.get('summary'),
+                'key_points': insight.get('key_points', [])[:3], 'relevance': relevance_score_insight
             }
-            element_found = False
-            for keywords_tuple, element_name in keyword_to_element_map.items():
-                # app.logger.debug(f"Checking element: {element_name} with keywords: {keywords_tuple}") # Original debug
-                for kw in keywords_tuple:
-                    app.logger.debug(f"Checking keyword '{kw}' from element '{element_name}' against query_lower: '{query_lower[:100]}...'") # Log each keyword check
-                    if kw in query_lower:
-                        inferred_vespa_element_from_query = element_name
-                        app.logger.info(f"SUCCESS: Inferred VESPA element '{inferred_vespa_element_from_query}' from user query using keyword: '{kw}'.")
-                        element_found = True
-                        break # Break from inner loop (keywords_tuple)
-                if element_found:
-                    break # Break from outer loop (keyword_to_element_map)
-            if not element_found:
-                app.logger.info(f"FAILED: Could not infer VESPA element from query: '{query_lower}'")
+            for relevance_score_insight, insight in heapq.nlargest(3, scored_insights, key=itemgetter(0))
+        ]
+    
+    if relevant_coaching_insights_for_chat:
+        rag_context_parts.append("\n--- Relevant Coaching Insights & Research (For Your Inspiration) ---")
+        for ci_item in relevant_coaching_insights_for_chat:
+            rag_context_parts.append(f"\nInsight: {ci_item['name']}")
+            rag_context_parts.append(f"Summary: {ci_item['summary']}")
+            if ci_item.get('key_points'):
+                rag_context_parts.append("Key ideas to consider for coaching:")
+                for point_text in ci_item['key_points']: rag_context_parts.append(f"  • {point_text}")
+        rag_context_parts.append("\n(Subtly weave these research-backed ideas into your conversation and questions, don't quote them directly.)")
+    
+    if is_revision_query:
+        rag_context_parts.append("\n--- CRITICAL COACHING NOTE: Active vs Passive Learning ---")
+        rag_context_parts.append("The student may be discussing highlighting or simple note-taking. These are often PASSIVE strategies. Research strongly indicates ACTIVE strategies are far more effective.")
+        rag_context_parts.append("ACTIVE strategies include: Self-testing, retrieval practice, teaching content to others, past paper practice, creating & answering questions, spaced repetition, interleaving, creating concept maps or Cornell notes from memory.")
+        rag_context_parts.append("GENTLY explore their current methods and guide them towards discovering more active and effective techniques through questioning. Don't preach, help them find better ways.")
+
+    # 5. RAG based on Coaching Questions KB & Activities
+    if coaching_kb and VESPA_ACTIVITIES_DATA:
+        app.logger.info(f"Processing RAG with Coaching KB and Activities KB. Student Edu Level for KB: {student_educational_level_kb}")
         
-        # 3. Add relevant VESPA statements from vespa-statements.json
-        if VESPA_STATEMENTS_DATA and isinstance(VESPA_STATEMENTS_DATA, dict):
-            vespa_statements_list = VESPA_STATEMENTS_DATA.get('vespa_statements', {}).get('statements', [])
-            if vespa_statements_list and isinstance(vespa_statements_list, list):
-                if "revis" in current_user_message.lower() or "highlight" in current_user_message.lower() or "note" in current_user_message.lower():
-                    for statement_obj in vespa_statements_list:
-                        if isinstance(statement_obj, dict):
-                            statement_id = statement_obj.get('id', '')
-                            if statement_id in ['P10', 'P12', 'P18', 'P20']: 
-                                relevant_vespa_statements.append({
-                                    'element': 'Practice', 'type': 'positive',
-                                    'text': statement_obj.get('statement', ''), 'id': statement_id
-                                })
-                                if len(relevant_vespa_statements) >= 4: break
-                
-                if len(relevant_vespa_statements) < 4:
-                    for statement_obj in vespa_statements_list:
-                        if isinstance(statement_obj, dict):
-                            statement_category = statement_obj.get('category', '').lower()
-                            if (inferred_vespa_element_from_query and statement_category == inferred_vespa_element_from_query.lower()) or \
-                               (not inferred_vespa_element_from_query and any(kw in current_user_message.lower() for kw in statement_obj.get('keywords', []))):
-                                if len(relevant_vespa_statements) < 4:
-                                    relevant_vespa_statements.append({
-                                        'element': statement_category.capitalize(),
-                                        'type': 'positive' if len(relevant_vespa_statements) < 2 else 'negative',
-                                        'text': statement_obj.get('statement', '')
-                                    })
-                            if len(relevant_vespa_statements) >= 4: break
-
-        if relevant_vespa_statements:
-            rag_context_parts.append("\n--- VESPA Framework Perspectives (General Principles) ---")
-            current_element_for_statement = None
-            for vs_item in relevant_vespa_statements:
-                if vs_item['element'] != current_element_for_statement:
-                    current_element_for_statement = vs_item['element']
-                    rag_context_parts.append(f"\nOn {current_element_for_statement}:")
-                statement_prefix = "✓ Effective approaches often involve..." if vs_item['type'] == 'positive' else "✗ Less effective approaches might include..."
-                rag_context_parts.append(f"  {statement_prefix} {vs_item['text']}")
-            rag_context_parts.append("\n(Use these general VESPA perspectives to understand common patterns and guide your questions subtly.)")
-
-        # 4. Add relevant coaching insights - ENHANCED for revision strategies
-        if COACHING_INSIGHTS_DATA and isinstance(COACHING_INSIGHTS_DATA, list):
-            revision_related_keywords = ["active", "passive", "retrieval", "testing", "practice", "recall", "memory", "revision", "study strategies", "notes", "cornell"] # Added "notes", "cornell"
-            
-            temp_insights_with_scores = []
-            for insight in COACHING_INSIGHTS_DATA: 
-                if isinstance(insight, dict):
-                    insight_name = insight.get('name', '').lower()
-                    insight_summary = insight.get('summary', '').lower()
-                    insight_tags = [str(tag).lower() for tag in insight.get('tags', []) if isinstance(tag, str)]
-                    
-                    relevance_score_insight = 0
-                    query_l = current_user_message.lower()
-                    
-                    for keyword_rev in revision_related_keywords:
-                        if keyword_rev in insight_name or keyword_rev in insight_summary or keyword_rev in insight_tags:
-                            relevance_score_insight += 3
-                    
-                    insight_all_text_corpus = insight_name + " " + insight_summary + " " + " ".join(insight_tags)
-                    for word_in_query in query_l.split():
-                        if len(word_in_query) > 3 and word_in_query in insight_all_text_corpus:
-                            relevance_score_insight += 2
-                    
-                    if inferred_vespa_element_from_query:
-                        if inferred_vespa_element_from_query.lower() in insight_tags or \
-                           inferred_vespa_element_from_query.lower() in insight_name or \
-                           inferred_vespa_element_from_query.lower() in insight_summary:
-                            relevance_score_insight += 3
-                    
-                    if relevance_score_insight > 1: # Minimum relevance
-                         temp_insights_with_scores.append({
-                            'name': insight.get('name'), 'summary': insight.get('summary'),
-                            'key_points': insight.get('key_points', [])[:3], 'relevance': relevance_score_insight
-                        })
-            
-            temp_insights_with_scores.sort(key=lambda x: x['relevance'], reverse=True)
-            relevant_coaching_insights_for_chat = temp_insights_with_scores[:3] # Get top 3
+        overall_profile_categories_for_framing = [details.get('score_profile_text', 'N/A') for details in student_vespa_profile.values() if isinstance(details, dict) and details.get('score_profile_text', 'N/A') != 'N/A']
+        low_score_count_for_framing = sum(1 for cat_text in overall_profile_categories_for_framing if cat_text in ["Low", "Very Low"])
         
-        if relevant_coaching_insights_for_chat:
-            rag_context_parts.append("\n--- Relevant Coaching Insights & Research (For Your Inspiration) ---")
-            for ci_item in relevant_coaching_insights_for_chat:
-                rag_context_parts.append(f"\nInsight: {ci_item['name']}")
-                rag_context_parts.append(f"Summary: {ci_item['summary']}")
-                if ci_item.get('key_points'):
-                    rag_context_parts.append("Key ideas to consider for coaching:")
-                    for point_text in ci_item['key_points']: rag_context_parts.append(f"  • {point_text}")
-            rag_context_parts.append("\n(Subtly weave these research-backed ideas into your conversation and questions, don't quote them directly.)")
+        framing_statement_to_use_rag = coaching_kb.get('conditionalFramingStatements', [{}])[0].get('statement', '') 
+        if low_score_count_for_framing >= 4 and len(overall_profile_categories_for_framing) == 5 :
+            framing_statement_to_use_rag = next((s_item['statement'] for s_item in coaching_kb['conditionalFramingStatements'] if s_item['id'] == 'low_4_or_5_scores'), framing_statement_to_use_rag)
+        if framing_statement_to_use_rag:
+            rag_context_parts.append(f"\nCoach's Opening Thought (General Framing): {framing_statement_to_use_rag}")
+
+        target_vespa_element_for_rag = None
+        target_score_category_for_rag = None
+
+        if is_focus_area_query:
+            app.logger.info("Focus Area query detected. Identifying lowest VESPA score from student_vespa_profile.")
+            lowest_element_name = lowest_vespa_element(student_vespa_profile)
+            if lowest_element_name:
+                target_vespa_element_for_rag = lowest_element_name
+                target_score_category_for_rag = student_vespa_profile[lowest_element_name].get('score_profile_text', 'N/A')
+                rag_context_parts.append(_CHAT_FOCUS_AREA_LINE.format(element=target_vespa_element_for_rag, profile=target_score_category_for_rag))
+            else: app.logger.warning("Focus area query, but could not determine lowest VESPA element from profile.")
+        elif inferred_vespa_element_from_query:
+            target_vespa_element_for_rag = inferred_vespa_element_from_query
+            if student_vespa_profile and target_vespa_element_for_rag in student_vespa_profile and isinstance(student_vespa_profile[target_vespa_element_for_rag], dict):
+                target_score_category_for_rag = student_vespa_profile[target_vespa_element_for_rag].get('score_profile_text', 'N/A')
+            else: # If profile doesn't have this element (should not happen ideally) or not dict
+                target_score_category_for_rag = "Medium" # Default if no score profile for inferred element
+                app.logger.warning(f"Using inferred VESPA '{target_vespa_element_for_rag}' but no score profile in student_vespa_profile. Defaulting to 'Medium' for RAG.")
+            app.logger.info(f"Using inferred VESPA element '{target_vespa_element_for_rag}' for RAG. Score profile: '{target_score_category_for_rag}'.")
+        else:
+            app.logger.info("No specific VESPA element inferred for targeted RAG. Will rely on general keyword search for activities if applicable.")
         
-        if "revis" in current_user_message.lower() or "highlight" in current_user_message.lower() or "note" in current_user_message.lower():
-            rag_context_parts.append("\n--- CRITICAL COACHING NOTE: Active vs Passive Learning ---")
-            rag_context_parts.append("The student may be discussing highlighting or simple note-taking. These are often PASSIVE strategies. Research strongly indicates ACTIVE strategies are far more effective.")
-            rag_context_parts.append("ACTIVE strategies include: Self-testing, retrieval practice, teaching content to others, past paper practice, creating & answering questions, spaced repetition, interleaving, creating concept maps or Cornell notes from memory.")
-            rag_context_parts.append("GENTLY explore their current methods and guide them towards discovering more active and effective techniques through questioning. Don't preach, help them find better ways.")
-
-        # 5. RAG based on Coaching Questions KB & Activities
-        if coaching_kb and VESPA_ACTIVITIES_DATA:
-            app.logger.info(f"Processing RAG with Coaching KB and Activities KB. Student Edu Level for KB: {student_educational_level_kb}")
+        if target_vespa_element_for_rag and target_score_category_for_rag and target_score_category_for_rag != "N/A":
+            questions_data_level_kb = coaching_kb.get('vespaSpecificCoachingQuestionsWithActivities', {}).get(target_vespa_element_for_rag, {}).get(student_educational_level_kb, {})
+            questions_for_category_kb = questions_data_level_kb.get(target_score_category_for_rag, {})
             
-            overall_profile_categories_for_framing = [details.get('score_profile_text', 'N/A') for details in student_vespa_profile.values() if isinstance(details, dict) and details.get('score_profile_text', 'N/A') != 'N/A']
-            low_score_count_for_framing = sum(1 for cat_text in overall_profile_categories_for_framing if cat_text in ["Low", "Very Low"])
+            retrieved_questions_kb = questions_for_category_kb.get('questions', [])
+            retrieved_activity_ids_kb = questions_for_category_kb.get('related_activity_ids', [])
+
+            if retrieved_questions_kb:
+                chosen_coaching_questions_for_llm = [q_text for q_text in retrieved_questions_kb[:3]] 
+                rag_context_parts.append(_CHAT_COACHING_QUESTIONS_HEADER.format(element=target_vespa_element_for_rag, level=student_educational_level_kb, profile=target_score_category_for_rag))
+                for q_text_item in chosen_coaching_questions_for_llm:
+                    rag_context_parts.append(f"- {q_text_item}")
             
-            framing_statement_to_use_rag = coaching_kb.get('conditionalFramingStatements', [{}])[0].get('statement', '') 
-            if low_score_count_for_framing >= 4 and len(overall_profile_categories_for_framing) == 5 :
-                framing_statement_to_use_rag = next((s_item['statement'] for s_item in coaching_kb['conditionalFramingStatements'] if s_item['id'] == 'low_4_or_5_scores'), framing_statement_to_use_rag)
-            if framing_statement_to_use_rag:
-                rag_context_parts.append(f"\nCoach's Opening Thought (General Framing): {framing_statement_to_use_rag}")
-
-            target_vespa_element_for_rag = None
-            target_score_category_for_rag = None
-
-            if is_focus_area_query:
-                app.logger.info("Focus Area query detected. Identifying lowest VESPA score from student_vespa_profile.")
-                lowest_score_val = 11
-                lowest_element_name = None
-                if student_vespa_profile: # Ensure it's populated
-                    for vespa_el_name, el_details in student_vespa_profile.items():
-                        if vespa_el_name == "Overall" or not isinstance(el_details, dict): continue
-                        try:
-                            current_score = float(el_details.get('score_1_to_10', 10))
-                            if current_score < lowest_score_val:
-                                lowest_score_val = current_score
-                                lowest_element_name = vespa_el_name
-                        except (ValueError, TypeError): pass
-                if lowest_element_name:
-                    target_vespa_element_for_rag = lowest_element_name
-                    target_score_category_for_rag = student_vespa_profile[lowest_element_name].get('score_profile_text', 'N/A')
-                    rag_context_parts.append(f"\nStudent wants to focus on an area. Their lowest VESPA element is '{target_vespa_element_for_rag}' (Profile: '{target_score_category_for_rag}'). Prioritize questions/activities for this.")
-                else: app.logger.warning("Focus area query, but could not determine lowest VESPA element from profile.")
-            elif inferred_vespa_element_from_query:
-                target_vespa_element_for_rag = inferred_vespa_element_from_query
-                if student_vespa_profile and target_vespa_element_for_rag in student_vespa_profile and isinstance(student_vespa_profile[target_vespa_element_for_rag], dict):
-                    target_score_category_for_rag = student_vespa_profile[target_vespa_element_for_rag].get('score_profile_text', 'N/A')
-                else: # If profile doesn't have this element (should not happen ideally) or not dict
-                    target_score_category_for_rag = "Medium" # Default if no score profile for inferred element
-                    app.logger.warning(f"Using inferred VESPA '{target_vespa_element_for_rag}' but no score profile in student_vespa_profile. Defaulting to 'Medium' for RAG.")
-                app.logger.info(f"Using inferred VESPA element '{target_vespa_element_for_rag}' for RAG. Score profile: '{target_score_category_for_rag}'.")
-            else:
-                app.logger.info("No specific VESPA element inferred for targeted RAG. Will rely on general keyword search for activities if applicable.")
+            include_activities_rag = (conversation_depth >= 1 or user_asking_for_activity) and retrieved_activity_ids_kb # MODIFIED: Threshold lowered to depth 1
             
-            if target_vespa_element_for_rag and target_score_category_for_rag and target_score_category_for_rag != "N/A":
-                questions_data_level_kb = coaching_kb.get('vespaSpecificCoachingQuestionsWithActivities', {}).get(target_vespa_element_for_rag, {}).get(student_educational_level_kb, {})
-                questions_for_category_kb = questions_data_level_kb.get(target_score_category_for_rag, {})
+            if include_activities_rag:
+                activity_header_template = _CHAT_SUGGESTED_ACTIVITIES_HEADER if user_asking_for_activity else _CHAT_POTENTIAL_ACTIVITIES_HEADER
+                rag_context_parts.append(activity_header_template.format(element=target_vespa_element_for_rag))
                 
-                retrieved_questions_kb = questions_for_category_kb.get('questions', [])
-                retrieved_activity_ids_kb = questions_for_category_kb.get('related_activity_ids', [])
-
-                if retrieved_questions_kb:
-                    chosen_coaching_questions_for_llm = [q_text for q_text in retrieved_questions_kb[:3]] 
-                    rag_context_parts.append(f"\n--- Potentially Relevant Coaching Questions for '{target_vespa_element_for_rag}' (Level: {student_educational_level_kb}, Profile: {target_score_category_for_rag}) ---")
-                    for q_text_item in chosen_coaching_questions_for_llm:
-                        rag_context_parts.append(f"- {q_text_item}")
-                
-                include_activities_rag = (conversation_depth >= 1 or user_asking_for_activity) and retrieved_activity_ids_kb # MODIFIED: Threshold lowered to depth 1
+                activity_count_primary = 0
+                for act_id_kb in retrieved_activity_ids_kb:
+                    if activity_count_primary >= 2: break # Limit to 2 from primary source
+                    activity_detail_kb = next((act_item for act_item in VESPA_ACTIVITIES_DATA if act_item.get('id') == act_id_kb), None)
+                    if activity_detail_kb:
+                        activity_data_for_llm_item = {
+                            "id": activity_detail_kb.get('id'), "name": activity_detail_kb.get('name'),
+                            "short_summary": activity_detail_kb.get('short_summary'), "pdf_link": activity_detail_kb.get('pdf_link'),
+                            "vespa_element": activity_detail_kb.get('vespa_element'), "level": activity_detail_kb.get('level')
+                        }
+                        suggested_activities_for_response.append(activity_data_for_llm_item)
+                        pdf_text = _CHAT_ACTIVITY_PDF_NOTE if activity_data_for_llm_item['pdf_link'] and activity_data_for_llm_item['pdf_link'] != '#' else ""
+                        
+                        rag_context_parts.append(_CHAT_ACTIVITY_LINE.format(name=activity_data_for_llm_item['name'], pdf=pdf_text, summary=activity_data_for_llm_item['short_summary']))
+                        activity_count_primary += 1
+                app.logger.info(f"Student chat RAG: Found {len(suggested_activities_for_response)} activities via coaching questions link for {target_vespa_element_for_rag}.")
+            elif retrieved_activity_ids_kb and conversation_depth >= 0: 
+                rag_context_parts.append(_CHAT_ACTIVITIES_LATER_NOTE.format(element=target_vespa_element_for_rag))
+
+        # Fallback: General keyword search for activities - MODIFIED threshold & scoring
+        if not suggested_activities_for_response and (conversation_depth >= 1 or user_asking_for_activity): # Fallback if no primary activities and depth >= 1
+            cleaned_msg_for_kw_search = query_lower.translate(_KEYWORD_SEARCH_PUNCTUATION)
+            keywords_from_query = [word for word in cleaned_msg_for_kw_search.split() if word not in _ACTIVITY_SEARCH_STOPWORDS and len(word) > 3]
+        
+            if keywords_from_query:
+                found_activities_text_for_prompt_fallback = []
+                processed_activity_ids_student_chat_fallback = set()
                 
-                if include_activities_rag:
-                    activity_header_text = f"\n--- Suggested Activities for '{target_vespa_element_for_rag}' (If student asks or after more discussion) ---" if user_asking_for_activity else f"\n--- Potential Activities for '{target_vespa_element_for_rag}' (Available if student expresses need) ---"
-                    rag_context_parts.append(activity_header_text)
+                # Which themes the message touches depends only on the message, so it is decided once per turn
+                message_context_word_items = [context_word_items for context_word_items in _ACTIVITY_CONTEXT_KEYWORDS.values()
+                                              if any(word_ctx in query_lower for word_ctx in context_word_items)]
+                scored_activities_list = []
+                for activity_item_fallback in VESPA_ACTIVITIES_DATA:
+                    relevance_score_fallback = 0
+                    activity_name_l = str(activity_item_fallback.get('name', '')).lower()
                     
-                    activity_count_primary = 0
-                    for act_id_kb in retrieved_activity_ids_kb:
-                        if activity_count_primary >= 2: break # Limit to 2 from primary source
-                        activity_detail_kb = next((act_item for act_item in VESPA_ACTIVITIES_DATA if act_item.get('id') == act_id_kb), None)
-                        if activity_detail_kb:
-                            activity_data_for_llm_item = {
-                                "id": activity_detail_kb.get('id'), "name": activity_detail_kb.get('name'),
-                                "short_summary": activity_detail_kb.get('short_summary'), "pdf_link": activity_detail_kb.get('pdf_link'),
-                                "vespa_element": activity_detail_kb.get('vespa_element'), "level": activity_detail_kb.get('level')
-                            }
-                            suggested_activities_for_response.append(activity_data_for_llm_item)
-                            pdf_text = " (Resource PDF available)" if activity_data_for_llm_item['pdf_link'] and activity_data_for_llm_item['pdf_link'] != '#' else ""
-                            
-                            rag_context_parts.append(f"\n- Name: {activity_data_for_llm_item['name']}{pdf_text}.\n  Summary: {activity_data_for_llm_item['short_summary']}")
-                            activity_count_primary += 1
-                    app.logger.info(f"Student chat RAG: Found {len(suggested_activities_for_response)} activities via coaching questions link for {target_vespa_element_for_rag}.")
-                elif retrieved_activity_ids_kb and conversation_depth >= 0: 
-                    rag_context_parts.append(f"\n[Coach Note: Relevant activities exist for '{target_vespa_element_for_rag}'. Consider asking if student wants suggestions later if the conversation heads that way.]")
-
-            # Fallback: General keyword search for activities - MODIFIED threshold & scoring
-            if not suggested_activities_for_response and (conversation_depth >= 1 or user_asking_for_activity): # Fallback if no primary activities and depth >= 1
-                common_words_filter = {"is", "a", "the", "and", "to", "of", "it", "in", "for", "on", "with", "as", "an", "at", "by", "my", "i", "me", "what", "how", "help", "can", "some", "this", "that", "area", "areas", "score", "scores"}
-                cleaned_msg_for_kw_search = current_user_message.lower()
-                for char_to_replace_item in ['?', '.', ',', '\'', '"', '!']: # Ensure ' is \'
-                    cleaned_msg_for_kw_search = cleaned_msg_for_kw_search.replace(char_to_replace_item, '')
-                keywords_from_query = [word for word in cleaned_msg_for_kw_search.split() if word not in common_words_filter and len(word) > 3]
-            
-                if keywords_from_query:
-                    found_activities_text_for_prompt_fallback = []
-                    processed_activity_ids_student_chat_fallback = set()
+                    activity_keywords_l_list = activity_item_fallback.get('keywords', [])
+                    if not isinstance(activity_keywords_l_list, list): activity_keywords_l_list = []
+                    activity_keywords_l = [str(k_item).lower() for k_item in activity_keywords_l_list]
+                    activity_summary_l = str(activity_item_fallback.get('short_summary', '')).lower()
+
+                    for kw_usr_item in keywords_from_query:
+                        if kw_usr_item in activity_name_l: relevance_score_fallback += 5
+                        if kw_usr_item in activity_keywords_l: relevance_score_fallback += 4 
+                        if kw_usr_item in activity_summary_l: relevance_score_fallback += 1
                     
-                    scored_activities_list = []
-                    for activity_item_fallback in VESPA_ACTIVITIES_DATA:
-                        relevance_score_fallback = 0
-                        activity_name_l = str(activity_item_fallback.get('name', '')).lower()
-                        
-                        activity_keywords_l_list = activity_item_fallback.get('keywords', [])
-                        if not isinstance(activity_keywords_l_list, list): activity_keywords_l_list = []
-                        activity_keywords_l = [str(k_item).lower() for k_item in activity_keywords_l_list]
-                        activity_summary_l = str(activity_item_fallback.get('short_summary', '')).lower()
-
-                        for kw_usr_item in keywords_from_query:
-                            if kw_usr_item in activity_name_l: relevance_score_fallback += 5
-                            if kw_usr_item in activity_keywords_l: relevance_score_fallback += 4 
-                            if kw_usr_item in activity_summary_l: relevance_score_fallback += 1
-                        
-                        if inferred_vespa_element_from_query and activity_item_fallback.get('vespa_element', '').lower() == inferred_vespa_element_from_query.lower():
-                            relevance_score_fallback += 3
-                        
-                        context_keywords_map = {
-                            "active_learning": ["flashcard", "test", "quiz", "retrieval", "practice", "leitner", "command verb", "past paper", "exam paper", "mock exam", "question practice", "self-testing", "spaced repetition", "interleaving"],
-                            "organization": ["plan", "schedule", "diary", "timetable", "system", "organize", "task management", "prioritization", "notes"], # "notes" added
-                            "mindset": ["confidence", "stress", "anxiety", "belief", "attitude", "resilience", "growth mindset", "coping"],
-                            "goal_setting": ["goal", "target", "vision", "future", "career", "aspiration", "objective", "plan"]
-                        }
-                        
-                        for context_type_name, context_word_items in context_keywords_map.items():
-                            if any(word_ctx in current_user_message.lower() for word_ctx in context_word_items):
-                                activity_corpus_theme = activity_name_l + " " + " ".join(activity_keywords_l) + " " + activity_summary_l
-                                matching_ctx_score = sum(1 for word_ctx_item in context_word_items if word_ctx_item in activity_corpus_theme)
-                                relevance_score_fallback += matching_ctx_score * 2 
-                        
-                        if relevance_score_fallback > 3: # Adjusted threshold to >3
-                            scored_activities_list.append((relevance_score_fallback, activity_item_fallback))
+                    if inferred_vespa_element_from_query and activity_item_fallback.get('vespa_element', '').lower() == inferred_vespa_element_from_query.lower():
+                        relevance_score_fallback += 3
                     
-                    scored_activities_list.sort(key=lambda x_item: x_item[0], reverse=True)
+                    if message_context_word_items:
+                        activity_corpus_theme = activity_name_l + " " + " ".join(activity_keywords_l) + " " + activity_summary_l
+                        for context_word_items in message_context_word_items:
+                            matching_ctx_score = sum(1 for word_ctx_item in context_word_items if word_ctx_item in activity_corpus_theme)
+                            relevance_score_fallback += matching_ctx_score * 2 
                     
-                    for score_val, activity_data_fb in scored_activities_list[:2]: # Take top 2 fallback
-                        if activity_data_fb.get('id') not in processed_activity_ids_student_chat_fallback:
-                            activity_llm_data = {
-                                "id": activity_data_fb.get('id'), "name": activity_data_fb.get('name'),
-                                "short_summary": activity_data_fb.get('short_summary'), "pdf_link": activity_data_fb.get('pdf_link'),
-                                "vespa_element": activity_data_fb.get('vespa_element'), "level": activity_data_fb.get('level')
-                            }
-                            suggested_activities_for_response.append(activity_llm_data)
-                            pdf_text_fb = " (Resource PDF available)" if activity_llm_data['pdf_link'] and activity_llm_data['pdf_link'] != '#' else ""
-                            found_activities_text_for_prompt_fallback.append(
-                                f"- Name: {activity_llm_data['name']}{pdf_text_fb}. Summary: {activity_llm_data['short_summary'][:150]}..."
-                            )
-                            processed_activity_ids_student_chat_fallback.add(activity_llm_data['id'])
+                    if relevance_score_fallback > 3: # Adjusted threshold to >3
+                        scored_activities_list.append((relevance_score_fallback, activity_item_fallback))
                 
-                    if found_activities_text_for_prompt_fallback:
-                        rag_context_parts.append("\n--- Also Consider these Activities (based on your message keywords, if primary ones aren't suitable) ---")
-                        rag_context_parts.extend(found_activities_text_for_prompt_fallback)
-                        app.logger.info(f"Student chat RAG: Added {len(found_activities_text_for_prompt_fallback)} fallback activities via keyword match.")
-        
-        system_prompt_content = f"""You are My VESPA AI Coach - a warm, supportive coach who helps students develop their Vision, Effort, Systems, Practice, and Attitude.
+                scored_activities_list.sort(key=lambda x_item: x_item[0], reverse=True)
+                
+                for score_val, activity_data_fb in scored_activities_list[:2]: # Take top 2 fallback
+                    if activity_data_fb.get('id') not in processed_activity_ids_student_chat_fallback:
+                        activity_llm_data = {
+                            "id": activity_data_fb.get('id'), "name": activity_data_fb.get('name'),
+                            "short_summary": activity_data_fb.get('short_summary'), "pdf_link": activity_data_fb.get('pdf_link'),
+                            "vespa_element": activity_data_fb.get('vespa_element'), "level": activity_data_fb.get('level')
+                        }
+                        suggested_activities_for_response.append(activity_llm_data)
+                        pdf_text_fb = _CHAT_ACTIVITY_PDF_NOTE if activity_llm_data['pdf_link'] and activity_llm_data['pdf_link'] != '#' else ""
+                        found_activities_text_for_prompt_fallback.append(
+                            _CHAT_FALLBACK_ACTIVITY_LINE.format(name=activity_llm_data['name'], pdf=pdf_text_fb, summary=activity_llm_data['short_summary'][:150])
+                        )
+                        processed_activity_ids_student_chat_fallback.add(activity_llm_data['id'])
+            
+                if found_activities_text_for_prompt_fallback:
+                    rag_context_parts.append("\n--- Also Consider these Activities (based on your message keywords, if primary ones aren't suitable) ---")
+                    rag_context_parts.extend(found_activities_text_for_prompt_fallback)
+                    app.logger.info(f"Student chat RAG: Added {len(found_activities_text_for_prompt_fallback)} fallback activities via keyword match.")
+    
+    system_prompt_content = f"""You are My VESPA AI Coach - a warm, supportive coach who helps students develop their Vision, Effort, Systems, Practice, and Attitude.
 
 You're chatting with {student_name_for_chat}. Always use just their first name.
 
@@ -1877,26 +2895,26 @@ ACTIVITY SUGGESTION PROTOCOL:
 The RAG context (ADDITIONAL CONTEXT section) provides student data, VESPA principles, coaching insights, and potentially relevant activities. Use these as *inspiration and background*, not a script. Adapt them. You're a coach.
 
 Remember: Every student is unique. Tailor your approach. Vary your response style. Avoid formulaic responses. Be genuine."""
-        
-        conversation_guidance = ""
-        if conversation_depth < 2 and not user_asking_for_activity:
-            conversation_guidance = f"""
+    
+    conversation_guidance = ""
+    if conversation_depth < 2 and not user_asking_for_activity:
+        conversation_guidance = f"""
 
 CONVERSATION PHASE (Turn {conversation_depth + 1}): Early stage.
 - Focus: Build rapport, active listening, deep understanding of their specific issue.
 - Actions: Ask open-ended questions. Explore their current methods and feelings.
 - Activities: DO NOT suggest activities yet unless they ask. IGNORE any activities in RAG for now.
 """
-        elif conversation_depth >= 2 and not user_asking_for_activity: 
-            conversation_guidance = f"""
+    elif conversation_depth >= 2 and not user_asking_for_activity: 
+        conversation_guidance = f"""
 
 CONVERSATION PHASE (Turn {conversation_depth + 1}): Deeper dive.
 - Focus: Continue coaching. If a *highly relevant* activity exists in RAG AND it feels natural after understanding their need:
 - Action (Optional): You could ask: "I have an idea for an activity that might help with [their specific issue just discussed]. Would you be interested in hearing about it?"
 - Activities: Only suggest if they confirm interest AND it's directly relevant.
 """
-        elif user_asking_for_activity and suggested_activities_for_response:
-            conversation_guidance = f"""
+    elif user_asking_for_activity and suggested_activities_for_response:
+        conversation_guidance = f"""
 
 ACTIVITY SUGGESTION PHASE: Student has asked for activity suggestions.
 - Action: Acknowledge their request.
@@ -1904,15 +2922,13 @@ ACTIVITY SUGGESTION PHASE: Student has asked for activity suggestions.
 - Explain *briefly and clearly* how each chosen activity connects to what they've shared.
 - Ask which one resonates or if they'd like to try one.
 """
-        
-        system_prompt_content += conversation_guidance
-        
-        messages_for_llm = [{"role": "system", "content": system_prompt_content}]
+    
+    system_prompt_content += conversation_guidance
+    
+    messages_for_llm = [{"role": "system", "content": system_prompt_content}]
 
-        if rag_context_parts and len(rag_context_parts) > 1 : 
-            system_rag_content = "\n".join(rag_context_parts)
-            
-            activity_guidance = f"""--- How to Use Activities Effectively (Interpreting RAG Context for this Turn with {student_name_for_chat}) ---
+    if rag_context_parts and len(rag_context_parts) > 1 : 
+        activity_guidance = f"""--- How to Use Activities Effectively (Interpreting RAG Context for this Turn with {student_name_for_chat}) ---
 1.  RELEVANCE IS KEY: Only suggest activities from RAG that *directly address the specific challenge* {student_name_for_chat} is discussing *right now*.
 2.  NO FORCING: Don't suggest an activity just because it's in RAG if it doesn't fit the immediate conversation.
 3.  EXPLAIN WHY: If you suggest an activity, briefly explain *how it connects to what they just told you*. Example: "Since you mentioned struggling with [specific issue], the '[Activity Name]' activity might help you by [briefly explain relevance]."
@@ -1925,26 +2941,56 @@ RAG INTERPRETATION NOTES:
 -   Coaching Questions (from RAG): These are good starting points for your own questions if relevant to the topic. Adapt them.
 -   Activities (from RAG): These are *potential tools*. Evaluate their relevance to the *current specific point* of the conversation *very carefully* before even considering asking to suggest one. If the student is talking about X, don't suggest an activity for Y. If none fit, don't suggest any, as per main prompt.
 """
-            
-            messages_for_llm.append({"role": "system", "content": f"ADDITIONAL CONTEXT FOR YOUR RESPONSE (Student Data, RAG Insights & Potential Activities):\n{system_rag_content}\n{activity_guidance}"})
-            app.logger.info(f"Student chat: Added RAG context to LLM prompt. Length: {len(system_rag_content)} + {len(activity_guidance)}")
-            app.logger.debug(f"Full RAG context for LLM (excluding main system prompt): {system_rag_content}\n{activity_guidance}")
-
-        for message in chat_history:
-            role = message.get("role", "user").lower()
-            if role not in ["user", "assistant"]: role = "user"
-            messages_for_llm.append({"role": role, "content": message.get("content", "")})
         
-        messages_for_llm.append({"role": "user", "content": current_user_message})
+        # Header, RAG parts and guidance go through a single join, rather than joining the parts
+        # and then copying that whole string again into the surrounding message text
+        system_rag_content = "\n".join([
+            "ADDITIONAL CONTEXT FOR YOUR RESPONSE (Student Data, RAG Insights & Potential Activities):",
+            *rag_context_parts,
+            activity_guidance,
+        ])
+        messages_for_llm.append({"role": "system", "content": system_rag_content})
+        app.logger.info(f"Student chat: Added RAG context to LLM prompt. Length: {len(system_rag_content)} ({len(rag_context_parts)} RAG parts + guidance)")
+        app.logger.debug("Full RAG context for LLM (excluding main system prompt): %s", system_rag_content)
+
+    for message in chat_history:
+        role = message.get("role", "user").lower()
+        if role not in ["user", "assistant"]: role = "user"
+        messages_for_llm.append({"role": role, "content": message.get("content", "")})
+    
+    messages_for_llm.append({"role": "user", "content": current_user_message})
+
+    return None, {
+        "student_object3_id": student_object3_id,
+        "messages_for_llm": messages_for_llm,
+        "suggested_activities": suggested_activities_for_response,
+    }
 
-        ai_response_text = "I'm having a little trouble formulating a response right now. Could you try rephrasing your question, or perhaps we can talk about something else?"
+@app.route('/api/v1/chat_turn', methods=['POST', 'OPTIONS'])
+def chat_turn():
+    app.logger.info(f"Received request for /api/v1/chat_turn. Method: {request.method}")
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        app.logger.info(f"Chat turn data received: {str(data)[:500]}...")
+
+        error_response, chat_turn_context = _prepare_chat_turn(data)
+        if error_response is not None:
+            return error_response
+        student_object3_id = chat_turn_context["student_object3_id"]
+        messages_for_llm = chat_turn_context["messages_for_llm"]
+        suggested_activities_for_response = chat_turn_context["suggested_activities"]
+
+        ai_response_text = _CHAT_FALLBACK_RESPONSE
         try:
             app.logger.info(f"Student chat: Sending to LLM. Number of messages for LLM: {len(messages_for_llm)}.")
             app.logger.info(f"Student chat: Total activities available in RAG for LLM consideration this turn: {len(suggested_activities_for_response)}")
             if suggested_activities_for_response:
                 app.logger.info(f"Student chat: RAG Activity IDs available: {[act_item['id'] for act_item in suggested_activities_for_response]}")
             
-            llm_response = openai.chat.completions.create(
+            llm_response = openai_client.chat.completions.create(
                 model="gpt-4o-mini", 
                 messages=messages_for_llm,
                 max_tokens=450, 
@@ -1972,6 +3018,78 @@ RAG INTERPRETATION NOTES:
         })
     
     
+def _sse_event(payload):
+    "Formats one Server-Sent Events message carrying a JSON payload."
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.route('/api/v1/chat_turn_stream', methods=['POST', 'OPTIONS'])
+def chat_turn_stream():
+    """Streaming variant of chat_turn: tokens are sent as SSE events as the LLM produces them.
+
+    Events are `{"token": "..."}` per chunk, then a final `{"done": true, ...}` event carrying
+    the full reply, the RAG activities and the Knack ID of the saved AI message.
+    """
+    app.logger.info(f"Received request for /api/v1/chat_turn_stream. Method: {request.method}")
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+
+    data = request.get_json(silent=True) or {}
+    app.logger.info(f"Chat turn (stream) data received: {str(data)[:500]}...")
+
+    error_response, chat_turn_context = _prepare_chat_turn(data)
+    if error_response is not None:
+        return error_response
+    student_object3_id = chat_turn_context["student_object3_id"]
+    messages_for_llm = chat_turn_context["messages_for_llm"]
+    suggested_activities_for_response = chat_turn_context["suggested_activities"]
+
+    def generate():
+        response_parts = []
+        try:
+            app.logger.info(f"Student chat (stream): Sending to LLM. Number of messages for LLM: {len(messages_for_llm)}.")
+            llm_stream = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages_for_llm,
+                max_tokens=450,
+                temperature=0.75,
+                n=1,
+                stop=None,
+                stream=True
+            )
+            for chunk in llm_stream:
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if token:
+                    response_parts.append(token)
+                    yield _sse_event({"token": token})
+        except Exception as e:
+            app.logger.error(f"Student chat (stream): Error calling OpenAI API: {e}")
+
+        ai_response_text = "".join(response_parts).strip()
+        if not ai_response_text:
+            ai_response_text = _CHAT_FALLBACK_RESPONSE
+            yield _sse_event({"token": ai_response_text})
+        app.logger.info(f"Student chat (stream): LLM full response: {ai_response_text}")
+
+        ai_message_saved_id = save_chat_message_to_knack(student_object3_id, "My AI Coach", ai_response_text)
+        if not ai_message_saved_id:
+            app.logger.error(f"Student chat (stream): Failed to save AI's response to Knack for student Object_3 ID {student_object3_id}.")
+
+        yield _sse_event({
+            "done": True,
+            "ai_response": ai_response_text,
+            "suggested_activities_in_chat": suggested_activities_for_response, # These are from RAG this turn
+            "ai_message_knack_id": ai_message_saved_id
+        })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/v1/chat_history', methods=['POST', 'OPTIONS'])
 def chat_history():
     app.logger.info(f"Received request for /api/v1/chat_history. Method: {request.method}")
@@ -1979,7 +3097,7 @@ def chat_history():
         return _build_cors_preflight_response()
     
     if request.method == 'POST':
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         student_object3_id = data.get('student_knack_id') 
         max_messages = data.get('max_messages', 50) 
         initial_ai_context = data.get('initial_ai_context')
@@ -2012,7 +3130,7 @@ def chat_history():
             app.logger.info(f"Fetched initial {len(all_student_chat_records)} chat records for student {student_object3_id} from {knack_object_key_chatlog}.")
         else:
             app.logger.warning(f"No chat records found or unexpected response format for student {student_object3_id} from {knack_object_key_chatlog}. Response: {chat_log_response}")
-            return jsonify({"chat_history": [], "total_count": 0, "liked_count": 0, "summary": "No chat history found for you yet."}), 200
+            return app.response_class(_EMPTY_CHAT_HISTORY_BODY, status=200, mimetype='application/json')
 
         # Sort records by timestamp (field_1285 in object_119 - CONFIRM THIS IS STILL CORRECT)
         def get_datetime_from_knack_ts(ts_str):
@@ -2064,21 +3182,51 @@ def chat_history():
 
 
 # Helper function for CORS preflight responses
-def _build_cors_preflight_response():
-    response = jsonify(success=True)
+# Body and headers are constant, so they are built once at import.
+_PREFLIGHT_BODY = json.dumps({"success": True})
+_PREFLIGHT_HEADERS = {
     # These headers are important for CORS preflight
-    response.headers.add("Access-Control-Allow-Origin", "https://vespaacademy.knack.com")
-    response.headers.add('Access-Control-Allow-Headers', "Content-Type,Authorization")
-    response.headers.add('Access-Control-Allow-Methods', "GET,PUT,POST,DELETE,OPTIONS")
-    app.logger.info("Built CORS preflight response.")
+    "Access-Control-Allow-Origin": "https://vespaacademy.knack.com",
+    "Access-Control-Allow-Headers": "Content-Type,Authorization",
+    "Access-Control-Allow-Methods": "GET,PUT,POST,DELETE,OPTIONS",
+}
+
+def _build_cors_preflight_response():
+    response = app.response_class(_PREFLIGHT_BODY, status=200, mimetype='application/json')
+    response.headers.update(_PREFLIGHT_HEADERS)
+    app.logger.debug("Built CORS preflight response.")
     return response
 
 # Basic health check endpoint
+# Probes hit this constantly, so the body is encoded once and the log line is debug-only.
+_HEALTH_BODY = json.dumps({"status": "Healthy", "message": "Student Coach Backend is running!"}).encode('utf-8')
+
 @app.route('/', methods=['GET'])
 @app.route('/health', methods=['GET'])
 def health_check():
-    app.logger.info("Health check endpoint was hit.")
-    return jsonify({"status": "Healthy", "message": "Student Coach Backend is running!"}), 200
+    app.logger.debug("Health check endpoint was hit.")
+    return app.response_class(_HEALTH_BODY, status=200, mimetype='application/json')
+
+# Admin endpoint to drop a school's cached VESPA averages (e.g. right after a cohort completes a cycle).
+# The cache is per process, so this clears only the gunicorn worker that serves the request; the response
+# says so with "scope": "this_worker". Other workers keep their copy until it expires (up to 10 minutes).
+# Disabled unless CACHE_ADMIN_TOKEN is set; callers must send it in the X-Cache-Admin-Token header.
+# The same token gates student_coaching_data?mode=batch.
+CACHE_ADMIN_TOKEN = os.getenv('CACHE_ADMIN_TOKEN')
+
+def _has_admin_token():
+    "True if CACHE_ADMIN_TOKEN is set and the request's X-Cache-Admin-Token header matches it."
+    supplied_token = request.headers.get('X-Cache-Admin-Token', '')
+    return bool(CACHE_ADMIN_TOKEN) and hmac.compare_digest(supplied_token, CACHE_ADMIN_TOKEN)
+
+@app.route('/api/v1/cache/invalidate_school/<school_id>', methods=['POST'])
+def invalidate_school_cache(school_id):
+    if not _has_admin_token():
+        app.logger.warning("Rejected cache invalidation request for school %s.", school_id)
+        return jsonify({"error": "Forbidden"}), 403
+    removed = SCHOOL_AVERAGES_CACHE.pop(("get_school_vespa_averages", school_id)) is not None
+    app.logger.info("Cache invalidation for school %s in worker pid %s: %s.", school_id, os.getpid(), 'removed' if removed else 'nothing cached')
+    return jsonify({"success": True, "school_id": school_id, "removed": removed, "scope": "this_worker", "worker_pid": os.getpid()}), 200
 
 # --- Add definitions for new KBs from tutorapp.py here, after existing KB loading ---
 coaching_kb = load_json_file('coaching_questions_knowledge_base.json')
@@ -2086,6 +3234,74 @@ COACHING_INSIGHTS_DATA = load_json_file('coaching_insights.json')
 VESPA_ACTIVITIES_DATA = load_json_file('vespa_activities_kb.json')
 VESPA_STATEMENTS_DATA = load_json_file('vespa-statements.json')  # Load VESPA statements KB
 
+# Lower-cased searchable text of each coaching insight (same index as COACHING_INSIGHTS_DATA), built once
+COACHING_INSIGHT_SEARCH_TEXT = [
+    (
+        str(insight.get('name', '')).lower() + " " +
+        str(insight.get('description', '')).lower() + " " +
+        str(insight.get('implications_for_tutor', '')).lower() + " " +
+        " ".join(insight.get('keywords', [])).lower()
+    ) if isinstance(insight, dict) else ""
+    for insight in (COACHING_INSIGHTS_DATA if isinstance(COACHING_INSIGHTS_DATA, list) else [])
+]
+
+# The line each coaching insight contributes to the student insights prompt (same index), rendered once
+COACHING_INSIGHT_PROMPT_LINES = [
+    f"- Insight: {insight.get('name')}. Focus: {str(insight.get('description') or '')[:100]}..." if isinstance(insight, dict) else ""
+    for insight in (COACHING_INSIGHTS_DATA if isinstance(COACHING_INSIGHTS_DATA, list) else [])
+]
+
+# Revision-strategy terms; an insight scores 3 chat relevance points for each one in its name, summary or tags
+COACHING_REVISION_KEYWORDS = ("active", "passive", "retrieval", "testing", "practice", "recall", "memory", "revision", "study strategies", "notes", "cornell")
+
+def _revision_keyword_score(insight_name, insight_summary, insight_tags):
+    return 3 * sum(1 for keyword in COACHING_REVISION_KEYWORDS
+                   if keyword in insight_name or keyword in insight_summary or keyword in insight_tags)
+
+# Chat RAG view of each coaching insight, lower-cased once:
+# (name, summary, tags, all three joined, revision keyword score, insight)
+COACHING_INSIGHT_CHAT_INDEX = [
+    (insight_name, insight_summary, insight_tags, insight_name + " " + insight_summary + " " + " ".join(insight_tags),
+     _revision_keyword_score(insight_name, insight_summary, insight_tags), insight)
+    for insight in (COACHING_INSIGHTS_DATA if isinstance(COACHING_INSIGHTS_DATA, list) else []) if isinstance(insight, dict)
+    for insight_name, insight_summary, insight_tags in ((
+        insight.get('name', '').lower(),
+        insight.get('summary', '').lower(),
+        [str(tag).lower() for tag in insight.get('tags', []) if isinstance(tag, str)],
+    ),)
+]
+
+# Practice statements about active revision, added to the chat context when a student mentions revising or notes
+_REVISION_STATEMENT_IDS = frozenset(('P10', 'P12', 'P18', 'P20'))
+
+def _build_vespa_statement_indices(vespa_statements_data):
+    """Indexes vespa-statements.json for the chat RAG, returning (revision statements, by category, all).
+    Statements are (lower-cased category, statement text, keywords) tuples, in KB order."""
+    statements = vespa_statements_data.get('vespa_statements', {}).get('statements', []) if isinstance(vespa_statements_data, dict) else []
+    if not isinstance(statements, list):
+        return (), {}, ()
+    all_statements = []
+    statements_by_category = {}
+    revision_statements = []
+    for statement_obj in statements:
+        if not isinstance(statement_obj, dict):
+            continue
+        statement_entry = (statement_obj.get('category', '').lower(), statement_obj.get('statement', ''), statement_obj.get('keywords', []))
+        all_statements.append(statement_entry)
+        statements_by_category.setdefault(statement_entry[0], []).append(statement_entry)
+        statement_id = statement_obj.get('id', '')
+        if statement_id in _REVISION_STATEMENT_IDS and len(revision_statements) < 4:
+            revision_statements.append({'element': 'Practice', 'type': 'positive', 'text': statement_entry[1], 'id': statement_id})
+    return tuple(revision_statements), statements_by_category, tuple(all_statements)
+
+REVISION_PRACTICE_STATEMENTS, VESPA_STATEMENTS_BY_CATEGORY, VESPA_STATEMENT_INDEX = _build_vespa_statement_indices(VESPA_STATEMENTS_DATA)
+
+@lru_cache(maxsize=4096)
+def coaching_insight_ids_for_keyword(keyword):
+    """Indices of the coaching insights whose search text contains keyword.
+    Memoized, so this fills in an inverted index keyword by keyword as requests arrive."""
+    return tuple(idx for idx, text in enumerate(COACHING_INSIGHT_SEARCH_TEXT) if keyword in text)
+
 # Load ALPS bands (ensure these JSON files are in your student app's knowledge_base directory)
 alps_bands_btec2010_kb = load_json_file('alpsBands_btec2010_main.json')
 alps_bands_btec2016_kb = load_json_file('alpsBands_btec2016_main.json')
@@ -2098,11 +3314,8 @@ alps_bands_wjec_kb = load_json_file('alpsBands_wjec.json')
 # Load Reflective Statements from text file (similar to tutorapp.py)
 REFLECTIVE_STATEMENTS_DATA = []
 try:
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    # Path should be relative to this app.py, inside knowledge_base.
     # If '100 statements - 2023.txt' is directly in 'knowledge_base' for student app:
-    statements_file_path = os.path.join(current_dir, 'knowledge_base', '100 statements - 2023.txt')
-    statements_file_path = os.path.normpath(statements_file_path)
+    statements_file_path = os.path.join(_KB_DIR, '100 statements - 2023.txt')
     app.logger.info(f"Attempting to load 100 statements from: {statements_file_path}")
     with open(statements_file_path, 'r', encoding='utf-8') as f:
         REFLECTIVE_STATEMENTS_DATA = [line.strip() for line in f if line.strip()]
@@ -2168,47 +3381,13 @@ def save_chat_message_to_knack(student_obj3_id, author, message_text, is_liked=F
     # 1. Get student_email from Object_3 using student_obj3_id
     if student_obj3_id:
         app.logger.info(f"save_chat: Fetching Object_3 record for ID: {student_obj3_id} to get email.")
-        object_3_record = get_knack_record("object_3", record_id=student_obj3_id)
+        object_3_record = get_student_user_details(student_obj3_id)
         if object_3_record and isinstance(object_3_record, dict):
             raw_val_field70 = object_3_record.get('field_70_raw')
             obj_val_field70 = object_3_record.get('field_70')
 
-            if isinstance(obj_val_field70, dict) and 'email' in obj_val_field70 and isinstance(obj_val_field70['email'], str):
-                student_email = obj_val_field70['email'].strip()
-            elif isinstance(raw_val_field70, dict) and 'email' in raw_val_field70 and isinstance(raw_val_field70['email'], str):
-                 student_email = raw_val_field70['email'].strip()
-            elif isinstance(raw_val_field70, str):
-                temp_email_str = raw_val_field70.strip()
-                if temp_email_str.lower().startswith('<a') and 'mailto:' in temp_email_str.lower() and temp_email_str.lower().endswith('</a>'):
-                    try:
-                        mailto_keyword = 'mailto:'
-                        mailto_start_index = temp_email_str.lower().find(mailto_keyword) + len(mailto_keyword)
-                        end_char_index = len(temp_email_str)
-                        quote_index = temp_email_str.find('"', mailto_start_index)
-                        if quote_index != -1: end_char_index = min(end_char_index, quote_index)
-                        single_quote_index = temp_email_str.find("'", mailto_start_index)
-                        if single_quote_index != -1: end_char_index = min(end_char_index, single_quote_index)
-                        angle_bracket_index = temp_email_str.find('>', mailto_start_index)
-                        if angle_bracket_index != -1: end_char_index = min(end_char_index, angle_bracket_index)
-                        extracted_from_href = temp_email_str[mailto_start_index:end_char_index].strip()
-                        if '@' in extracted_from_href and ' ' not in extracted_from_href and '<' not in extracted_from_href:
-                            student_email = extracted_from_href
-                        if not student_email:
-                            text_start_actual_index = temp_email_str.find('>') 
-                            if text_start_actual_index != -1:
-                                text_start_actual_index +=1
-                                text_end_index = temp_email_str.lower().rfind('</a>')
-                                if text_end_index > text_start_actual_index :
-                                    extracted_text = temp_email_str[text_start_actual_index:text_end_index].strip()
-                                    if '@' in extracted_text and ' ' not in extracted_text and '<' not in extracted_text:
-                                        student_email = extracted_text
-                    except Exception as e_parse:
-                        app.logger.warning(f"save_chat: Error parsing HTML email string '{temp_email_str}' from Object_3: {e_parse}")
-                elif '@' in temp_email_str and not '<' in temp_email_str:
-                    student_email = temp_email_str
-            elif isinstance(obj_val_field70, str) and '@' in obj_val_field70 and not '<' in obj_val_field70 :
-                 student_email = obj_val_field70.strip()
-            
+            student_email = extract_email_from_field70(raw_val_field70, obj_val_field70)
+
             if student_email:
                 app.logger.info(f"save_chat: Extracted student email '{student_email}' from Object_3.")
             else:
@@ -2217,34 +3396,28 @@ def save_chat_message_to_knack(student_obj3_id, author, message_text, is_liked=F
             app.logger.warning(f"save_chat: Could not fetch Object_3 record for ID {student_obj3_id}.")
 
     # 2. Get student_object_6_id using student_email (for field_3283)
+    # The Object_10 lookup for step 3 only needs the email too, so it runs alongside this one.
+    obj10_record_future = _submit_background_fetch(get_student_object10_record, student_email) if student_email else None
     if student_email:
         app.logger.info(f"save_chat: Fetching Object_6 record using email '{student_email}' (field_91).")
-        filters_obj6 = [{'field': 'field_91', 'operator': 'is', 'value': student_email}]
-        obj6_response = get_knack_record("object_6", filters=filters_obj6)
-        if obj6_response and isinstance(obj6_response, dict) and obj6_response.get('records'):
-            if obj6_response['records']: # Check if the list is not empty
-                student_object_6_id = obj6_response['records'][0].get('id')
-                app.logger.info(f"save_chat: Found Object_6 ID: {student_object_6_id}.")
-            else:
-                app.logger.warning(f"save_chat: No Object_6 record found for email '{student_email}'.")
+        obj6_record = get_student_object6_record(student_email)
+        if obj6_record and isinstance(obj6_record, dict):
+            student_object_6_id = obj6_record.get('id')
+            app.logger.info(f"save_chat: Found Object_6 ID: {student_object_6_id}.")
         else:
-            app.logger.warning(f"save_chat: Error or unexpected response fetching Object_6 record for email '{student_email}'. Response: {str(obj6_response)[:200]}")
+            app.logger.warning(f"save_chat: No Object_6 record found for email '{student_email}'.")
     else:
         app.logger.warning(f"save_chat: No student_email available to fetch Object_6 ID for student_obj3_id {student_obj3_id}.")
 
     # 3. Get student_object_10_id using student_email (for field_3284)
     if student_email:
         app.logger.info(f"save_chat: Fetching Object_10 record using email '{student_email}' (field_197).")
-        filters_obj10 = [{'field': 'field_197', 'operator': 'is', 'value': student_email}]
-        obj10_response = get_knack_record("object_10", filters=filters_obj10)
-        if obj10_response and isinstance(obj10_response, dict) and obj10_response.get('records'):
-            if obj10_response['records']: # Check if the list is not empty
-                student_object_10_id = obj10_response['records'][0].get('id')
-                app.logger.info(f"save_chat: Found Object_10 ID: {student_object_10_id} for field_3284.")
-            else:
-                app.logger.warning(f"save_chat: No Object_10 record found for email '{student_email}' for field_3284.")
+        obj10_record = obj10_record_future.result()
+        if obj10_record and isinstance(obj10_record, dict):
+            student_object_10_id = obj10_record.get('id')
+            app.logger.info(f"save_chat: Found Object_10 ID: {student_object_10_id} for field_3284.")
         else:
-            app.logger.warning(f"save_chat: Error or unexpected response fetching Object_10 record for email '{student_email}' for field_3284. Response: {str(obj10_response)[:200]}")
+            app.logger.warning(f"save_chat: No Object_10 record found for email '{student_email}' for field_3284.")
     else:
         app.logger.warning(f"save_chat: No student_email available to fetch Object_10 ID for student_obj3_id {student_obj3_id}.")
 
@@ -2272,20 +3445,15 @@ def save_chat_message_to_knack(student_obj3_id, author, message_text, is_liked=F
     else:
         app.logger.warning(f"save_chat: student_object_10_id is None. field_3284 will not be set for chat log related to student_obj3_id {student_obj3_id}.")
         
-    headers = {
-        'X-Knack-Application-Id': KNACK_APP_ID,
-        'X-Knack-REST-API-Key': KNACK_API_KEY,
-        'Content-Type': 'application/json'
-    }
-    
     url = f"{KNACK_API_BASE_URL}/object_119/records"
     app.logger.info(f"Saving chat message to Knack ({url}): Payload Author='{author}', StudentObj3ID='{student_obj3_id}', SessionID='{session_id}', Obj6ID='{student_object_6_id}', Obj10ID='{student_object_10_id}'")
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = KNACK_SESSION.post(url, json=payload, timeout=KNACK_REQUEST_TIMEOUT) # POSTs are not retried, so a message is never saved twice
         response.raise_for_status() # Will raise HTTPError for 4xx/5xx responses
         response_data = response.json()
         app.logger.info(f"Chat message saved successfully to Knack (object_119). Record ID: {response_data.get('id')}")
+        invalidate_knack_cache("object_119")
         return response_data.get('id')
     except requests.exceptions.HTTPError as e:
         # Log the full response content if available for better debugging
@@ -2334,19 +3502,14 @@ def chat_message_like_toggle():
             "field_3287": "Yes" if like_status else "No" # Corrected Liked field for object_119
         }
         
-        headers = {
-            'X-Knack-Application-Id': KNACK_APP_ID,
-            'X-Knack-REST-API-Key': KNACK_API_KEY,
-            'Content-Type': 'application/json'
-        }
-        
         url = f"{KNACK_API_BASE_URL}/{knack_object_key_chatlog}/records/{message_knack_id}"
         app.logger.info(f"Updating like status for message {message_knack_id} in {knack_object_key_chatlog} to {payload['field_3287']}. URL: {url}")
 
         try:
-            response = requests.put(url, headers=headers, json=payload)
+            response = KNACK_SESSION.put(url, json=payload, timeout=KNACK_REQUEST_TIMEOUT)
             response.raise_for_status()
             app.logger.info(f"Successfully updated like status for message {message_knack_id}.")
+            invalidate_knack_cache(knack_object_key_chatlog)
             return jsonify({"success": True, "message_id": message_knack_id, "liked": like_status}), 200
         except requests.exceptions.HTTPError as e:
             app.logger.error(f"HTTP error updating like status for message {message_knack_id}: {e}. Response: {response.content if response else 'No response object'}")
@@ -0,0 +1,29 @@
+# Gunicorn settings (picked up automatically from the working directory by `gunicorn app:app`).
+import gc
+import os
+
+# Requests spend most of their time waiting on Knack/OpenAI, so let each worker overlap several.
+# gthread needs nothing beyond gunicorn; set GUNICORN_WORKER_CLASS=gevent (after adding gevent to
+# requirements.txt) for many more concurrent students per worker.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Must run before app.py (preloaded below) imports requests/ssl/openai.
+    from gevent import monkey
+    monkey.patch_all()
+
+# Load app.py (and all knowledge-base JSON) once in the master, then fork workers
+# that share those pages copy-on-write instead of each re-parsing every KB file.
+preload_app = True
+
+# Heroku sets WEB_CONCURRENCY based on dyno size.
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+
+threads = int(os.getenv('GUNICORN_THREADS', '4'))  # gthread only
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '200'))  # gevent only
+
+
+def pre_fork(server, worker):
+    # Move everything allocated during import (the KBs) into the permanent generation so the
+    # cyclic GC never touches those objects in the workers and dirties the shared pages.
+    gc.freeze()